@@ -0,0 +1,186 @@
+# battle.py - пошаговые бои питомцев
+#
+# The simulator works on teams packed into arrays (one slot per pet) rather
+# than pet documents, and everything that does not change during a fight -
+# turn order and base damage - is worked out once per matchup. Rolls come
+# from a GameRNG, so a fight is replayed exactly from its seed. Challenges
+# between players are stored in MongoDB like trade offers, so any bot worker
+# can accept one.
+
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+
+from leaderboard import pet_power
+from mechanics import GameRNG
+
+TEAM_SIZE = 3  # pets per side
+MAX_ROUNDS = 30  # after that the side with more health left wins
+CRIT_CHANCE = 0.10
+CRIT_MULTIPLIER = 1.5
+DAMAGE_SPREAD = 0.15  # a hit does 85-100% of its base damage
+
+# winner is 0 (first team), 1 (second) or None for a draw; health_left is per side, in shares of 1
+BattleResult = namedtuple("BattleResult", "winner rounds health_left")
+# One hit: (round, side, attacker slot, target slot, damage, critical)
+Hit = namedtuple("Hit", "round side attacker target damage critical")
+
+
+def strongest(pets, count=TEAM_SIZE):
+    """The pets a player fights with unless they pick their own."""
+    return sorted(pets, key=pet_power, reverse=True)[:count]
+
+
+def team_rating(pets):
+    """Matchmaking rating of a team: the sum of its pets' stats."""
+    return sum(pet_power(pet) for pet in pets)
+
+
+class Team:
+    """The pets of one side as parallel arrays of their stats."""
+
+    __slots__ = ("ids", "names", "attack", "defense", "health", "speed")
+
+    def __init__(self, pets):
+        self.ids = [pet["id"] for pet in pets]
+        self.names = [pet["name"] for pet in pets]
+        self.attack = array("q", (pet["stats"]["attack"] for pet in pets))
+        self.defense = array("q", (pet["stats"]["defense"] for pet in pets))
+        self.health = array("q", (pet["stats"]["health"] for pet in pets))
+        self.speed = array("q", (pet["stats"]["speed"] for pet in pets))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Matchup:
+    """Two teams and what their fights have in common.
+
+    Turns go by speed, fastest first; ties are settled by a roll at the start
+    of every fight. Base damage of every attacker against every target is
+    ``attack² / (attack + defense)``, at least 1.
+    """
+
+    def __init__(self, first, second):
+        self.teams = (first, second)
+        self.slots = [(side, slot) for side in (0, 1) for slot in range(len(self.teams[side]))]
+        self.damage = [
+            [
+                [max(1, attack * attack // (attack + defense)) if attack > 0 else 1 for defense in other.defense]
+                for attack in team.attack
+            ]
+            for team, other in ((first, second), (second, first))
+        ]  # damage[side][attacker][target]
+        self.total_health = (sum(first.health) or 1, sum(second.health) or 1)
+
+    def turn_order(self, rng):
+        speeds = [self.teams[side].speed[slot] for side, slot in self.slots]
+        ties = [rng.random() for _ in self.slots]
+        order = sorted(range(len(self.slots)), key=lambda i: (-speeds[i], ties[i]))
+        return [self.slots[i] for i in order]
+
+    def fight(self, rng, log=None, max_rounds=MAX_ROUNDS):
+        """Fight once; pass a list as ``log`` to get every Hit appended to it."""
+        health = [array("q", team.health) for team in self.teams]
+        alive = [[slot for slot in range(len(team)) if health[side][slot] > 0]
+                 for side, team in enumerate(self.teams)]
+        order = self.turn_order(rng)
+        damage = self.damage
+        roll = rng.random
+
+        rounds = 0
+        while alive[0] and alive[1] and rounds < max_rounds:
+            rounds += 1
+            for side, slot in order:
+                if health[side][slot] <= 0:
+                    continue
+                targets = alive[1 - side]
+                if not targets:
+                    break
+                target = targets[int(roll() * len(targets))]
+                critical = roll() < CRIT_CHANCE
+                hit = int(damage[side][slot][target] * (1 - DAMAGE_SPREAD * roll()) *
+                          (CRIT_MULTIPLIER if critical else 1)) or 1
+                health[1 - side][target] -= hit
+                if health[1 - side][target] <= 0:
+                    targets.remove(target)
+                if log is not None:
+                    log.append(Hit(rounds, side, slot, target, hit, critical))
+
+        left = tuple(sum(max(0, value) for value in health[side]) / self.total_health[side] for side in (0, 1))
+        if not alive[1] and alive[0]:
+            winner = 0
+        elif not alive[0] and alive[1]:
+            winner = 1
+        elif left[0] != left[1]:
+            winner = 0 if left[0] > left[1] else 1
+        else:
+            winner = None
+        return BattleResult(winner, rounds, left)
+
+
+def battle(first_pets, second_pets, rng, log=None):
+    """One fight between two lists of pet documents."""
+    return Matchup(Team(first_pets), Team(second_pets)).fight(rng, log)
+
+
+BattleStats = namedtuple("BattleStats", "fights wins draws average_rounds")
+
+
+def simulate_many(first_pets, second_pets, fights, seed=0):
+    """Fight the same matchup ``fights`` times for balance testing.
+
+    wins is (first team's wins, second team's wins).
+    """
+    matchup = Matchup(Team(first_pets), Team(second_pets))
+    rng = GameRNG(seed)
+    wins = [0, 0]
+    draws = rounds = 0
+    for _ in range(fights):
+        result = matchup.fight(rng)
+        rounds += result.rounds
+        if result.winner is None:
+            draws += 1
+        else:
+            wins[result.winner] += 1
+    return BattleStats(fights, tuple(wins), draws, rounds / fights if fights else 0.0)
+
+
+class ChallengeBook:
+    """Open battle challenges, at most one per challenger, expiring through a TTL index."""
+
+    def __init__(self, challenges, ttl=900):
+        self.challenges = challenges
+        self.ttl = ttl
+
+    async def ensure_indexes(self):
+        await self.challenges.create_index([("challenger_id", ASCENDING)], unique=True)
+        await self.challenges.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    async def create(self, challenger_id, opponent_id, pet_ids):
+        """Open (or replace) the challenger's challenge with the team they picked."""
+        now = datetime.now(timezone.utc)
+        await self.challenges.replace_one(
+            {"challenger_id": challenger_id},
+            {
+                "challenger_id": challenger_id,
+                "opponent_id": opponent_id,
+                "pet_ids": list(pet_ids),
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl),
+            },
+            upsert=True,
+        )
+
+    async def take(self, challenger_id, opponent_id):
+        """Remove and return the open challenge, so it can only be answered once; None if there is none."""
+        return await self.challenges.find_one_and_delete({
+            "challenger_id": challenger_id,
+            "opponent_id": opponent_id,
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+        })
+
+    async def cancel(self, challenger_id):
+        await self.challenges.delete_one({"challenger_id": challenger_id})
@@ -0,0 +1,48 @@
+# benchmarks/battles.py - баланс боёв: кто кого побеждает и как быстро считаются бои
+#
+# Builds a random team of every rarity and fights each against each with the
+# game's own simulator. Prints how often the row's team beats the column's
+# and the simulator's throughput. Seeded, so a run can be repeated exactly:
+#   python benchmarks/battles.py --fights 2000 --seed 1
+#   python benchmarks/battles.py --team-size 1
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from battle import TEAM_SIZE, simulate_many  # noqa: E402
+from mechanics import RARITIES, GameRNG, generate_random_pets, rarity_table  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Battle balance and speed")
+    parser.add_argument("--fights", type=int, default=1000, help="fights per matchup")
+    parser.add_argument("--team-size", type=int, default=TEAM_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = GameRNG(args.seed)
+    # A table with a single rarity hatches only that rarity
+    teams = {rarity: generate_random_pets(args.team_size, rng=rng, table=rarity_table({rarity: 1.0}))
+             for rarity in RARITIES}
+
+    total = 0
+    started = time.perf_counter()
+    print(f"Win rate of the row's team against the column's ({args.fights} fights each):")
+    print(f"{'':<12}" + "".join(f"{rarity[:10]:>11}" for rarity in RARITIES))
+    for row in RARITIES:
+        cells = []
+        for column in RARITIES:
+            stats = simulate_many(teams[row], teams[column], args.fights, seed=rng.getrandbits(63))
+            total += stats.fights
+            cells.append(f"{stats.wins[0] / stats.fights:>11.1%}" if stats.fights else f"{'-':>11}")
+        print(f"{row:<12}" + "".join(cells))
+    elapsed = time.perf_counter() - started
+    print(f"\n{total} fights in {elapsed:.2f} s: {total / elapsed:,.0f} fights/s")
+
+
+if __name__ == "__main__":
+    main()
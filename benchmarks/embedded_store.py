@@ -0,0 +1,77 @@
+# benchmarks/embedded_store.py - скорость встроенного хранилища SQLite
+#
+# Fills a temporary SQLite file with users and their pets through the same
+# UserRepository the bot uses, then times reads of whole users, of a few
+# fields, and concurrent writes, which share commits:
+#   python benchmarks/embedded_store.py --users 10000 --pets 30
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedded import SQLiteClient  # noqa: E402
+from mechanics import GameRNG, generate_random_pets  # noqa: E402
+from storage import UserRepository, UserUpdate  # noqa: E402
+
+
+async def run(args):
+    rng = GameRNG(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        client = SQLiteClient(os.path.join(directory, "bench.db"), arrays={"users": ("pets", "id")})
+        users = UserRepository(client["petropolis"]["users"])
+        await users.ensure_indexes()
+
+        started = time.perf_counter()
+        next_id = 1
+        for user_id in range(args.users):
+            pets = generate_random_pets(args.pets, rng=rng)
+            for pet in pets:
+                pet["id"], next_id = next_id, next_id + 1
+            await users.get(user_id)
+            update = UserUpdate()
+            update.push("pets", *pets)
+            await users.bulk_write(update.requests(user_id))
+        print(f"loaded {args.users} users with {args.pets} pets each in {time.perf_counter() - started:.2f} s")
+
+        ids = [rng.randrange(args.users) for _ in range(args.reads)]
+        for name, fields in (("whole user", None), ("coins only", ["coins"])):
+            started = time.perf_counter()
+            for user_id in ids:
+                await users.get(user_id, fields)
+            print(f"read {name}: {(time.perf_counter() - started) / len(ids) * 1e6:.1f} us")
+
+        async def train(user_id):
+            pet_id = user_id * args.pets + 1
+            update = UserUpdate()
+            update.require_pets(pet_id)
+            update.inc_pet(pet_id, "level", 1)
+            update.inc("coins", -1)
+            await users.bulk_write(update.requests(user_id))
+
+        for concurrency in args.concurrency:
+            started = time.perf_counter()
+            for first in range(0, args.writes, concurrency):
+                await asyncio.gather(*(train(user_id % args.users) for user_id in range(first, first + concurrency)))
+            elapsed = time.perf_counter() - started
+            print(f"{concurrency:>4} concurrent writers: {args.writes / elapsed:,.0f} writes/s")
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed of the embedded SQLite store")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--pets", type=int, default=30)
+    parser.add_argument("--reads", type=int, default=10000)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
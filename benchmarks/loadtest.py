@@ -0,0 +1,295 @@
+# benchmarks/loadtest.py - нагрузочный тест бота без Telegram и MongoDB
+#
+# Simulated users play through the real handlers of bot.py: buying and
+# hatching eggs, collecting, browsing and merging pets, browsing the market,
+# and trading, fighting and selling to each other in pairs.
+# Bot API calls go to fake_telegram.py over local HTTP, the database is
+# benchmarks/memory_mongo.py. Reports latency percentiles, throughput and
+# database round-trips per update:
+#   python benchmarks/loadtest.py --users 2000 --rounds 10 --output run.json
+#   python benchmarks/loadtest.py --users 2000 --rounds 10 --baseline run.json
+# With --baseline the run fails (exit code 1) if it is more than --tolerance
+# slower than the baseline, so it can gate performance changes.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Mix of actions per round, with their weights
+ACTIONS = {
+    "collect": 30,
+    "hatch": 25,
+    "pets": 15,
+    "merge": 15,
+    "balance": 10,
+    "daily": 5,
+    "market": 5,
+}
+STARTING_COINS = 1_000_000
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LoadTest:
+
+    def __init__(self, bot, fake, application, client, seed):
+        self.bot = bot
+        self.fake = fake
+        self.application = application
+        self.client = client
+        self.rng = random.Random(seed)
+        self.latencies = defaultdict(list)  # {action: [seconds]}
+        self.process = bot.timed_updates(application.process_update)
+
+    async def send(self, action, update):
+        started = time.perf_counter()
+        await self.process(self.bot.Update.de_json(update, self.application.bot))
+        self.latencies[action].append(time.perf_counter() - started)
+
+    def pets_of(self, user_id):
+        # The cache holds the newest state, the database may still lag behind it
+        entry = self.bot.user_cache.entries.get(user_id)
+        if entry is not None:
+            return entry[0].get("pets", [])
+        doc = next(iter(self.client["petropolis"]["users"].indexes["user_id"].get(user_id, [])), None)
+        return doc.get("pets", []) if doc else []
+
+    async def command(self, action, user_id, text):
+        await self.send(action, self.fake.message_update(user_id, text))
+
+    async def button(self, action, user_id, data):
+        await self.send(action, self.fake.callback_update(user_id, data))
+
+    async def play(self, user_id, rounds, rng):
+        await self.command("start", user_id, "/start")
+        for _ in range(rounds):
+            action = rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+            if action == "hatch":
+                await self.button("buy_egg", user_id, "buy_Базовое")
+                await self.button("hatch", user_id, "hatch_Базовое_1")
+            elif action == "merge":
+                by_type = defaultdict(list)
+                for pet in self.pets_of(user_id):
+                    by_type[pet["type"]].append(pet["id"])
+                pair = next((ids[:2] for ids in by_type.values() if len(ids) >= 2), None)
+                if pair is None:
+                    await self.command("merge", user_id, "/merge")
+                else:
+                    await self.command("merge", user_id, f"/merge {pair[0]} {pair[1]}")
+            elif action == "pets":
+                await self.command("pets", user_id, "/pets")
+                await self.button("pets_page", user_id, "page_pets_rarity_-_1")
+            else:
+                await self.command(action, user_id, f"/{action}")
+
+    async def trade(self, proposer_id, partner_id):
+        offered, answered = self.pets_of(proposer_id), self.pets_of(partner_id)
+        if not offered or not answered:
+            return
+        await self.command("trade", proposer_id, f"/trade {partner_id}")
+        await self.button("offer", proposer_id, f"offer_{partner_id}_{offered[0]['id']}")
+        await self.command("respond", partner_id, f"/respond {proposer_id}")
+        await self.button("settle", partner_id, f"respond_{proposer_id}_{answered[0]['id']}")
+        await self.command("battle", proposer_id, f"/battle {partner_id}")
+        await self.button("fight", partner_id, f"battle_accept_{proposer_id}")
+
+        # The proposer lists two pets, the partner buys one from the page and one by ID
+        listed = [pet["id"] for pet in self.pets_of(proposer_id)[-2:]]
+        for pet_id in listed:
+            await self.command("sell", proposer_id, f"/sell {pet_id} 100")
+        if len(listed) == 2:
+            await self.command("market", partner_id, "/market")
+            await self.button("market_buy", partner_id, f"market_buy_{listed[0]}_100")
+            await self.command("buy", partner_id, f"/buy {listed[1]}")
+
+    async def run(self, users, rounds, concurrency, first_user_id=10_000):
+        semaphore = asyncio.Semaphore(concurrency)
+        user_ids = list(range(first_user_id, first_user_id + users))
+        seeds = [self.rng.random() for _ in user_ids]
+
+        async def user(user_id, seed):
+            async with semaphore:
+                await self.play(user_id, rounds, random.Random(seed))
+
+        async def pair(proposer_id, partner_id):
+            async with semaphore:
+                await self.trade(proposer_id, partner_id)
+
+        await asyncio.gather(*(user(user_id, seed) for user_id, seed in zip(user_ids, seeds)))
+        await asyncio.gather(*(pair(user_ids[i], user_ids[i + 1]) for i in range(0, len(user_ids) - 1, 2)))
+
+
+def seed_users(client, users, first_user_id=10_000):
+    from storage import new_user
+
+    collection = client["petropolis"]["users"]
+    for user_id in range(first_user_id, first_user_id + users):
+        doc = new_user(user_id)
+        doc["coins"] = STARTING_COINS
+        collection._insert(doc)
+
+
+def report(test, elapsed, db_operations, bot_calls):
+    from metrics import UPDATE_DB_OPS
+
+    all_latencies = [value for values in test.latencies.values() for value in values]
+    updates = len(all_latencies)
+    counts = UPDATE_DB_OPS.values.get((), [0])
+    result = {
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(updates / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(all_latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 3),
+        "db_ops_per_update": round(counts[-1] / updates, 3) if updates else 0,
+        "db_ops_total_per_update": round(db_operations / updates, 3) if updates else 0,
+        "bot_api_calls_per_update": round(bot_calls / updates, 3) if updates else 0,
+        "actions": {
+            action: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+            for action, values in sorted(test.latencies.items())
+        },
+    }
+    return result
+
+
+def print_report(result):
+    print(f"{result['updates']} updates in {result['seconds']} s: {result['updates_per_second']} updates/s")
+    print(f"latency p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+    print(f"database round-trips per update: {result['db_ops_per_update']} in handlers, "
+          f"{result['db_ops_total_per_update']} including cache flushes")
+    print(f"Bot API calls per update: {result['bot_api_calls_per_update']}")
+    print(f"\n{'action':<12} {'count':>8} {'p50 ms':>10} {'p99 ms':>10}")
+    for action, stats in result["actions"].items():
+        print(f"{action:<12} {stats['count']:>8} {stats['p50_ms']:>10} {stats['p99_ms']:>10}")
+
+
+def compare(result, baseline, tolerance):
+    """Regressions beyond ``tolerance`` (a fraction) against a previous run."""
+    regressions = []
+    for key in ("p50_ms", "p99_ms", "db_ops_per_update"):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {baseline[key]} -> {result[key]}")
+    if baseline.get("updates_per_second") and \
+            result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append(f"updates_per_second: {baseline['updates_per_second']} -> {result['updates_per_second']}")
+    return regressions
+
+
+async def main(args):
+    import uvicorn
+
+    from fake_telegram import FakeTelegram
+
+    # bot.py reads its configuration at import time
+    os.environ.setdefault("TOKEN", "1:loadtest")
+    os.environ.setdefault("MONGO_URI", "mongodb://127.0.0.1")
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.port}/bot"
+    os.environ["SEND_RATE"] = "1000000"
+    os.environ["RNG_SEED"] = str(args.seed)
+    os.environ["USER_CACHE_FLUSH_INTERVAL"] = str(args.flush_interval)
+    import bot
+    from market import Market
+    from memory_mongo import MemoryClient
+    from metrics import InstrumentedCollection
+    from storage import LazyClient, PetIdAllocator, UserCache, UserRepository
+    from trading import TradeEngine
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if not args.throttle:
+        bot.USER_RATE, bot.USER_BURST, bot.COMMAND_BUDGETS = 1e9, 10**9, {}
+
+    # Swap the database for the in-memory one before anything touches it
+    client = MemoryClient(latency=args.db_latency / 1000)
+    seed_users(client, args.users)
+    db = client["petropolis"]
+    bot.client = LazyClient(lambda: client)
+    bot.users_collection = InstrumentedCollection(db["users"])
+    bot.user_repository = UserRepository(bot.users_collection)
+    bot.user_cache = UserCache(bot.user_repository, max_size=bot.USER_CACHE_SIZE, ttl=bot.USER_CACHE_TTL,
+                               flush_interval=args.flush_interval, ledger=bot.coin_ledger)
+    bot.pet_ids = PetIdAllocator(InstrumentedCollection(db["counters"]))
+    bot.coin_ledger.events = InstrumentedCollection(db["coin_events"])
+    bot.coin_ledger.snapshots = InstrumentedCollection(db["coin_snapshots"])
+    bot.trade_engine = TradeEngine(client, bot.users_collection, InstrumentedCollection(db["trades"]),
+                                   bot.user_cache, bot.RARITIES, ttl=bot.TRADE_TTL)
+    bot.leaderboard = bot.Leaderboard(bot.users_collection, size=bot.LEADERBOARD_SIZE,
+                                      refresh_interval=bot.LEADERBOARD_REFRESH_INTERVAL)
+    bot.reminders.collection = InstrumentedCollection(db["reminders"])
+    bot.battle_challenges.challenges = InstrumentedCollection(db["battles"])
+    bot.market = Market(client, bot.users_collection, InstrumentedCollection(db["listings"]), bot.user_cache,
+                        bot.RARITIES, ledger=bot.coin_ledger, max_listings=bot.MARKET_MAX_LISTINGS,
+                        refresh_interval=bot.MARKET_REFRESH_INTERVAL)
+
+    fake = FakeTelegram()
+    server = uvicorn.Server(uvicorn.Config(fake, host="127.0.0.1", port=args.port, lifespan="off",
+                                           log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    application = bot.build_application()
+    try:
+        async with application:
+            await bot.post_init(application)
+            test = LoadTest(bot, fake, application, client, args.seed)
+            started = time.perf_counter()
+            await test.run(args.users, args.rounds, args.concurrency)
+            elapsed = time.perf_counter() - started
+            await bot.post_shutdown(application)
+    finally:
+        server.should_exit = True
+        await serving
+
+    bot_calls = sum(1 for method, _ in fake.calls if method != "getMe")
+    return report(test, elapsed, client.operations(), bot_calls)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of the bot's handlers")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=10, help="actions per user")
+    parser.add_argument("--concurrency", type=int, default=200, help="users playing at the same time")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="simulated database round-trip, ms")
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--throttle", action="store_true", help="keep the anti-flood limits on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8099, help="port of the fake Bot API")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(main(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
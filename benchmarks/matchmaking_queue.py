@@ -0,0 +1,54 @@
+# benchmarks/matchmaking_queue.py - скорость и качество подбора соперников
+#
+# Sends players with the ratings of real teams through the match queue and
+# reports the time per join, the longest the queue got and how far apart
+# paired teams were. A join looks at a few buckets whatever the number of
+# players, so the time per join should stay flat as --players grows:
+#   python benchmarks/matchmaking_queue.py --players 1000 10000 100000
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from battle import strongest, team_rating  # noqa: E402
+from matchmaking import MatchQueue  # noqa: E402
+from mechanics import GameRNG, generate_random_pets  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed and quality of the match queue")
+    parser.add_argument("--players", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ratio", type=float, default=1.25)
+    parser.add_argument("--spread", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = GameRNG(args.seed)
+    # The strongest 3 of collections of 1-30 pets
+    ratings = [team_rating(strongest(generate_random_pets(rng.randint(1, 30), rng=rng))) for _ in range(2000)]
+
+    print(f"{'players':>8} {'pairs':>8} {'us/join':>9} {'max queue':>10} {'mean gap':>9}")
+    for players in args.players:
+        queue = MatchQueue(ratio=args.ratio, spread=args.spread)
+        rating_of = {}
+        pairs = longest = 0
+        gap = 0.0
+        started = time.perf_counter()
+        for user_id in range(players):
+            rating = rating_of[user_id] = rng.choice(ratings)
+            match = queue.join(user_id, rating)
+            if match is not None:
+                other = rating_of[match[0]]
+                pairs += 1
+                gap += max(rating, other) / min(rating, other) - 1
+            longest = max(longest, len(queue))
+        elapsed = time.perf_counter() - started
+        print(f"{players:>8} {pairs:>8} {elapsed / players * 1e6:>9.2f} {longest:>10} "
+              f"{gap / pairs if pairs else 0:>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
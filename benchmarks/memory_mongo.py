@@ -0,0 +1,267 @@
+# benchmarks/memory_mongo.py - MongoDB в памяти для нагрузочных тестов
+#
+# Implements the part of motor's async API the bot uses, on top of the same
+# filter and update evaluation the user cache uses (storage.matches and
+# storage.apply_update). Transactions are undone from a journal on failure.
+# ``latency`` adds a simulated network round-trip to every operation.
+
+import asyncio
+import copy
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import DeleteOne  # noqa: E402
+
+from storage import get_path, set_path, apply_update, matches, project  # noqa: E402
+
+# Equality lookups on these fields use a hash index instead of a scan
+INDEXED_FIELDS = ("user_id", "_id", "proposer_id", "u")
+
+
+class _Result:
+
+    def __init__(self, matched_count=0, modified_count=0, deleted_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+        self.upserted_id = upserted_id
+
+
+class MemoryCursor:
+
+    def __init__(self, docs, projection):
+        self.docs = docs
+        self.projection = projection
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: get_path(doc, field)[0], reverse=direction < 0)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield project(doc, self.projection)
+
+    async def to_list(self, length=None):
+        return [project(doc, self.projection) for doc in self.docs[:length]]
+
+
+class MemoryCollection:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.docs = []
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.operations = 0
+        self._ids = itertools.count(1)
+
+    async def _round_trip(self):
+        self.operations += 1
+        if self.client.latency:
+            await asyncio.sleep(self.client.latency)
+
+    def _candidates(self, query):
+        for field in INDEXED_FIELDS:
+            value = query.get(field)
+            if value is not None and not isinstance(value, dict):
+                return list(self.indexes[field].get(value, ()))
+        return list(self.docs)
+
+    def _find(self, query):
+        return [doc for doc in self._candidates(query) if matches(doc, query)]
+
+    def _index(self, doc, add=True):
+        for field in INDEXED_FIELDS:
+            if field in doc:
+                bucket = self.indexes[field].setdefault(doc[field], [])
+                if add:
+                    bucket.append(doc)
+                else:
+                    bucket[:] = [other for other in bucket if other is not doc]
+
+    def _insert(self, doc, session=None):
+        doc.setdefault("_id", next(self._ids))
+        self.docs.append(doc)
+        self._index(doc)
+        if session is not None:
+            session.journal.append(lambda: self._remove(doc))
+
+    def _remove(self, doc, session=None):
+        self.docs = [other for other in self.docs if other is not doc]
+        self._index(doc, add=False)
+        if session is not None:
+            session.journal.append(lambda: self._insert(doc))
+
+    def _modify(self, doc, update, array_filters=None, session=None):
+        if session is not None:
+            saved = copy.deepcopy(doc)
+            session.journal.append(lambda: (doc.clear(), doc.update(saved)))
+        apply_update(doc, {op: fields for op, fields in update.items() if op != "$setOnInsert"}, array_filters)
+
+    def _upsert(self, query, update, session=None):
+        doc = {field: value for field, value in query.items()
+               if not field.startswith("$") and not isinstance(value, dict)}
+        for path, value in update.get("$setOnInsert", {}).items():
+            set_path(doc, path, copy.deepcopy(value))
+        self._modify(doc, update)
+        self._insert(doc, session)
+        return doc
+
+    async def create_index(self, keys, **kwargs):
+        await self._round_trip()
+
+    async def find_one(self, query, projection=None, session=None):
+        await self._round_trip()
+        found = self._find(query)
+        return project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None, session=None):
+        self.operations += 1
+        return MemoryCursor(self._find(query or {}), projection)
+
+    async def count_documents(self, query, session=None):
+        await self._round_trip()
+        return len(self._find(query))
+
+    async def insert_one(self, doc, session=None):
+        await self._round_trip()
+        self._insert(copy.deepcopy(doc), session)
+
+    async def insert_many(self, docs, ordered=True, session=None):
+        await self._round_trip()
+        for doc in docs:
+            self._insert(copy.deepcopy(doc), session)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False,
+                                  array_filters=None, session=None):
+        await self._round_trip()
+        found = self._find(query)
+        if not found:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update, session)
+            return project(doc, projection) if return_document else None
+        doc = found[0]
+        before = None if return_document else project(doc, projection)
+        self._modify(doc, update, array_filters, session)
+        return project(doc, projection) if return_document else before
+
+    async def find_one_and_delete(self, query, projection=None, session=None):
+        await self._round_trip()
+        found = self._find(query)
+        if not found:
+            return None
+        self._remove(found[0], session)
+        return project(found[0], projection)
+
+    async def update_one(self, query, update, upsert=False, array_filters=None, session=None):
+        await self._round_trip()
+        return self._update_one(query, update, upsert, array_filters, session)
+
+    def _update_one(self, query, update, upsert=False, array_filters=None, session=None):
+        found = self._find(query)
+        if found:
+            self._modify(found[0], update, array_filters, session)
+            return _Result(matched_count=1, modified_count=1)
+        if upsert:
+            return _Result(upserted_id=self._upsert(query, update, session)["_id"])
+        return _Result()
+
+    async def replace_one(self, query, doc, upsert=False, session=None):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            self._remove(found[0], session)
+        elif not upsert:
+            return _Result()
+        self._insert(copy.deepcopy(doc), session)
+        return _Result(matched_count=len(found), modified_count=len(found))
+
+    async def delete_one(self, query, session=None):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            self._remove(found[0], session)
+        return _Result(deleted_count=len(found[:1]))
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        """UpdateOne and DeleteOne requests, which is all the bot sends."""
+        await self._round_trip()
+        matched = 0
+        for request in requests:
+            if isinstance(request, DeleteOne):
+                found = self._find(request._filter)
+                if found:
+                    self._remove(found[0], session)
+                continue
+            result = self._update_one(request._filter, request._doc, request._upsert,
+                                      request._array_filters, session)
+            matched += result.matched_count
+        return _Result(matched_count=matched, modified_count=matched)
+
+
+class MemorySession:
+
+    def __init__(self):
+        self.journal = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def with_transaction(self, callback):
+        self.journal = []
+        try:
+            return await callback(self)
+        except BaseException:
+            for undo in reversed(self.journal):
+                undo()
+            raise
+        finally:
+            self.journal = []
+
+
+class MemoryDatabase:
+
+    def __init__(self, client):
+        self.client = client
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self.client, name)
+        return self.collections[name]
+
+
+class MemoryClient:
+    """Stand-in for AsyncIOMotorClient."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self)
+        return self.databases[name]
+
+    async def start_session(self):
+        return MemorySession()
+
+    def close(self):
+        pass
+
+    def operations(self):
+        return sum(c.operations for db in self.databases.values() for c in db.collections.values())
@@ -0,0 +1,68 @@
+# benchmarks/migrate.py - скорость миграции пользователей
+#
+# Fills the in-memory Mongo with legacy users (last_claim, no summaries,
+# merged pets with the old coin rate, some repeated pet IDs) and migrates
+# them to the current schema version with different partition counts.
+# ``--latency`` adds a simulated round-trip per operation, which is what
+# partitions overlap. The in-memory store does the server's work in this
+# process too, so its CPU time caps what more partitions gain here:
+#   python benchmarks/migrate.py --users 5000 --latency 0.02 --partitions 1 4 16
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_mongo import MemoryClient  # noqa: E402
+
+from mechanics import GameRNG, RARITY_MULTIPLIERS, generate_random_pets  # noqa: E402
+from migrations import Migrator  # noqa: E402
+from storage import PetIdAllocator  # noqa: E402
+
+
+def legacy_user(user_id, rng, pets):
+    ids = [10000 + (user_id * pets + i) % 90000 for i in range(pets)]  # five digits, like the old random IDs
+    pets = generate_random_pets(pets, rng=rng, ids=ids)
+    for pet in pets[::2]:
+        pet["coin_rate"] = 1 + RARITY_MULTIPLIERS[pet["rarity"]] // 2  # merged before the fix
+    if user_id % 10 == 0 and len(pets) > 1:
+        pets[-1]["id"] = pets[0]["id"]  # the old random IDs could repeat
+    return {"user_id": user_id, "coins": 450, "pets": pets, "last_claim": None, "streak": 0}
+
+
+async def run(args):
+    rng = GameRNG(args.seed)
+    users = [legacy_user(user_id, rng, args.pets) for user_id in range(1, args.users + 1)]
+    print(f"{'partitions':>10} {'seconds':>8} {'users/s':>9} {'stale':>6}")
+    for partitions in args.partitions:
+        db = MemoryClient(latency=args.latency)["petropolis"]
+        for user in users:
+            await db["users"].insert_one(user)
+        migrator = Migrator(db["users"], db["migrations"], PetIdAllocator(db["counters"]),
+                            partitions=partitions, batch_size=args.batch_size)
+        started = time.perf_counter()
+        totals = await migrator.run()
+        elapsed = time.perf_counter() - started
+        assert not await migrator.pending(), "users left behind"
+        async for user in db["users"].find({}, {"pets": 1}):
+            pet_ids = [pet["id"] for pet in user["pets"]]
+            assert len(pet_ids) == len(set(pet_ids)), "repeated pet IDs left"
+        print(f"{partitions:>10} {elapsed:>8.2f} {totals['users'] / elapsed:>9,.0f} {totals['stale']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed of the user migrations")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--pets", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--partitions", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per simulated round-trip")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/simulate.py - офлайн-симуляция вылупления и скрещивания
+#
+# Runs the game's own pet generation with no Telegram or MongoDB and compares
+# the rarity distribution with the configured chances. Seeded, so a run can be
+# repeated exactly:
+#   python benchmarks/simulate.py --hatches 1000000 --egg Премиум --seed 1
+#   python benchmarks/simulate.py --chances '{"Обычный": 0.5, "Мифический": 0.5}'
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mechanics import (EGG_RARITY_BOOSTS, RARITIES, RARITY_CHANCES, GameRNG,  # noqa: E402
+                       generate_random_pets, merge_pet_stats, rarity_table)
+
+
+def expected_distribution(table, boost):
+    """Probability of each rarity for one roll with the given boost."""
+    order, thresholds = table
+    bounds = [0.0] + [min(max(t + boost, 0.0), 1.0) for t in thresholds] + [1.0]
+    return {rarity: bounds[i + 1] - bounds[i] for i, rarity in enumerate(order)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline simulation of hatching and merging")
+    parser.add_argument("--hatches", type=int, default=100000)
+    parser.add_argument("--merges", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=500, help="pets per generate call")
+    parser.add_argument("--egg", choices=EGG_RARITY_BOOSTS, default="Базовое")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chances", type=json.loads, default=RARITY_CHANCES,
+                        help="JSON {rarity: chance} to try instead of the game's")
+    args = parser.parse_args()
+
+    rng = GameRNG(args.seed)
+    table = rarity_table(args.chances)
+    boost = EGG_RARITY_BOOSTS[args.egg]
+
+    counts = Counter()
+    pets = []
+    started = time.perf_counter()
+    for done in range(0, args.hatches, args.batch):
+        batch = generate_random_pets(min(args.batch, args.hatches - done), rarity_boost=boost, rng=rng, table=table)
+        counts.update(pet["rarity"] for pet in batch)
+        if len(pets) < 2 * args.merges:
+            pets.extend(batch[:2 * args.merges - len(pets)])
+    hatch_time = time.perf_counter() - started
+
+    print(f"{args.hatches} hatches ({args.egg}, seed {args.seed}): "
+          f"{args.hatches / hatch_time:,.0f} pets/s")
+    print(f"{'rarity':<12} {'expected':>9} {'observed':>9}")
+    expected = expected_distribution(table, boost)
+    for rarity in RARITIES:
+        if rarity in expected:
+            observed = counts[rarity] / args.hatches if args.hatches else 0
+            print(f"{rarity:<12} {expected[rarity]:>9.4%} {observed:>9.4%}")
+
+    merges = len(pets) // 2
+    if merges:
+        upgraded = 0
+        started = time.perf_counter()
+        for i in range(merges):
+            pet1, pet2 = pets[2 * i], pets[2 * i + 1]
+            merged = merge_pet_stats(pet1, pet2, rng=rng)
+            upgraded += merged["rarity"] != max(pet1, pet2, key=lambda p: p["level"])["rarity"]
+        merge_time = time.perf_counter() - started
+        print(f"{merges} merges: {merges / merge_time:,.0f} merges/s, rarity went up in {upgraded / merges:.2%}")
+
+
+if __name__ == "__main__":
+    main()
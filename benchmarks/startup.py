@@ -0,0 +1,90 @@
+# benchmarks/startup.py - сколько стоит запуск бота до обработки апдейтов
+#
+# Starts fresh interpreters that import bot.py and build the application,
+# which is what every restart pays before post_init, and reports the median
+# time of each phase and the slowest modules bot.py imports. Fails (exit
+# code 1) when the total goes over --budget, so it can gate changes to
+# module-level code:
+#   python benchmarks/startup.py --runs 5 --budget 1.0
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+bot.build_application()
+built = time.perf_counter()
+print(json.dumps({"import": imported - started, "build": built - imported}))
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    # bot.py reads its configuration at import time; nothing is contacted before post_init
+    env.setdefault("TOKEN", "1:startup")
+    env.setdefault("MONGO_URI", "mongodb://127.0.0.1")
+    return env
+
+
+def measure(runs):
+    phases = {"import": [], "build": []}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=child_env(),
+                                capture_output=True, text=True, check=True).stdout
+        for phase, seconds in json.loads(output.splitlines()[-1]).items():
+            phases[phase].append(seconds)
+    return {phase: statistics.median(values) for phase, values in phases.items()}
+
+
+def slowest_imports(count):
+    """The modules bot.py imports by cumulative import time, from ``python -X importtime``."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot"], cwd=ROOT, env=child_env(),
+                            capture_output=True, text=True, check=True).stderr
+    direct = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented two spaces a level and listed before the module that made them
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            direct.append((int(cumulative) / 1e6, name.strip()))
+        elif depth == 0:
+            if name.strip() == "bot":
+                return sorted(direct, reverse=True)[:count]
+            direct = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the bot")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds for import and build together")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    args = parser.parse_args()
+
+    phases = measure(args.runs)
+    total = sum(phases.values())
+    print(f"median of {args.runs} runs: import bot {phases['import']:.3f} s, "
+          f"build_application {phases['build']:.3f} s, total {total:.3f} s")
+    print(f"\n{'seconds':>8}  slowest imports")
+    for seconds, name in slowest_imports(args.top):
+        print(f"{seconds:>8.3f}  {name}")
+
+    if total > args.budget:
+        print(f"\nOver the budget of {args.budget} s")
+        sys.exit(1)
+    print(f"\nWithin the budget of {args.budget} s")
+
+
+if __name__ == "__main__":
+    main()
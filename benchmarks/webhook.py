@@ -0,0 +1,83 @@
+# benchmarks/webhook.py - приём апдейтов через вебхук keep_alive.py
+#
+# fake_telegram.py plays Telegram and posts updates to the KeepAliveApp of
+# bot.py in process (httpx's ASGI transport, no sockets). Checks that the
+# secret token is enforced, then reports how many updates per second the
+# webhook takes in and queues for the handlers:
+#   python benchmarks/webhook.py --updates 5000
+# Exits with code 1 if an update with a wrong or missing secret gets in.
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECRET = "webhook-benchmark"
+
+
+async def rejected(fake, client, update):
+    """Whether the webhook turns the update away with 403."""
+    try:
+        await fake.post_update(client, update)
+    except httpx.HTTPStatusError as e:
+        return e.response.status_code == 403
+    return False
+
+
+async def main(args):
+    # bot.py reads its configuration at import time
+    os.environ.setdefault("TOKEN", "1:webhook")
+    os.environ.setdefault("MONGO_URI", "mongodb://127.0.0.1")
+    import bot
+    from fake_telegram import FakeTelegram
+    from keep_alive import KeepAliveApp
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    application = bot.build_application()
+    app = KeepAliveApp(application, webhook_path=bot.WEBHOOK_PATH, secret_token=SECRET)
+    queue = application.update_queue
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+        url = f"http://bot{bot.WEBHOOK_PATH}"
+        failures = []
+        for name, secret in (("wrong secret", "not-" + SECRET), ("no secret", None)):
+            fake = FakeTelegram(webhook_url=url, secret_token=secret)
+            if not await rejected(fake, client, fake.message_update(1, "/start")) or not queue.empty():
+                failures.append(f"update with {name} was not rejected")
+
+        fake = FakeTelegram(webhook_url=url, secret_token=SECRET)
+        await fake.post_update(client, fake.message_update(1, "/start"))
+        update = queue.get_nowait() if queue.qsize() == 1 else None
+        if update is None or update.message.text != "/start":
+            failures.append("update with the right secret was not queued")
+
+        started = time.perf_counter()
+        for i in range(args.updates):
+            await fake.post_update(client, fake.message_update(i % 1000 + 1, "/balance"))
+        elapsed = time.perf_counter() - started
+        if queue.qsize() != args.updates:
+            failures.append(f"{queue.qsize()} of {args.updates} updates were queued")
+    return failures, args.updates / elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Webhook intake of the bot")
+    parser.add_argument("--updates", type=int, default=5000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    failures, rate = asyncio.run(main(parse_args()))
+    print(f"webhook intake: {rate:,.0f} updates/s")
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+    print("secret token enforced")
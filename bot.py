@@ -1,204 +1,291 @@
 # main.py (refactored for latest python-telegram-bot v20+)
 
 import os
+import asyncio
+import signal
 from dotenv import load_dotenv
-import random
-import json
+load_dotenv()  # before the game modules, mechanics reads RNG_SECRET and RNG_SEED when imported
 import logging
-from datetime import datetime
 import time
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ParseMode
-from telegram.ext import (ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-                          ContextTypes, MessageHandler, ConversationHandler, filters)
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from keep_alive import keep_alive
-import pymongo
+from telegram.constants import ParseMode
+from telegram.error import Forbidden
+from telegram.ext import (AIORateLimiter, ApplicationBuilder, CommandHandler, CallbackQueryHandler,
+                          ContextTypes, MessageHandler, TypeHandler, filters)
+from keep_alive import KeepAliveApp, serve
+from battle import TEAM_SIZE, ChallengeBook, battle, strongest, team_rating
+from embedded import SQLiteClient
+from economy import (added_pets_delta, collect_income, collect_legacy_income, income_full_at, is_legacy_income,
+                     legacy_income, merge_deltas, removed_pets_delta)
+from sharding import ShardRouter, UpdateDispatcher, fetch_updates, shard_for, update_user_id, worker_loop
+from state import Conversations, MemoryStateStore, MongoStateStore, SQLiteStateStore
+from ledger import CoinLedger
+from leaderboard import BOARDS, Leaderboard, legacy_ranking, ranking_delta
+from mechanics import (EGG_PRICES, EGG_RARITY_BOOSTS, HATCH_BATCH_LIMIT, RARITIES, RARITY_MULTIPLIERS,
+                       RARITY_ORDER, PET_TYPES, generate_random_pets, merge_pet_stats, rng_for)
+from market import Market, MarketError
+from matchmaking import MatchQueue
+from metrics import (REGISTRY, InstrumentedCollection, combine, instrument_handlers, render, timed_updates,
+                     with_label)
+from reminders import ReminderScheduler
+from ratelimit import CallbackCoalescer, RateLimiter, throttle
+from pages import NO_FILTER, SORTS, CollectionPages, filter_name, parse_filter, parse_page_data
+from storage import (LazyClient, PetIdAllocator, UserCache, UserRepository, UserUpdate, create_client,
+                     repeated_pet_id)
+from trading import TradeEngine, TradeError
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
-# Храним временные трейды в памяти
-active_trades = {}  # {user_id: {"partner": partner_id, "offer": pet_index, "status": "waiting"|"confirmed"}}
-user_states = {}
-load_dotenv()
 TOKEN=os.getenv("TOKEN")
 MONGO_URI=os.getenv("MONGO_URI")
-client = pymongo.MongoClient(MONGO_URI, ssl=True, tls=True)
-db = client["petropolis"]
-users_collection = db["users"]
-
-# Constants
-PET_TYPES = ["Огненный", "Водный", "Земляной", "Воздушный", "Светлый", "Тёмный"]
-RARITIES = ["Обычный", "Необычный", "Редкостный", "Эпический", "Легендарный", "Мифический"]
-RARITY_CHANCES = {
-    "Обычный": 0.35,
-    "Необычный": 0.30,
-    "Редкостный": 0.20,
-    "Эпический": 0.10,
-    "Легендарный": 0.04,
-    "Мифический": 0.01,
-}
-RARITY_MULTIPLIERS = {
-    "Обычный": 50,
-    "Необычный": 100,
-    "Редкостный": 250,
-    "Эпический": 500,
-    "Легендарный": 1500,
-    "Мифический": 3000,
-}
-EGG_PRICES = {
-    "Базовое": 150,
-    "Премиум": 600,
-    "Редкостное": 1200,
-}
-EGG_RARITY_BOOSTS = {
-    "Базовое": 0,
-    "Премиум": 0.30,
-    "Редкостное": 0.45,
+RNG_SECRET = os.getenv("RNG_SECRET")  # required: keys every hatch, merge and battle roll, keep it private
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")  # mongo | sqlite (one process, no database server)
+SQLITE_PATH = os.getenv("SQLITE_PATH", "petropolis.db")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL of this server, e.g. https://petropolis.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # required in webhook mode: Telegram sends it with every update
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. fake_telegram.py in tests
+PORT = int(os.getenv("PORT", "8080"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+SHARDS = int(os.getenv("SHARDS", "1"))  # worker processes, updates are routed to them by user_id
+STATE_STORE = os.getenv("STATE_STORE", "memory")  # memory | sqlite | mongo
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+STATE_TTL = float(os.getenv("STATE_TTL", "600"))  # seconds a command waits for the rest of its input
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "100000"))  # users in a state per process (memory store)
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_FLUSH_INTERVAL = float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "5"))
+TRADE_TTL = int(os.getenv("TRADE_TTL", "900"))
+BATTLE_TTL = int(os.getenv("BATTLE_TTL", "900"))  # how long a challenge stays open
+MATCH_TIMEOUT = float(os.getenv("MATCH_TIMEOUT", "120"))  # how long /findbattle waits for an opponent
+MATCH_RATIO = float(os.getenv("MATCH_RATIO", "1.25"))  # width of a rating bucket, as a ratio
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "300"))
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "5000"))
+USER_RATE = float(os.getenv("USER_RATE", "2"))  # updates per second per user
+USER_BURST = int(os.getenv("USER_BURST", "10"))
+GLOBAL_RATE = float(os.getenv("GLOBAL_RATE", "0"))  # updates per second per process, 0 = unlimited
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))  # outgoing messages per second, split between shards
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))  # how often shard workers report metrics
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "20"))  # reminders sent per interval
+REMINDER_INTERVAL = float(os.getenv("REMINDER_INTERVAL", "1"))
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "500"))  # coin events per insert
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "1"))
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "100"))  # events between a user's snapshots
+MARKET_MAX_LISTINGS = int(os.getenv("MARKET_MAX_LISTINGS", "20"))  # open listings per seller
+MARKET_REFRESH_INTERVAL = float(os.getenv("MARKET_REFRESH_INTERVAL", "60"))  # how often other shards' listings show up
+
+# Tighter budgets (per second, burst) for commands and buttons that write to the database
+COMMAND_BUDGETS = {
+    "collect": (0.2, 3),
+    "daily": (0.1, 2),
+    "buy": (1, 5),
+    "hatch": (1, 5),
+    "merge": (0.5, 3),
+    "train": (0.5, 3),
+    "trade": (0.2, 3),
+    "offer": (0.2, 3),
+    "respond": (0.2, 3),
+    "battle": (0.2, 3),
+    "findbattle": (0.2, 3),
+    "sell": (0.2, 3),
+    "unlist": (0.2, 3),
+    "market": (1, 5),
 }
 
-# File to store user data
-DATA_FILE = "user_data.json"
+# Summaries built from the pets when a user is first loaded after they were introduced
+SUMMARY_FIELDS = ("income", "power", "rarity_counts", "best_rarity")
+# Fields of the user document that pet commands read besides the pets themselves
+PET_VIEW_FIELDS = ("coins", "pets_version", *SUMMARY_FIELDS)
+
+# The client is built in post_init, so importing this module costs no motor import or connection setup
+if STORAGE_BACKEND == "sqlite":
+    # Pets get their own rows, so a user's write only touches the pets it changed
+    client = LazyClient(lambda: SQLiteClient(SQLITE_PATH, arrays={"users": ("pets", "id")}))
+else:
+    client = LazyClient(lambda: create_client(
+        MONGO_URI,
+        pool_size=MONGO_POOL_SIZE,
+        min_pool_size=MONGO_MIN_POOL_SIZE,
+        connect_timeout_ms=MONGO_CONNECT_TIMEOUT_MS,
+        server_selection_timeout_ms=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socket_timeout_ms=MONGO_SOCKET_TIMEOUT_MS,
+    ))
+db = client["petropolis"]
+# Every database call is timed and counted towards the update that made it
+users_collection = InstrumentedCollection(db["users"])
+user_repository = UserRepository(users_collection)
+# Журнал всех начислений и списаний монет
+coin_ledger = CoinLedger(
+    InstrumentedCollection(db["coin_events"]),
+    InstrumentedCollection(db["coin_snapshots"]),
+    batch_size=LEDGER_BATCH_SIZE,
+    flush_interval=LEDGER_FLUSH_INTERVAL,
+    snapshot_every=LEDGER_SNAPSHOT_EVERY,
+)
+user_cache = UserCache(
+    user_repository,
+    max_size=USER_CACHE_SIZE,
+    ttl=USER_CACHE_TTL,
+    flush_interval=USER_CACHE_FLUSH_INTERVAL,
+    ledger=coin_ledger,  # coin changes are recorded once they are written
+)
+pet_ids = PetIdAllocator(InstrumentedCollection(db["counters"]))
+
+# Conversation state (which command is waiting for input) lives outside handler memory
+if STATE_STORE == "sqlite":
+    state_store = SQLiteStateStore(STATE_DB_PATH)
+elif STATE_STORE == "mongo":
+    state_store = MongoStateStore(db["states"])
+else:
+    state_store = MemoryStateStore(max_size=STATE_CACHE_SIZE)
+# Текстовые сообщения уходят обработчику того состояния, в котором пользователь
+conversations = Conversations(state_store, ttl=STATE_TTL)
+
+# Трейды хранятся в MongoDB, чтобы их видел любой процесс бота
+trade_engine = TradeEngine(client, users_collection, InstrumentedCollection(db["trades"]), user_cache, RARITIES,
+                           ttl=TRADE_TTL)
+leaderboard = Leaderboard(users_collection, size=LEADERBOARD_SIZE, refresh_interval=LEADERBOARD_REFRESH_INTERVAL)
+# Рынок: выставленные питомцы лежат в listings, стакан лотов держится в памяти
+market = Market(client, users_collection, InstrumentedCollection(db["listings"]), user_cache, RARITIES,
+                ledger=coin_ledger, max_listings=MARKET_MAX_LISTINGS, refresh_interval=MARKET_REFRESH_INTERVAL)
+battle_challenges = ChallengeBook(InstrumentedCollection(db["battles"]), ttl=BATTLE_TTL)
+# Очередь /findbattle в памяти процесса; on_timeout подключается в post_init.
+# With SHARDS > 1 the queue is on the worker MATCH_SHARD: the worker that owns a player
+# picks the team from its cache and sends it there (see run_worker)
+MATCH_SHARD = 0
+match_queue = MatchQueue(ratio=MATCH_RATIO, timeout=MATCH_TIMEOUT)
+# Напоминания для тех, кто их включил; send подключается в post_init, когда есть бот
+reminders = ReminderScheduler(InstrumentedCollection(db["reminders"]), send=None,
+                              batch_size=REMINDER_BATCH_SIZE, interval=REMINDER_INTERVAL)
+
+async def get_user(user_id, fields=None):
+    """Retrieve user data from the cache, MongoDB, or create a new user if not found.
+
+    Commands that only need a few fields pass them as ``fields``; an uncached
+    user is then read with a projected query instead of loading the pets.
+    """
+    if fields is not None:
+        user = await user_cache.get_fields(user_id, fields)
+        if all(field in user for field in fields if field in SUMMARY_FIELDS):
+            return user
+        # New and legacy users get their summaries built from the full document once
+        await get_user(user_id)
+        return await user_cache.get_fields(user_id, fields)
+
+    user = await user_cache.get(user_id)
+    if "income" not in user:
+        # Users from before the income summary get it built once
+        changes = UserUpdate().require("income", {"$exists": False}).set("income", legacy_income(user))
+        user = await update_user(user_id, changes) or user
+    if "power" not in user:
+        changes = UserUpdate().require("power", {"$exists": False})
+        for field, value in legacy_ranking(user, RARITIES).items():
+            changes.set(field, value)
+        user = await update_user(user_id, changes) or user
+    return user
 
-# Functions to load and save data
-def load_data():
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, "r") as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            # If the file is not found or the JSON is broken, return a default structure
-            return {}
-    return {}
-
-def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
-def get_user(user_id):
-    """Retrieve user data from MongoDB or create a new user if not found."""
-    user = users_collection.find_one({"user_id": user_id})
-    if not user:
-        user = {
-            "user_id": user_id,
-            "coins": 450,
-            "eggs": {},
-            "pets": [],
-            "last_daily": None,
-            "streak": 0
-        }
-        users_collection.insert_one(user)
+def track_pets(changes, user, added=(), removed=()):
+    """Keep the income summary and ranking keys in step with pets entering or leaving."""
+    rank_inc, rank_set = ranking_delta(user, RARITIES, added, removed)
+    income_inc = merge_deltas(removed_pets_delta(user["income"], removed), added_pets_delta(added))
+    for field, amount in merge_deltas(income_inc, rank_inc).items():
+        changes.inc(field, amount)
+    for field, value in rank_set.items():
+        changes.set(field, value)
+    return changes.inc("pets_version", 1)
+
+async def get_pets(user_id, pet_ids):
+    """Only the given pets of a user plus the fields pet commands need.
+
+    Unlike get_user this never loads the whole collection of an uncached user.
+    """
+    user = await user_cache.get_pets(user_id, pet_ids, PET_VIEW_FIELDS)
+    if user is None or not all(field in user for field in SUMMARY_FIELDS):
+        await get_user(user_id)
+        user = await user_cache.get_pets(user_id, pet_ids, PET_VIEW_FIELDS)
     return user
 
-def save_user(user):
-    """Save or update user data in MongoDB."""
-    users_collection.update_one(
-        {"user_id": user["user_id"]},
-        {"$set": user},
-        upsert=True
-    )
+def repeated_pet_text(pet_id):
+    # Pets from before PetIdAllocator can share an ID until migrations.py renumbers them;
+    # a $pull by that ID would take all of them
+    return f"‼ У тебя несколько питомцев с ID {pet_id}. Скоро им выдадут новые ID, тогда попробуй снова."
+
+async def update_user(user_id, changes, view=None, reason=None):
+    """Apply a UserUpdate; returns the updated user, or None if its conditions are not met.
+
+    The change is visible immediately and written to MongoDB by the next cache
+    flush. Pass the result of get_pets() or get_user(fields=...) as ``view`` to
+    update an uncached user without loading it. Updates that change coins pass
+    a ``reason`` for the coin ledger, which gets the change once it is written.
+    """
+    if view is not None:
+        return await user_cache.update_view(user_id, view, changes, reason)
+    return await user_cache.update(user_id, changes, reason)
 
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
-
-    pets = user.get("pets", [])
-    pet_summary = ", ".join([p["name"] for p in pets]) or "нет"
+    user = await get_user(user_id, fields=("coins", "eggs", "streak", "rarity_counts", "battles_won", "battles_lost"))
 
     text = (
         f"👤 Профиль\n"
         f"💰 Монеты: {user['coins']}\n"
-        f"🥚 Яйца: {len(user['eggs'])}\n"
-        f"🙈 Питомцы: {len(pets)}\n"
-        f"🔥 Стрик: {user.get('streak', 0)} дн"
+        f"🥚 Яйца: {sum(user.get('eggs', {}).values())}\n"
+        f"🙈 Питомцы: {sum(user['rarity_counts'].values())}\n"
+        f"🔥 Стрик: {user.get('streak', 0)} дн\n"
+        f"⚔️ Бои: {user.get('battles_won', 0)} побед, {user.get('battles_lost', 0)} поражений"
     )
     await update.message.reply_text(text)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "<b>Комманды Петрополиса:</b>\n\n"
-        "🥚 <b>Яйца & Питомцы</b>\n"
+        "🥚 <b>Яйца &amp; Питомцы</b>\n"
         "/buy_egg - Купить яйцо\n"
-        "/hatch - Вскрыть купленное яйцо\n"
-        "/pets - Посмотреть свою коллекцию питомцев\n\n"
+        "/hatch [N] - Вскрыть купленные яйца (по одному, по N или все сразу)\n"
+        "/pets [rarity|level|type] [редкость или вид] - Посмотреть свою коллекцию питомцев\n\n"
         "💰 <b>Экономика</b>\n"
         "/collect - Собрать доход с питомцев\n"
         "/daily - Получить дневное вознаграждение\n"
         "/profile - Посмотреть свой профиль\n"
         "/balance - Посмотреть свой баланс\n\n"
         "🔄 <b>Прогресс</b>\n"
-        "/merge <цифра первого питомца> <цифра второго> - Скрестить питомцев воедино\n"
-        "/train <цифра питомца по счету> <качество> - Тренировать питомца\n\n"
+        "/merge &lt;ID первого питомца&gt; &lt;ID второго&gt; - Скрестить питомцев воедино\n"
+        "/train &lt;ID питомца&gt; &lt;качество&gt; - Тренировать питомца\n\n"
         "🤝 <b>Трэйдинг</b>\n"
         "/myid - Узнать своё ID\n"
-        "/trade <ID пользователя> - Обмен питомцами\n\n"
-        "⚔️ <b>Бой - в разработке</b>\n"
-        "/battle <ID пользователя> - Сражаться с другими\n"
-        "/leaderboard - Лидеры"
+        "/trade &lt;ID пользователя&gt; - Обмен питомцами\n\n"
+        "🏪 <b>Рынок</b>\n"
+        "/market [редкость] [вид] [мин. уровень] - Самые дешёвые лоты\n"
+        "/sell &lt;ID питомца&gt; &lt;цена&gt; - Выставить питомца на продажу\n"
+        "/buy &lt;ID питомца&gt; - Купить выставленного питомца\n"
+        "/unlist [ID питомца] - Свои лоты, снять лот с продажи\n\n"
+        "⚔️ <b>Бой</b>\n"
+        f"/battle &lt;ID пользователя&gt; [ID питомцев, до {TEAM_SIZE}] - Вызвать на бой\n"
+        "/findbattle - Найти соперника своего уровня\n"
+        "/leaderboard - Лидеры\n"
+        "/remind [on|off] - Напоминания о доходе и ежедневной награде"
     )
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
-# User init
-def initialize_user(user_id):
-    return {
-        "coins": 450,
-        "pets": [],
-        "last_claim": None,
-        "streak": 0,
-        "last_daily": None,
-    }
-
-# Pet generation
-def determine_rarity(rarity_boost=0):
-    roll = random.random() - rarity_boost
-    if roll < RARITY_CHANCES["Мифический"]:
-        return "Мифический"
-    elif roll < sum(RARITY_CHANCES[r] for r in ["Легендарный", "Мифический"]):
-        return "Легендарный"
-    elif roll < sum(RARITY_CHANCES[r] for r in ["Эпический", "Легендарный", "Мифический"]):
-        return "Эпический"
-    elif roll < sum(RARITY_CHANCES[r] for r in ["Редкостный", "Эпический", "Легендарный", "Мифический"]):
-        return "Редкостный"
-    elif roll < sum(RARITY_CHANCES[r] for r in ["Необычный", "Редкостный", "Эпический", "Легендарный", "Мифический"]):
-        return "Необычный"
-    return "Обычный"
-
-def generate_random_pet(pet_type=None, rarity_boost=0):
-    if pet_type is None:
-        pet_type = random.choice(PET_TYPES)
-    rarity = determine_rarity(rarity_boost)
-    multiplier = RARITY_MULTIPLIERS[rarity]
-    base_stats = random.randint(5, 12) * multiplier
-    return {
-        "id": random.randint(10000, 99999),
-        "name": f"{rarity} {pet_type}",
-        "type": pet_type,
-        "rarity": rarity,
-        "level": 1,
-        "xp": 0,
-        "xp_needed": 100,
-        "stats": {
-            "attack": base_stats + random.randint(-1, 5),
-            "defense": base_stats + random.randint(1, 5),
-            "health": base_stats * 2 + random.randint(5, 7),
-            "speed": base_stats + random.randint(1, 8),
-        },
-        "coin_rate": 20 + (RARITY_MULTIPLIERS[rarity] // 2),
-        "last_collected": None,
-    }
-
 # Bot commands
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id, fields=("coins",))
 
     await update.message.reply_text(f"👋 Привет! У тебя {user['coins']} монет. Напиши /help для большей информации!")
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id, fields=("coins",))
     await update.message.reply_text(f"💸 У тебя {user['coins']} монет.")
 
 async def buy_egg(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -215,99 +302,184 @@ async def buy_egg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = query.from_user.id
     egg_type = query.data.split("_")[1]
-    user = get_user(user_id)
-
-    if user["coins"] < EGG_PRICES[egg_type]:
+    price = EGG_PRICES[egg_type]
+
+    user = await get_user(user_id, fields=("coins", "eggs"))
+    changes = (UserUpdate()
+               .require("coins", {"$gte": price})
+               .inc("coins", -price)
+               .inc(f"eggs.{egg_type}", 1))
+    if await update_user(user_id, changes, view=user, reason="egg") is None:
         await query.edit_message_text(f"💸 Недостаточно монет для покупки яйца типа {egg_type}.")
         return
 
-    if "eggs" not in user:
-        user["eggs"] = {}
-    if egg_type not in user["eggs"]:
-        user["eggs"][egg_type] = 0
-
-    user["eggs"][egg_type] += 1
-    user["coins"] -= EGG_PRICES[egg_type]
-    save_user(user)
-
     await query.edit_message_text(f"🐣 Вы купили {egg_type} яйцо за {EGG_PRICES[egg_type]} монет!")
 
 async def hatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display available eggs to hatch"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id, fields=("eggs",))
 
-    if "eggs" not in user or not user["eggs"]:
+    if "eggs" not in user or not any(count > 0 for count in user["eggs"].values()):
         await update.message.reply_text("🥚 У тебя нет яиц для вскрытия. Купи их через /buy_egg!")
         return
 
+    # /hatch N adds a button to open N eggs at once
+    custom = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+
     keyboard = []
     for egg_type, count in user["eggs"].items():
         if count > 0:
-            keyboard.append([InlineKeyboardButton(f"{egg_type} яйцо ({count})", callback_data=f"hatch_{egg_type}")])
+            keyboard.append([InlineKeyboardButton(f"{egg_type} яйцо ({count})", callback_data=f"hatch_{egg_type}_1")])
+            batch = []
+            if custom and 1 < custom <= count:
+                batch.append(InlineKeyboardButton(f"×{custom}", callback_data=f"hatch_{egg_type}_{custom}"))
+            if count >= 10 and custom != 10:
+                batch.append(InlineKeyboardButton("×10", callback_data=f"hatch_{egg_type}_10"))
+            if count > 1:
+                batch.append(InlineKeyboardButton("Все", callback_data=f"hatch_{egg_type}_all"))
+            if batch:
+                keyboard.append(batch)
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("🥚 Выбери яйцо для вскрытия:", reply_markup=reply_markup)
 
 async def hatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Process egg hatching"""
+    """Process egg hatching, one egg or a whole batch"""
     query = update.callback_query
     await query.answer()
 
     user_id = query.from_user.id
-    egg_type = query.data.split("_")[1]
-    user = get_user(user_id)
+    parts = query.data.split("_")
+    egg_type = parts[1]
+    amount = parts[2] if len(parts) > 2 else "1"
 
-    if egg_type not in user["eggs"] or user["eggs"][egg_type] <= 0:
+    user = await get_user(user_id, fields=("eggs", *PET_VIEW_FIELDS))
+    if amount == "all":
+        count = min(user.get("eggs", {}).get(egg_type, 0), HATCH_BATCH_LIMIT)
+    else:
+        count = min(int(amount), HATCH_BATCH_LIMIT)
+    if count <= 0:
         await query.edit_message_text(f"😔 У тебя нет яиц типа *{egg_type}* для вскрытия.")
         return
 
-    pet = generate_random_pet(rarity_boost=EGG_RARITY_BOOSTS[egg_type])
-    user["eggs"][egg_type] -= 1
-
-    if "pets" not in user:
-        user["pets"] = []
+    # All new pets go to MongoDB in a single $push with $each
+    ids = await pet_ids.allocate(count)
+    new_pets = generate_random_pets(count, rarity_boost=EGG_RARITY_BOOSTS[egg_type],
+                                    rng=rng_for("hatch", user_id, ids[0]), ids=ids)
+    changes = (UserUpdate()
+               .require(f"eggs.{egg_type}", {"$gte": count})
+               .inc(f"eggs.{egg_type}", -count))
+    track_pets(changes, user, added=new_pets).push("pets", *new_pets)
+    if await update_user(user_id, changes, view=user) is None:
+        await query.edit_message_text(f"😔 У тебя нет яиц типа *{egg_type}* для вскрытия.")
+        return
 
-    user["pets"].append(pet)
-    save_user(user)
+    if count == 1:
+        pet = new_pets[0]
+        await query.edit_message_text(
+            f"🥚 Из {egg_type} яйца вылупился {pet['rarity']} {pet['type']} питомец!\n\n"
+            f"🆔 ID: {pet['id']}\n"
+            f"⚔️ Атака: {pet['stats']['attack']}\n"
+            f"🛡️ Защита: {pet['stats']['defense']}\n"
+            f"❤️ Здоровье: {pet['stats']['health']}\n"
+            f"⚡ Скорость: {pet['stats']['speed']}\n\n"
+            f"Этот питомец приносит {pet['coin_rate']} монет/час."
+        )
+        return
 
+    rarity_counts = {}
+    for pet in new_pets:
+        rarity_counts[pet["rarity"]] = rarity_counts.get(pet["rarity"], 0) + 1
+    summary = "\n".join(f"• {rarity}: {rarity_counts[rarity]}" for rarity in RARITY_ORDER if rarity in rarity_counts)
     await query.edit_message_text(
-        f"🥚 Из {egg_type} яйца вылупился {pet['rarity']} {pet['type']} питомец!\n\n"
-        f"🆔 ID: {pet['id']}\n"
-        f"⚔️ Атака: {pet['stats']['attack']}\n"
-        f"🛡️ Защита: {pet['stats']['defense']}\n"
-        f"❤️ Здоровье: {pet['stats']['health']}\n"
-        f"⚡ Скорость: {pet['stats']['speed']}\n\n"
-        f"Этот питомец приносит {pet['coin_rate']} монет/час."
+        f"🥚 Из {count} яиц типа {egg_type} вылупились питомцы!\n\n"
+        f"{summary}\n\n"
+        f"Вместе они приносят {sum(pet['coin_rate'] for pet in new_pets)} монет/час. Смотри их в /pets."
     )
 
+def render_pets_page(view, entries, total):
+    pet_list = "".join(
+        f"{i}. {pet['name']} (ID: {pet['id']}) - Уровень {pet['level']}\n"
+        f"   ⚔️ {pet['stats']['attack']} | 🛡️ {pet['stats']['defense']} | "
+        f"❤️ {pet['stats']['health']} | ⚡ {pet['stats']['speed']}\n"
+        f"   Приносит {pet['coin_rate']} монет/ч\n\n"
+        for i, pet in entries
+    )
+    return f"🙈 Твои питомцы ({total}):\n\n{pet_list or 'Таких питомцев нет.'}", []
+
+def render_merge_page(view, entries, total):
+    pet_list = "".join(f"{i}. {pet['name']} (ID: {pet['id']}) - Level {pet['level']}\n" for i, pet in entries)
+    return (
+        f"➕ Для того, чтобы скрестить питомцев, укажи их ID используя: /merge <ID> <ID>\n\n"
+        f"🐵 Твои питомцы:\n{pet_list}"
+    ), []
+
+def render_trade_page(view, entries, total):
+    kind, other_id = view.split(".")
+    keyboard = [
+        [InlineKeyboardButton(f"{pet['name']} ({pet['rarity']})", callback_data=f"{kind}_{other_id}_{pet['id']}")]
+        for i, pet in entries
+    ]
+    if kind == "offer":
+        return f"Выбери питомца, которого ты хочешь предложить @{other_id}:", keyboard
+    return "Выбери, какого питомца ты отдашь в обмен:", keyboard
+
+# Страницы коллекций кешируются до следующего изменения питомцев пользователя
+collection_pages = CollectionPages(
+    {"pets": render_pets_page, "merge": render_merge_page, "offer": render_trade_page, "respond": render_trade_page},
+    max_size=PAGE_CACHE_SIZE,
+)
+
 async def pets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display user's pets"""
+    """Display user's pets: /pets [sort] [rarity or type]"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
 
     if not user.get("pets"):
         await update.message.reply_text("😉 У тебя пока нет питомцев. Купи и вскрой яйцо сначала!")
         return
 
-    pet_list = ""
-    for i, pet in enumerate(user["pets"], 1):
-        pet_list += (
-            f"{i}. {pet['name']} (ID: {pet['id']}) - Уровень {pet['level']}\n"
-            f"   ⚔️ {pet['stats']['attack']} | 🛡️ {pet['stats']['defense']} | "
-            f"❤️ {pet['stats']['health']} | ⚡ {pet['stats']['speed']}\n"
-            f"   Приносит {pet['coin_rate']} монет/ч\n\n"
-        )
+    sort, filt = "added", NO_FILTER
+    for arg in context.args or []:
+        if arg.lower() in SORTS:
+            sort = arg.lower()
+        elif parse_filter(arg):
+            filt = parse_filter(arg)
+        else:
+            await update.message.reply_text(
+                f"Напиши: /pets [{'|'.join(SORTS)}] [редкость или вид], например /pets level {filter_name('r3')}"
+            )
+            return
+
+    text, markup = collection_pages.render(user, "pets", sort, filt)
+    await update.message.reply_text(text, reply_markup=markup)
 
-    await update.message.reply_text(f"🙈 Твои питомцы:\n\n{pet_list}")
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Flip, sort or filter a collection page"""
+    query = update.callback_query
+    await query.answer()
+
+    data = parse_page_data(query.data)
+    if data is None:
+        return
+    view, sort, filt, page = data
+
+    user = await get_user(query.from_user.id)
+    if not user.get("pets"):
+        await query.edit_message_text("😉 У тебя пока нет питомцев. Купи и вскрой яйцо сначала!")
+        return
+
+    text, markup = collection_pages.render(user, view, sort, filt, page)
+    await query.edit_message_text(text, reply_markup=markup)
 
 async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Claim daily reward"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id, fields=("coins", "last_daily", "streak", "reminders"))
 
     current_time = time.time()
-    last_daily = user.get("last_daily", 0)
+    last_daily = user.get("last_daily")
 
     # Check if 20 hours have passed since last claim
     if last_daily and current_time - last_daily < 20 * 3600:
@@ -322,16 +494,23 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         streak = 1  # Reset streak
 
-    user["streak"] = streak
-    user["last_daily"] = current_time
-
     # Calculate reward based on streak
     base_reward = 120
     streak_bonus = min(streak * 10, 3000)  # Cap streak bonus at 100
     total_reward = base_reward + streak_bonus
 
-    user["coins"] += total_reward
-    save_user(user)
+    # Only one claim can win if several arrive at once
+    changes = (UserUpdate()
+               .require("last_daily", last_daily)
+               .set("streak", streak)
+               .set("last_daily", current_time)
+               .inc("coins", total_reward))
+    user = await update_user(user_id, changes, view=user, reason="daily")
+    if user is None:
+        await update.message.reply_text("🕰 Ты сможешь получить вознаграждение через 20 ч.")
+        return
+    if user.get("reminders"):
+        reminders.schedule(user_id, "daily", current_time + 20 * 3600)
 
     await update.message.reply_text(
         f"🎁 Вознаграждение получено! +{total_reward} монет\n"
@@ -342,31 +521,36 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Collect coins from pets"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id, fields=("coins", "income", "rarity_counts", "reminders", "pets_version"))
 
-    if not user.get("pets"):
+    if not any(user["rarity_counts"].values()):
         await update.message.reply_text("😶 У тебя нет питомцев, которые отдают дань.")
         return
 
-    current_time = time.time()
-    total_coins = 0
-
-    for pet in user["pets"]:
-        last_collected = pet.get("last_collected", 0)
-        if last_collected is None:
-            last_collected = 0
-
-        # Calculate hours since last collection (max 24 hours to prevent massive accumulation)
-        hours_passed = min(24, (current_time - last_collected) / 3600) if last_collected > 0 else 1
-
-        if hours_passed >= 1:
-            coins_earned = int(pet["coin_rate"] * hours_passed)
-            total_coins += coins_earned
-            pet["last_collected"] = current_time
+    # One arithmetic step over the income summary instead of a pass over every pet
+    income = user["income"]
+    if is_legacy_income(income):
+        # Once per user from before the summary: their pets still pay from their own last_collected
+        full_user = await get_user(user_id)
+        income = full_user["income"]
+        total_coins, new_income = collect_legacy_income(income, full_user["pets"], time.time())
+    else:
+        total_coins, new_income = collect_income(income, time.time())
 
     if total_coins > 0:
-        user["coins"] += total_coins
-        save_user(user)
+        # The whole summary is written back, so it must still belong to the same pets; a migration that
+        # changes coin rates bumps pets_version, and a copy cached from before it doesn't get through
+        changes = (UserUpdate()
+                   .require("income.joined_at", income["joined_at"])
+                   .require("pets_version", user.get("pets_version"))
+                   .inc("coins", total_coins)
+                   .set("income", new_income))
+        user = await update_user(user_id, changes, view=user, reason="collect")
+        if user is None:
+            await update.message.reply_text("😁 Не спеши - денег нет, но ты держись.")
+            return
+        if user.get("reminders") and income_full_at(new_income):
+            reminders.schedule(user_id, "income", income_full_at(new_income))
         await update.message.reply_text(f"🐶 Ты собрал {total_coins} монет со своих питомцев! Твой баланс {user['coins']} монет.")
     else:
         await update.message.reply_text("😁 Не спеши - денег нет, но ты держись.")
@@ -374,55 +558,51 @@ async def collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def merge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Merge pets to increase level"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
 
     if not user.get("pets") or len(user["pets"]) < 2:
         await update.message.reply_text("❗ Тебе нужно как минимум 2 питомца, чтобы скрестить их.")
         return
 
     # Display user's pets for merging
-    pet_list = ""
-    for i, pet in enumerate(user["pets"], 1):
-        pet_list += f"{i}. {pet['name']} (ID: {pet['id']}) - Level {pet['level']}\n"
-
-    await update.message.reply_text(
-        f"➕ Для того, чтобы скрестить питомцев, укажи каких именно используя: /merge 1 2\n\n"
-        f"🐵 Твои питомцы:\n{pet_list}"
-    )
+    text, markup = collection_pages.render(user, "merge")
+    await update.message.reply_text(text, reply_markup=markup)
 
 async def merge_pets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Process pet merging"""
+    """Process pet merging: /merge <ID> <ID>"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
 
     if not context.args or len(context.args) != 2:
-        application.pending_merges[user_id] = True
-        user_states[user_id] = "merge"
-        await update.message.reply_text("❗ Укажи, пожалуйста, двух питомцев, то есть: /merge 1 2")
+        await conversations.begin(user_id, "merge")
+        await merge(update, context)
         return
 
     try:
-        # Convert to zero-based indices
-        pet1_idx = int(context.args[0]) - 1
-        pet2_idx = int(context.args[1]) - 1
+        pet1_id = int(context.args[0])
+        pet2_id = int(context.args[1])
 
-        if pet1_idx == pet2_idx:
+        if pet1_id == pet2_id:
             await update.message.reply_text("😡 Ты не можешь скрестить питомца с им же самим!")
             return
 
-        pets = user["pets"]
+        user = await get_pets(user_id, [pet1_id, pet2_id])
+        pets = {pet["id"]: pet for pet in user["pets"]}
 
-        if pet1_idx < 0 or pet1_idx >= len(pets) or pet2_idx < 0 or pet2_idx >= len(pets):
-            await update.message.reply_text("Некорректно введено число питомца.")
+        if pet1_id not in pets or pet2_id not in pets:
+            await update.message.reply_text("Некорректно введено ID питомца.")
+            return
+        repeated = repeated_pet_id(user["pets"])
+        if repeated is not None:
+            await update.message.reply_text(repeated_pet_text(repeated))
             return
 
-        pet1 = pets[pet1_idx]
-        pet2 = pets[pet2_idx]
+        pet1 = pets[pet1_id]
+        pet2 = pets[pet2_id]
 
         merge_cost = 140 + 20 * (pet1["level"] + pet2["level"])  # Merging is more expensive with higher level pets
 
         if user["coins"] < merge_cost:
-            update.message.reply_text(f"😟 У тебя нет достаточно денег для скрещивания. Тебе надо {merge_cost} монет.")
+            await update.message.reply_text(f"😟 У тебя нет достаточно денег для скрещивания. Тебе надо {merge_cost} монет.")
             return
 
         # Check if pets are of the same type
@@ -431,19 +611,19 @@ async def merge_pets(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Create the merged pet
-        merged_pet = merge_pet_stats(pet1, pet2)
-
-        # Remove the old pets
-        if pet1_idx > pet2_idx:
-            pets.pop(pet1_idx)
-            pets.pop(pet2_idx)
-        else:
-            pets.pop(pet2_idx)
-            pets.pop(pet1_idx)
-
-        # Add the new merged pet
-        pets.append(merged_pet)
-        save_user(user)
+        pet_id = (await pet_ids.allocate())[0]
+        merged_pet = merge_pet_stats(pet1, pet2, rng=rng_for("merge", user_id, pet_id), pet_id=pet_id)
+
+        # Replace the old pets with the merged one
+        changes = (UserUpdate()
+                   .require("coins", {"$gte": merge_cost})
+                   .require_pets(pet1["id"], pet2["id"])
+                   .inc("coins", -merge_cost))
+        track_pets(changes, user, added=[merged_pet], removed=[pet1, pet2])
+        changes.pull_pets(pet1["id"], pet2["id"]).push("pets", merged_pet)
+        if await update_user(user_id, changes, view=user, reason="merge") is None:
+            await update.message.reply_text(f"😟 У тебя нет достаточно денег для скрещивания. Тебе надо {merge_cost} монет.")
+            return
 
         await update.message.reply_text(
             f"😎 Успешно скрещено питомца в {merged_pet['name']}!\n\n"
@@ -453,70 +633,23 @@ async def merge_pets(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"😋 Монет приносит: {merged_pet['coin_rate']} монет/ч"
         )
 
-        application.pending_merges.pop(user_id, None)
-        user_states.pop(user_id, None)
+        await conversations.end(user_id)
 
     except ValueError:
-        await update.message.reply_text("Введи дейвствительное число питомца.")
-
-def merge_pet_stats(pet1, pet2):
-    """Merge two pets' stats and potentially increase rarity"""
-    # Determine which pet has higher level/rarity for base
-    rarities_order = {r: i for i, r in enumerate(RARITIES)}
-
-    # Use the higher level pet as the base
-    base_pet = pet1 if pet1["level"] >= pet2["level"] else pet2
-    other_pet = pet2 if base_pet == pet1 else pet1
-
-    # Create a new pet based on the higher level one
-    merged_pet = base_pet.copy()
-    merged_pet["id"] = random.randint(10000, 99999)  # New ID
-
-    # Increase level
-    merged_pet["level"] = base_pet["level"] + 1
-
-    # Merge stats (base + 50% of other pet's stats)
-    for stat in ["attack", "defense", "health", "speed"]:
-        bonus = other_pet["stats"][stat] * 0.5
-        merged_pet["stats"][stat] = int(base_pet["stats"][stat] + bonus)
-
-    # Chance to increase rarity based on combined levels
-    combined_level = pet1["level"] + pet2["level"]
-    rarity_chance = min(0.30 * combined_level, 0.60)  # Max 50% chance
-
-    current_rarity_idx = rarities_order[base_pet["rarity"]]
-    if current_rarity_idx < len(RARITIES) - 1 and random.random() < rarity_chance:
-        new_rarity = RARITIES[current_rarity_idx + 1]
-        merged_pet["rarity"] = new_rarity
-
-        # Bonus stats from rarity increase
-        rarity_mult = RARITY_MULTIPLIERS[new_rarity] / RARITY_MULTIPLIERS[base_pet["rarity"]]
-        for stat in merged_pet["stats"]:
-            merged_pet["stats"][stat] = int(merged_pet["stats"][stat] * rarity_mult)
-
-    # Update name and coin rate
-    merged_pet["name"] = f"{merged_pet['rarity']} {merged_pet['type']}"
-    merged_pet["coin_rate"] = 1 + (RARITY_MULTIPLIERS[merged_pet["rarity"]] // 2)
-
-    # Reset collection time
-    merged_pet["last_collected"] = None
-
-    return merged_pet
+        await update.message.reply_text("Введи действительное ID питомца.")
 
 async def train_pet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Process pet training"""
+    """Process pet training: /train <ID> <stat>"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
 
     # Ensure the command has the correct number of arguments
     if not context.args or len(context.args) != 2:
-        user_states[user_id] = "train"
-        await update.message.reply_text("‼ Введи число питомца и что нужно прокачать, то есть: /train_pet 1 attack")
+        await conversations.begin(user_id, "train")
+        await update.message.reply_text("‼ Введи ID питомца и что нужно прокачать, то есть: /train 100001 attack")
         return
 
     try:
-        # Convert to zero-based index
-        pet_idx = int(context.args[0]) - 1
+        pet_id = int(context.args[0])
         stat = context.args[1].lower()
 
         # Check if the stat is valid
@@ -524,42 +657,50 @@ async def train_pet(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("😮 О чем ты?. Выбери одно из: attack, defense, health, speed.")
             return
 
-        training_cost = 80 + 10 * user["pets"][pet_idx]["level"]  # Scaling cost based on pet level
+        user = await get_pets(user_id, [pet_id])
 
-        if user["coins"] < training_cost:
-            await update.message.reply_text(f"⚠ Тебе надо {training_cost} монет для улучшения!")
+        # Check if the pet ID is valid
+        if not user["pets"]:
+            await update.message.reply_text("Неверное ID питомца.")
+            return
+        if len(user["pets"]) > 1:
+            await update.message.reply_text(repeated_pet_text(pet_id))
             return
 
-        pets = user["pets"]
+        pet = user["pets"][0]
+        training_cost = 80 + 10 * pet["level"]  # Scaling cost based on pet level
 
-        # Check if the pet index is valid
-        if pet_idx < 0 or pet_idx >= len(pets):
-            await update.message.reply_text("Неверное число питомца.")
+        if user["coins"] < training_cost:
+            await update.message.reply_text(f"⚠ Тебе надо {training_cost} монет для улучшения!")
             return
 
-        pet = pets[pet_idx]
-
         # Increase the stat
         increase = 1 + (RARITY_MULTIPLIERS[pet["rarity"]] // 2)
-        old_value = pet["stats"][stat]
-
         if stat == "health":
-            pet["stats"][stat] += increase * 2  # Health increases more
-        else:
-            pet["stats"][stat] += increase
+            increase *= 2  # Health increases more
+        old_value = pet["stats"][stat]
 
         # Deduct coins for the training
-        user["coins"] -= training_cost
-        save_user(user)
+        changes = (UserUpdate()
+                   .require("coins", {"$gte": training_cost})
+                   .require_pets(pet["id"])
+                   .inc("coins", -training_cost)
+                   .inc("power", increase)
+                   .inc("pets_version", 1)
+                   .inc_pet(pet["id"], f"stats.{stat}", increase))
+        user = await update_user(user_id, changes, view=user, reason="train")
+        if user is None:
+            await update.message.reply_text(f"⚠ Тебе надо {training_cost} монет для улучшения!")
+            return
 
         # Send feedback to the user
         await update.message.reply_text(
             f"🎉 Лвл {pet['name']} {stat} поднят!\n"
-            f"{stat.capitalize()}: {old_value} → {pet['stats'][stat]} (+{pet['stats'][stat] - old_value})\n"
+            f"{stat.capitalize()}: {old_value} → {old_value + increase} (+{increase})\n"
             f"💲 Теперь твой баланс {user['coins']} монет."
         )
 
-        user_states.pop(user_id, None)
+        await conversations.end(user_id)
 
     except ValueError:
         await update.message.reply_text("Введи действительное число.")
@@ -569,61 +710,55 @@ async def trade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Напиши: /trade <user_id>")
         return
 
-    partner_id = context.args[0]
-    user_id = str(update.effective_user.id)
+    try:
+        partner_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Напиши: /trade <user_id>")
+        return
+    user_id = update.effective_user.id
 
     if user_id == partner_id:
         await update.message.reply_text("Ты не можешь торговать сам с собой.")
         return
 
-    partner = get_user(partner_id)
-    if not partner:
+    if not await user_repository.exists(partner_id):
         await update.message.reply_text("Такой пользователь не найден.")
         return
 
-    user_pets = get_user(user_id).get("pets", [])
-    if not user_pets:
+    user = await get_user(user_id)
+    if not user.get("pets"):
         await update.message.reply_text("У тебя нет питомцев для обмена.")
         return
 
     # Выбор питомца
-    keyboard = []
-    for i, pet in enumerate(user_pets):
-        keyboard.append([
-            InlineKeyboardButton(f"{pet['name']} ({pet['rarity']})", callback_data=f"offer_{partner_id}_{i}")
-        ])
-
-    await update.message.reply_text(
-        f"Выбери питомца, которого ты хочешь предложить @{partner_id}:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    text, markup = collection_pages.render(user, f"offer.{partner_id}")
+    await update.message.reply_text(text, reply_markup=markup)
 
 async def offer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user_id = str(query.from_user.id)
-    _, partner_id, pet_index = query.data.split("_")
-    pet_index = int(pet_index)
+    user_id = query.from_user.id
+    _, partner_id, pet_id = query.data.split("_")
+    partner_id = int(partner_id)
+    pet_id = int(pet_id)
 
-    user_data = get_user(user_id)
-    if pet_index >= len(user_data.get("pets", [])):
+    user_data = await get_pets(user_id, [pet_id])
+    offered_pet = next(iter(user_data["pets"]), None)
+    if offered_pet is None:
         await query.edit_message_text("Неверный выбор питомца.")
         return
+    if len(user_data["pets"]) > 1:
+        await query.edit_message_text(repeated_pet_text(pet_id))
+        return
 
-    active_trades[user_id] = {
-        "partner": partner_id,
-        "offer": pet_index,
-        "status": "waiting"
-    }
+    await trade_engine.create_offer(user_id, partner_id, pet_id)
 
     await query.edit_message_text("Предложение отправлено. Ожидаем ответа второго игрока.")
 
     # Уведомим второго игрока
-    partner_data = get_user(partner_id)
-    offered_pet = user_data["pets"][pet_index]
     await context.bot.send_message(
-        chat_id=int(partner_id),
+        chat_id=partner_id,
         text=f"Тебе предложили обмен: {offered_pet['name']} ({offered_pet['rarity']}). Хочешь предложить ответного питомца?\nНапиши /respond {user_id}"
     )
 
@@ -632,101 +767,494 @@ async def respond_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Напиши: /respond <user_id>")
         return
 
-    proposer_id = context.args[0]
-    user_id = str(update.effective_user.id)
+    try:
+        proposer_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Напиши: /respond <user_id>")
+        return
+    user_id = update.effective_user.id
 
-    if proposer_id not in active_trades:
+    trade = await trade_engine.get_offer(proposer_id)
+    if not trade or trade["partner_id"] != user_id:
         await update.message.reply_text("Нет активного предложения от этого пользователя.")
         return
 
     # Выбор ответного питомца
-    user_pets = get_user(user_id).get("pets", [])
-    if not user_pets:
+    user = await get_user(user_id)
+    if not user.get("pets"):
         await update.message.reply_text("У тебя нет питомцев для обмена.")
         return
 
-    keyboard = []
-    for i, pet in enumerate(user_pets):
-        keyboard.append([
-            InlineKeyboardButton(f"{pet['name']} ({pet['rarity']})", callback_data=f"respond_{proposer_id}_{i}")
-        ])
+    text, markup = collection_pages.render(user, f"respond.{proposer_id}")
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def respond_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
+    user_id = query.from_user.id
+    _, proposer_id, pet_id = query.data.split("_")
+    proposer_id = int(proposer_id)
+    pet_id = int(pet_id)
+
+    # Обмен (атомарно, в одной транзакции)
+    try:
+        await trade_engine.settle(proposer_id, user_id, pet_id)
+    except TradeError as e:
+        await query.edit_message_text(str(e))
+        return
+
+    # Подтверждения
+    await query.edit_message_text("🎉 Обмен успешно завершён! Питомцы поменялись.")
+    await context.bot.send_message(chat_id=proposer_id, text="🎉 Пользователь согласился! Питомцы обменяны.")
+
+MARKET_PAGE_SIZE = 10
+MARKET_MAX_PRICE = 10 ** 9
+
+def parse_market_filter(args):
+    """(type, rarity, min level) from /market arguments, None if one of them is neither."""
+    pet_type = rarity = None
+    min_level = 1
+    for arg in args:
+        if arg.isdigit():
+            min_level = int(arg)
+        elif arg.capitalize() in RARITIES:
+            rarity = arg.capitalize()
+        elif arg.capitalize() in PET_TYPES:
+            pet_type = arg.capitalize()
+        else:
+            return None
+    return pet_type, rarity, min_level
+
+def render_market_page(pet_type, rarity, min_level, page=0):
+    """A page of the cheapest listings; callback data carries type and rarity indexes ("-" for any)."""
+    listings, has_more = market.book.page(pet_type, rarity, min_level, page * MARKET_PAGE_SIZE, MARKET_PAGE_SIZE)
+    title = " ".join(filter(None, [rarity, pet_type])) or "все"
+    if min_level > 1:
+        title += f", от {min_level} ур."
+    if not listings and page == 0:
+        return f"🏪 Лотов ({title}) нет. Выставить своего питомца: /sell <ID> <цена>", None
+
+    lines = [
+        f"{i}. {listing.rarity} {listing.type}, ур. {listing.level} — {listing.price} монет (ID: {listing.pet_id})"
+        for i, listing in enumerate(listings, page * MARKET_PAGE_SIZE + 1)
+    ]
+    keyboard = [
+        [InlineKeyboardButton(f"🛒 {listing.pet_id} за {listing.price}",
+                              callback_data=f"market_buy_{listing.pet_id}_{listing.price}")
+         for listing in listings[row:row + 2]]
+        for row in range(0, len(listings), 2)
+    ]
+    filt = (f"{PET_TYPES.index(pet_type) if pet_type else '-'}_{RARITIES.index(rarity) if rarity else '-'}_"
+            f"{min_level}")
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"market_page_{filt}_{page - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"market_page_{filt}_{page + 1}"))
+    if nav:
+        keyboard.append(nav)
+    return f"🏪 Рынок ({title}), сначала дешёвые:\n\n" + "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def market_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the cheapest listings: /market [rarity] [type] [min level]"""
+    market_filter = parse_market_filter(context.args or [])
+    if market_filter is None:
+        await update.message.reply_text(
+            f"Напиши: /market [редкость] [вид] [мин. уровень], например /market {RARITIES[2]} 5"
+        )
+        return
+    text, markup = render_market_page(*market_filter)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def sell_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List a pet for sale: /sell <pet_id> <price>"""
+    try:
+        pet_id, price = (int(arg) for arg in context.args)
+    except (TypeError, ValueError):
+        await update.message.reply_text("Напиши: /sell <ID питомца> <цена>")
+        return
+    if not 1 <= price <= MARKET_MAX_PRICE:
+        await update.message.reply_text(f"Цена должна быть от 1 до {MARKET_MAX_PRICE} монет.")
+        return
+    user_id = update.effective_user.id
+
+    try:
+        listing = await market.list_pet(user_id, pet_id, price)
+    except MarketError as e:
+        await update.message.reply_text(str(e))
+        return
     await update.message.reply_text(
-        f"Выбери, какого питомца ты отдашь в обмен:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        f"🏪 {listing.rarity} {listing.type} (ID: {pet_id}) выставлен за {price} монет.\n"
+        f"Пока он на рынке, он не приносит доход. Снять: /unlist {pet_id}"
     )
 
-async def respond_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def buy_listing(context, user_id, pet_id, price=None):
+    """Buy a listing and tell both sides; returns the text for the buyer."""
+    try:
+        sale = await market.buy(user_id, pet_id, price)
+    except MarketError as e:
+        return str(e)
+    try:
+        await context.bot.send_message(
+            chat_id=sale.seller_id,
+            text=f"💰 Твой {sale.pet['name']} (ID: {pet_id}) продан за {sale.price} монет.",
+        )
+    except Forbidden:
+        pass
+    return (f"🎉 {sale.pet['name']} ({sale.pet['rarity']}) теперь твой за {sale.price} монет!\n"
+            f"💲 Теперь твой баланс {sale.coins} монет.")
+
+async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Buy a listed pet: /buy <pet_id>"""
+    try:
+        pet_id = int(context.args[0])
+    except (IndexError, TypeError, ValueError):
+        await update.message.reply_text("Напиши: /buy <ID питомца>. Лоты: /market")
+        return
+    await update.message.reply_text(await buy_listing(context, update.effective_user.id, pet_id))
+
+async def market_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Flip a market page or buy from it"""
     query = update.callback_query
     await query.answer()
 
-    user_id = str(query.from_user.id)
-    _, proposer_id, pet_index = query.data.split("_")
-    pet_index = int(pet_index)
+    parts = query.data.split("_")
+    try:
+        if parts[1] == "buy":
+            pet_id, price = int(parts[2]), int(parts[3])
+        else:
+            pet_type = None if parts[2] == "-" else PET_TYPES[int(parts[2])]
+            rarity = None if parts[3] == "-" else RARITIES[int(parts[3])]
+            min_level, page = int(parts[4]), int(parts[5])
+    except (IndexError, ValueError):
+        return
 
-    if proposer_id not in active_trades:
-        await query.edit_message_text("Предложение устарело.")
+    if parts[1] == "buy":
+        # The price is the one the buyer saw, a relisted pet must not cost more
+        await query.edit_message_text(await buy_listing(context, query.from_user.id, pet_id, price))
         return
+    text, markup = render_market_page(pet_type, rarity, min_level, page)
+    await query.edit_message_text(text, reply_markup=markup)
 
-    # Данные обеих сторон
-    proposer_data = get_user(proposer_id)
-    responder_data = get_user(user_id)
-    trade = active_trades[proposer_id]
+async def unlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Take a pet off the market: /unlist <pet_id>; without an ID, show own listings"""
+    user_id = update.effective_user.id
+    if not context.args:
+        listings = await market.seller_listings(user_id)
+        if not listings:
+            await update.message.reply_text("🏪 У тебя нет лотов. Выставить питомца: /sell <ID> <цена>")
+            return
+        lines = [f"{listing.rarity} {listing.type}, ур. {listing.level} — {listing.price} монет (ID: {listing.pet_id})"
+                 for listing in listings]
+        await update.message.reply_text("🏪 Твои лоты:\n\n" + "\n".join(lines) + "\n\nСнять: /unlist <ID>")
+        return
 
-    # Проверки
-    if trade["partner"] != user_id:
-        await query.edit_message_text("Это не твой трейд.")
+    try:
+        pet_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Напиши: /unlist <ID питомца>")
+        return
+    try:
+        pet = await market.unlist(user_id, pet_id)
+    except MarketError as e:
+        await update.message.reply_text(str(e))
         return
+    await update.message.reply_text(f"↩️ {pet['name']} снят с продажи и вернулся к тебе.")
+
+BATTLE_LOG_LINES = 12  # hits shown in the battle report
+
+def battle_report(teams, names, result, log):
+    lines = []
+    for hit in log[:BATTLE_LOG_LINES]:
+        attacker = teams[hit.side][hit.attacker]["name"]
+        target = teams[1 - hit.side][hit.target]["name"]
+        lines.append(f"{hit.round}. {attacker} ({names[hit.side]}) → {target}: "
+                     f"-{hit.damage}{' 💥' if hit.critical else ''}")
+    if len(log) > BATTLE_LOG_LINES:
+        lines.append(f"… и ещё {len(log) - BATTLE_LOG_LINES} ударов")
+    outcome = "🤝 Ничья!" if result.winner is None else f"🏆 Победил {names[result.winner]}!"
+    return f"⚔️ Бой {names[0]} против {names[1]}\n\n" + "\n".join(lines) + \
+        f"\n\n{outcome} Раундов: {result.rounds}."
+
+async def battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Challenge another player: /battle <user_id> [pet IDs]"""
+    usage = f"Напиши: /battle <user_id> [ID питомцев, до {TEAM_SIZE}]"
+    try:
+        opponent_id = int(context.args[0])
+        pet_ids = list(dict.fromkeys(int(arg) for arg in context.args[1:]))
+    except (IndexError, ValueError):
+        await update.message.reply_text(usage)
+        return
+    user_id = update.effective_user.id
 
-    # Обмен
-    proposer_pet = proposer_data["pets"].pop(trade["offer"])
-    responder_pet = responder_data["pets"].pop(pet_index)
+    if user_id == opponent_id:
+        await update.message.reply_text("Ты не можешь сражаться сам с собой.")
+        return
+    if len(pet_ids) > TEAM_SIZE:
+        await update.message.reply_text(usage)
+        return
 
-    proposer_data["pets"].append(responder_pet)
-    responder_data["pets"].append(proposer_pet)
+    if not await user_repository.exists(opponent_id):
+        await update.message.reply_text("Такой пользователь не найден.")
+        return
 
-    save_user(proposer_data)
-    save_user(responder_data)
-    del active_trades[proposer_id]
+    if pet_ids:
+        team = (await get_pets(user_id, pet_ids))["pets"]
+        if len(team) != len(pet_ids):
+            await update.message.reply_text("Неверное ID питомца.")
+            return
+    else:
+        team = strongest((await get_user(user_id)).get("pets", []))
+        if not team:
+            await update.message.reply_text("У тебя нет питомцев для боя.")
+            return
 
-    # Подтверждения
-    await query.edit_message_text("🎉 Обмен успешно завершён! Питомцы поменялись.")
-    await context.bot.send_message(chat_id=int(proposer_id), text="🎉 Пользователь согласился! Питомцы обменяны.")
+    await battle_challenges.create(user_id, opponent_id, [pet["id"] for pet in team])
+    await update.message.reply_text("⚔️ Вызов отправлен. Ожидаем ответа второго игрока.")
 
-async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    await update.message.reply_text(f"Твій Telegram ID: `{user_id}`", parse_mode=ParseMode.MARKDOWN)
+    keyboard = [[
+        InlineKeyboardButton("⚔️ Принять", callback_data=f"battle_accept_{user_id}"),
+        InlineKeyboardButton("🏳 Отказаться", callback_data=f"battle_decline_{user_id}"),
+    ]]
+    await context.bot.send_message(
+        chat_id=opponent_id,
+        text=f"⚔️ Игрок {user_id} вызывает тебя на бой: " + ", ".join(pet["name"] for pet in team) +
+             ".\nТы будешь сражаться своими сильнейшими питомцами.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
 
-async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
+async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
-    user_states.pop(user_id, None)
-    active_trades.pop(user_id, None)
+    user_id = query.from_user.id
+    _, action, challenger_id = query.data.split("_")
+    challenger_id = int(challenger_id)
 
-    if hasattr(context.application, "pending_merges"):
-        context.application.pending_merges.pop(user_id, None)
+    # Taking the challenge out first means it can be answered only once
+    challenge = await battle_challenges.take(challenger_id, user_id)
+    if challenge is None:
+        await query.edit_message_text("Этот вызов больше не действует.")
+        return
 
-    await update.message.reply_text("⚠ Отмена всех инструкций.")
+    if action == "decline":
+        await query.edit_message_text("🏳 Ты отказался от боя.")
+        await context.bot.send_message(chat_id=challenger_id, text=f"🏳 Игрок {user_id} отказался от боя.")
+        return
 
-async def fallback_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    state = user_states.get(user_id)
+    challenger = await get_pets(challenger_id, challenge["pet_ids"])
+    if len(challenger["pets"]) != len(challenge["pet_ids"]):
+        await query.edit_message_text("Питомцев из этого вызова уже нет, бой отменён.")
+        return
+    user = await get_user(user_id)
+    team = strongest(user.get("pets", []))
+    if not team:
+        await query.edit_message_text("У тебя нет питомцев для боя.")
+        return
 
-    if not state:
+    # Seeded by the challenge, so the fight can be replayed
+    rng = rng_for("battle", challenger_id, user_id, challenge["created_at"].timestamp())
+    report = await fight((challenger_id, user_id), (challenger["pets"], team), rng)
+    await query.edit_message_text(report)
+    await context.bot.send_message(chat_id=challenger_id, text=report)
+
+async def fight(user_ids, teams, rng):
+    """Fight two teams, count the win and the loss, and return the report.
+
+    Either player may be owned by another shard (the opponent, or with
+    /findbattle both), so the counters go straight to the database and every
+    cached copy of the players is invalidated.
+    """
+    log = []
+    result = battle(teams[0], teams[1], rng, log)
+    if result.winner is not None:
+        for i, user_id in enumerate(user_ids):
+            field = "battles_won" if i == result.winner else "battles_lost"
+            await users_collection.update_one({"user_id": user_id}, {"$inc": {field: 1}})
+            user_cache.invalidate(user_id)
+    return battle_report(teams, tuple(map(str, user_ids)), result, log)
+
+async def find_battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Queue for a battle against a player of similar strength: /findbattle"""
+    user_id = update.effective_user.id
+    # The user's own worker: its cache has the pets with the changes not yet written
+    user = await get_user(user_id)
+    team = strongest(user["pets"])
+    if not team:
+        await update.message.reply_text("У тебя нет питомцев для боя.")
         return
 
-    if state == "merge":
-        await update.message.reply_text("❗ Введите номера двух питомцев, например: /merge 1 2 или напишите /cancel")
-    elif state == "train":
-        await update.message.reply_text("❗ Введите номер питомца и аргумент прокачки: /train 1 attack или напишите /cancel")
+    if not await join_match(context.bot, user_id, team):
+        await update.message.reply_text(
+            f"🔎 Ищем соперника твоего уровня (до {int(MATCH_TIMEOUT)} с). Отменить: /cancel")
+
+async def join_match(bot, user_id, team):
+    """Fight a waiting player of similar strength, or queue with ``team``; False if queued.
+
+    On workers other than MATCH_SHARD match_queue.join only sends the team
+    to MATCH_SHARD, which calls this again to pair it.
+    """
+    match = match_queue.join(user_id, team_rating(team), team)
+    while match is not None:
+        opponent_id, queued_team = match
+        opponent = await get_pets(opponent_id, [pet["id"] for pet in queued_team])
+        if len(opponent["pets"]) == len(queued_team):
+            break
+        # The opponent's team changed while they waited, they drop out
+        await bot.send_message(chat_id=opponent_id, text="Твоя команда изменилась, поиск боя отменён.")
+        match = match_queue.join(user_id, team_rating(team), team)
+    if match is None:
+        return False
+
+    rng = rng_for("findbattle", opponent_id, user_id, time.time())
+    report = await fight((opponent_id, user_id), (opponent["pets"], team), rng)
+    await bot.send_message(chat_id=user_id, text=report)
+    await bot.send_message(chat_id=opponent_id, text=report)
+    return True
+
+async def match_timed_out(bot, user_id):
+    await bot.send_message(chat_id=user_id, text="😴 Соперник не нашёлся. Попробуй ещё раз: /findbattle")
+
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the top players from the leaderboard snapshot"""
+    board = context.args[0].lower() if context.args else "coins"
+    if board not in BOARDS:
+        await update.message.reply_text("Напиши: /leaderboard coins|power|rarity")
+        return
+
+    titles = {"coins": "по монетам", "power": "по силе питомцев", "rarity": "по редкости питомцев"}
+
+    def score_text(score):
+        if board == "rarity":
+            return RARITIES[int(score)] if score >= 0 else "нет"
+        return str(int(score))
+
+    top = leaderboard.top(board)
+    if not top:
+        await update.message.reply_text("🏆 Таблица лидеров ещё формируется, загляни чуть позже.")
+        return
+
+    lines = [f"{i}. {user_id} — {score_text(score)}" for i, (user_id, score) in enumerate(top, 1)]
+    user = await get_user(update.effective_user.id, fields=(BOARDS[board],))
+    my_score = user[BOARDS[board]]
+    await update.message.reply_text(
+        f"🏆 Лидеры {titles[board]}:\n\n" + "\n".join(lines) +
+        f"\n\nТы на {leaderboard.rank(board, my_score)} месте ({score_text(my_score)})."
+    )
+
+REMINDER_TEXTS = {
+    "income": "💰 Твои питомцы накопили доход за сутки и больше не копят. Забери его: /collect",
+    "daily": "🎁 Ежедневная награда снова доступна: /daily",
+}
+
+async def send_reminder(bot, user_id, kind):
+    try:
+        await bot.send_message(chat_id=user_id, text=REMINDER_TEXTS[kind])
+    except Forbidden:
+        # The user blocked the bot, stop reminding them
+        reminders.cancel(user_id)
+        user = await get_user(user_id, fields=("reminders",))
+        await update_user(user_id, UserUpdate().set("reminders", False), view=user)
+
+async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn reminders on or off: /remind [on|off]"""
+    user_id = update.effective_user.id
+    user = await get_user(user_id, fields=("reminders", "last_daily", "income"))
+
+    if context.args and context.args[0].lower() in ("on", "off"):
+        enabled = context.args[0].lower() == "on"
     else:
-        await update.message.reply_text("🤐 Я не понял. Воспользуйся командами или напиши /help.")
+        enabled = not user.get("reminders")
+    await update_user(user_id, UserUpdate().set("reminders", enabled), view=user)
+
+    if not enabled:
+        reminders.cancel(user_id)
+        await update.message.reply_text("🔕 Напоминания выключены.")
+        return
+
+    reminders.schedule(user_id, "daily", (user.get("last_daily") or 0) + 20 * 3600)
+    if income_full_at(user["income"]):
+        reminders.schedule(user_id, "income", income_full_at(user["income"]))
+    await update.message.reply_text("🔔 Напоминания включены: я напишу, когда доход перестанет копиться "
+                                    "и когда снова будет доступна ежедневная награда. Выключить: /remind off")
+
+async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    await update.message.reply_text(f"Твій Telegram ID: `{user_id}`", parse_mode=ParseMode.MARKDOWN)
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+
+    await conversations.end(user_id)
+    await trade_engine.cancel(user_id)
+    await battle_challenges.cancel(user_id)
+    match_queue.leave(user_id)
+
+    await update.message.reply_text("⚠ Отмена всех инструкций.")
+
+# Text messages of users in a state, see conversations.on in build_application
+async def merge_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("❗ Введите ID двух питомцев, например: /merge 100001 100002 или напишите /cancel")
+
+async def train_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("❗ Введите ID питомца и аргумент прокачки: /train 100001 attack или напишите /cancel")
+
+async def unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("🤐 Я не понял. Воспользуйся командами или напиши /help.")
+
+async def post_init(application):
+    client.open()
+    await user_repository.ensure_indexes()
+    await trade_engine.ensure_indexes()
+    await battle_challenges.ensure_indexes()
+    await coin_ledger.ensure_indexes()
+    await leaderboard.ensure_indexes()
+    await reminders.ensure_indexes()
+    await conversations.ensure_indexes()
+    await market.ensure_indexes()
+    await reminders.load()
+    await market.load()
+    reminders.send = lambda user_id, kind: send_reminder(application.bot, user_id, kind)
+    match_queue.on_timeout = lambda user_id: match_timed_out(application.bot, user_id)
+    user_cache.start()
+    coin_ledger.start()
+    leaderboard.start()
+    reminders.start()
+    match_queue.start()
+    conversations.start()
+    market.start()
+
+async def post_shutdown(application):
+    await market.stop()
+    await conversations.stop()
+    await match_queue.stop()
+    await reminders.stop()
+    await leaderboard.stop()
+    await coin_ledger.stop()
+    await user_cache.stop()
+    client.close()
+
+def build_application(shards=1):
+    """Build the application; ``shards`` processes share Telegram's sending limits."""
+    builder = ApplicationBuilder().token(TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if BOT_MODE == "webhook":
+        # Updates arrive through KeepAliveApp, there is nothing to poll
+        builder = builder.updater(None)
+    # Outgoing requests wait for their turn instead of running into 429s
+    builder = builder.rate_limiter(AIORateLimiter(overall_max_rate=SEND_RATE / shards, max_retries=3))
+    application = builder.build()
+
+    # Anti-flood runs before every other handler and stops over-budget updates
+    limiter = RateLimiter(
+        user_budget=(USER_RATE, USER_BURST),
+        budgets=COMMAND_BUDGETS,
+        global_budget=(GLOBAL_RATE, GLOBAL_RATE * 2) if GLOBAL_RATE else None,
+    )
+    application.add_handler(TypeHandler(Update, throttle(limiter, CallbackCoalescer())), group=-1)
 
-# Main launcher
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TOKEN).build()
-    application.pending_merges = {}
-    keep_alive()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("balance", balance))
@@ -739,15 +1267,178 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler("train", train_pet))
     application.add_handler(CommandHandler("trade", trade_command))
     application.add_handler(CommandHandler("respond", respond_command))
+    application.add_handler(CommandHandler("battle", battle_command))
+    application.add_handler(CommandHandler("findbattle", find_battle_command))
     application.add_handler(CommandHandler("myid", myid_command))
     application.add_handler(CommandHandler("cancel", cancel_command))
     application.add_handler(CommandHandler("profile", profile))
-    
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), fallback_message))
+    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    application.add_handler(CommandHandler("remind", remind_command))
+    application.add_handler(CommandHandler("market", market_command))
+    application.add_handler(CommandHandler("sell", sell_command))
+    application.add_handler(CommandHandler("buy", buy_command))
+    application.add_handler(CommandHandler("unlist", unlist_command))
+
+    # One handler for all text, the sender's state picks what happens
+    conversations.on("merge", merge_hint)
+    conversations.on("train", train_hint)
+    conversations.default = unknown_message
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, conversations.dispatch))
     application.add_handler(CallbackQueryHandler(offer_callback, pattern=r"^offer_"))
     application.add_handler(CallbackQueryHandler(respond_callback, pattern=r"^respond_"))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, merge_pets))
     application.add_handler(CallbackQueryHandler(hatch_callback, pattern="^hatch_"))
     application.add_handler(CallbackQueryHandler(buy_egg_callback, pattern="^buy_"))
+    application.add_handler(CallbackQueryHandler(page_callback, pattern="^page_"))
+    application.add_handler(CallbackQueryHandler(battle_callback, pattern="^battle_"))
+    application.add_handler(CallbackQueryHandler(market_callback, pattern="^market_"))
+    instrument_handlers(application)
+    return application
+
+def register_gauges(application, dispatcher):
+    """Gauges of the process that handles updates."""
+    REGISTRY.gauge("bot_dispatcher_users", "Users with updates queued or running", dispatcher.queue_depth)
+    REGISTRY.gauge("bot_update_queue_size", "Updates waiting in the application queue",
+                   application.update_queue.qsize)
+    REGISTRY.gauge("bot_user_cache_size", "Users in the cache", lambda: len(user_cache.entries))
+    REGISTRY.gauge("bot_user_cache_dirty", "Users with writes waiting for a flush", lambda: len(user_cache.pending))
+    REGISTRY.gauge("bot_user_cache_hits_total", "User reads served from the cache",
+                   lambda: user_cache.hits, monotonic=True)
+    REGISTRY.gauge("bot_user_cache_misses_total", "User reads that went to the database",
+                   lambda: user_cache.misses, monotonic=True)
+    REGISTRY.gauge("bot_page_cache_hits_total", "Collection pages served from the cache",
+                   lambda: collection_pages.hits, monotonic=True)
+    REGISTRY.gauge("bot_page_cache_misses_total", "Collection pages rendered",
+                   lambda: collection_pages.misses, monotonic=True)
+    REGISTRY.gauge("bot_coin_events_pending", "Coin events waiting to be written",
+                   lambda: len(coin_ledger.pending))
+    REGISTRY.gauge("bot_matchmaking_waiting", "Players waiting for an opponent", lambda: len(match_queue))
+    REGISTRY.gauge("bot_reminders_scheduled", "Reminders waiting to be sent", lambda: len(reminders.due))
+    REGISTRY.gauge("bot_market_listings", "Listings in this process's order book", lambda: len(market.book))
+    if isinstance(state_store, MemoryStateStore):
+        REGISTRY.gauge("bot_conversation_states", "Users in a conversation state", lambda: len(state_store))
+
+async def report_metrics(index, control):
+    """Shard workers: send our samples to the main process, which serves /metrics."""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        control.put({"metrics": index, "families": REGISTRY.collect()})
+
+async def main():
+    """Run the bot and its HTTP server (health checks, and the webhook in webhook mode) on one event loop.
+
+    With SHARDS > 1 this process only receives updates and routes them to
+    worker processes, otherwise it handles them itself.
+    """
+    if not RNG_SECRET:
+        raise SystemExit("Set RNG_SECRET to a long random string, e.g. the output of: openssl rand -hex 32")
+    if SHARDS > 1 and STORAGE_BACKEND == "sqlite":
+        raise SystemExit("STORAGE_BACKEND=sqlite serves a single process, set SHARDS=1")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise SystemExit("Set WEBHOOK_SECRET to a long random string, e.g. the output of: openssl rand -hex 32")
+    application = build_application()
+    server = KeepAliveApp(
+        application,
+        webhook_path=WEBHOOK_PATH if BOT_MODE == "webhook" else None,
+        secret_token=WEBHOOK_SECRET,
+        metrics=lambda: render(REGISTRY.collect()),
+    )
 
-    application.run_polling()
+    async with application:
+        if SHARDS > 1:
+            router = ShardRouter(SHARDS, worker_process)
+            router.start()
+            handle = router.route
+            REGISTRY.gauge("bot_router_queue_size", "Updates waiting in shard inboxes", router.queue_depth)
+            server.metrics = lambda: render(combine(REGISTRY.collect(), *(
+                with_label(families, "shard", str(index)) for index, families in sorted(router.worker_metrics.items())
+            )))
+        else:
+            await post_init(application)
+            dispatcher = UpdateDispatcher(timed_updates(application.process_update), CONCURRENT_UPDATES)
+            register_gauges(application, dispatcher)
+            handle = lambda update: dispatcher.submit(update_user_id(update), update)
+        fetcher = asyncio.create_task(fetch_updates(application.update_queue, handle))
+
+        if BOT_MODE == "webhook":
+            await application.bot.set_webhook(
+                f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await application.updater.start_polling()
+        server.ready = True
+
+        try:
+            await serve(server, port=PORT)
+        finally:
+            server.ready = False
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            fetcher.cancel()
+            if SHARDS > 1:
+                await asyncio.get_running_loop().run_in_executor(None, router.stop)
+            else:
+                await dispatcher.drain()
+                await post_shutdown(application)
+
+async def run_worker(index, shards, inbox, control):
+    application = build_application(shards)
+    dispatcher = UpdateDispatcher(timed_updates(application.process_update), CONCURRENT_UPDATES)
+    register_gauges(application, dispatcher)
+
+    # Users owned by other workers may sit in their caches, let them know
+    user_cache.on_invalidate = lambda user_id: (
+        shard_for(user_id, shards) != index and control.put({"invalidate": user_id}))
+    reminders.shard, reminders.shards = index, shards
+    if index != MATCH_SHARD:
+        # /cancel lands on the user's own worker, the queue is on MATCH_SHARD
+        match_queue.leave = lambda user_id: control.put({"shard": MATCH_SHARD, "leave_match": user_id})
+        # /findbattle too: the team goes to the queue on MATCH_SHARD, the player counts as queued
+        match_queue.join = lambda user_id, rating, team: control.put(
+            {"shard": MATCH_SHARD, "join_match": user_id, "team": team})
+    matches = set()  # join_match tasks for teams sent by other workers
+    # A buyer's worker settles the sale, the seller's worker records the seller's coin event
+    market.record_seller = lambda *event: (
+        coin_ledger.record(*event) if shard_for(event[0], shards) == index
+        else control.put({"shard": shard_for(event[0], shards), "coin_event": event}))
+
+    def on_update(data):
+        update = Update.de_json(data, application.bot)
+        dispatcher.submit(update_user_id(update), update)
+
+    def on_message(message):
+        if "leave_match" in message:
+            match_queue.leave(message["leave_match"])
+        elif "join_match" in message:
+            task = asyncio.create_task(join_match(application.bot, message["join_match"], message["team"]))
+            matches.add(task)
+            task.add_done_callback(match_done)
+        elif "coin_event" in message:
+            coin_ledger.record(*message["coin_event"])
+
+    def match_done(task):
+        matches.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger(__name__).error("Failed to pair a /findbattle team", exc_info=task.exception())
+
+    async with application:
+        await post_init(application)
+        reporter = asyncio.create_task(report_metrics(index, control))
+        await worker_loop(inbox, on_update, lambda user_id: user_cache.invalidate(user_id, notify=False),
+                          on_message)
+        reporter.cancel()
+        await dispatcher.drain()
+        if matches:
+            await asyncio.wait(matches)
+        await post_shutdown(application)
+
+def worker_process(index, shards, inbox, control):
+    # Ctrl+C reaches the whole process group; workers stop when the router tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger(__name__).info("Worker %d/%d started", index + 1, shards)
+    asyncio.run(run_worker(index, shards, inbox, control))
+
+# Main launcher
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+# economy.py - доход с питомцев без обхода всей коллекции
+#
+# Every user keeps an "income" summary instead of per-pet timestamps:
+#   rate         - coins/hour of pets that already collected at least once
+#   pending_rate - coins/hour of pets that were never collected from
+#   since        - when "rate" pets were last paid out (shared checkpoint)
+#   joined_at    - time of the last collect; pets added later are still pending
+#
+# Pending pets pay their first hour on the next collect regardless of time
+# (like the old last_collected=None rule) and then join the shared checkpoint.
+# A summary built from per-pet timestamps keeps paying by them once more: the
+# first collect after it goes over the pets (collect_legacy_income).
+
+MAX_INCOME_HOURS = 24
+
+
+def new_income():
+    return {"rate": 0, "pending_rate": 0, "since": None, "joined_at": 0}
+
+
+def legacy_income(user):
+    """Build the income summary from per-pet last_collected timestamps (one-off, O(pets))."""
+    income = new_income()
+    checkpoints = []
+    for pet in user.get("pets", []):
+        if pet.get("last_collected"):
+            income["rate"] += pet["coin_rate"]
+            checkpoints.append(pet["last_collected"])
+        else:
+            income["pending_rate"] += pet["coin_rate"]
+    if checkpoints:
+        # Only for income_full_at: the first collect pays each pet from its own checkpoint
+        income["since"] = max(checkpoints)
+    return income
+
+
+def is_legacy_income(income):
+    """Whether the summary was built by legacy_income and nothing was collected since."""
+    return bool(income["since"]) and not income["joined_at"]
+
+
+def is_pending(income, pet):
+    """Whether the pet has not been collected from since it joined the collection."""
+    if "added_at" in pet:
+        return pet["added_at"] > income["joined_at"]
+    # Pets from before the income summary: never collected and no collect since
+    return not pet.get("last_collected") and not income["joined_at"]
+
+
+def added_pets_delta(pets):
+    """$inc deltas for pets entering a collection."""
+    return {"income.pending_rate": sum(pet["coin_rate"] for pet in pets)}
+
+
+def removed_pets_delta(income, pets):
+    """$inc deltas for pets leaving a collection."""
+    delta = {"income.rate": 0, "income.pending_rate": 0}
+    for pet in pets:
+        field = "income.pending_rate" if is_pending(income, pet) else "income.rate"
+        delta[field] -= pet["coin_rate"]
+    return delta
+
+
+def merge_deltas(*deltas):
+    merged = {}
+    for delta in deltas:
+        for field, amount in delta.items():
+            merged[field] = merged.get(field, 0) + amount
+    return {field: amount for field, amount in merged.items() if amount}
+
+
+def collect_income(income, now):
+    """Coins earned at ``now`` and the new income summary after paying them out.
+
+    Returns (coins, income); coins is 0 when there is nothing to collect yet.
+    """
+    since = income["since"]
+    hours_passed = min(MAX_INCOME_HOURS, (now - since) / 3600) if since else 0
+
+    coins = income["pending_rate"]
+    if hours_passed >= 1:
+        coins += int(income["rate"] * hours_passed)
+    if coins <= 0:
+        return 0, income
+
+    return coins, {
+        "rate": income["rate"] + income["pending_rate"],
+        "pending_rate": 0,
+        "since": now if hours_passed >= 1 or since is None else since,
+        "joined_at": now,
+    }
+
+
+def collect_legacy_income(income, pets, now):
+    """collect_income for a summary that is_legacy_income, given the user's pets.
+
+    Pets collected from before the summary pay by the old per-pet rule, each
+    from its own last_collected; then all of them share the checkpoint ``now``.
+    """
+    coins = income["pending_rate"]
+    for pet in pets:
+        if "added_at" not in pet and pet.get("last_collected"):
+            hours_passed = min(MAX_INCOME_HOURS, (now - pet["last_collected"]) / 3600)
+            if hours_passed >= 1:
+                coins += int(pet["coin_rate"] * hours_passed)
+    if coins <= 0:
+        return 0, income
+
+    return coins, {
+        "rate": income["rate"] + income["pending_rate"],
+        "pending_rate": 0,
+        "since": now,
+        "joined_at": now,
+    }
+
+
+def income_full_at(income):
+    """When income stops accruing (MAX_INCOME_HOURS after the checkpoint), None if nothing accrues."""
+    if not income["since"] or not income["rate"]:
+        return None
+    return income["since"] + MAX_INCOME_HOURS * 3600
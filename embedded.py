@@ -0,0 +1,634 @@
+# embedded.py - встроенное хранилище на SQLite вместо MongoDB
+#
+# A local, single-process stand-in for the motor client: the same async
+# collection API the bot uses, with documents kept in one SQLite file, so a
+# small deployment (or a test run) needs no database server. Filters and
+# updates are evaluated with storage.matches and storage.apply_update, like
+# the user cache does. Layout, per collection:
+#   c_<name> - one row per document (for users: per user), JSON
+#   i_<name> - (field, value) -> document, for fields that have an index
+#   a_<name> - elements of a split-out array, e.g. a user's pets, one row each
+# Writes of concurrent callers are committed together (group commit) in WAL
+# mode, so a write costs a page append rather than an fsync.
+
+import asyncio
+import copy
+import json
+import sqlite3
+from datetime import datetime
+
+from pymongo import DeleteOne
+from pymongo.errors import BulkWriteError
+
+from storage import apply_update, get_path, matches, project, set_path
+
+ALL = object()  # load every element of a split-out array
+_CHUNK = 500  # values per IN (...) list
+
+
+class _Result:
+
+    def __init__(self, matched_count=0, modified_count=0, deleted_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+        self.upserted_id = upserted_id
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _hook(value):
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+# Built once: json.dumps and json.loads with options make a new encoder or decoder per call
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+_decoder = json.JSONDecoder(object_hook=_hook)
+_dumps = _encoder.encode
+_loads = _decoder.decode
+
+
+def _key(value):
+    """Stored form of an _id or an indexed value; equal values get equal keys."""
+    return json.dumps(value, default=_default, sort_keys=True)
+
+
+def _mentions(conditions, field):
+    """Whether a filter looks at ``field`` or anything inside it."""
+    for path, condition in conditions.items():
+        if path == "$or":
+            if any(_mentions(branch, field) for branch in condition):
+                return True
+        elif path == field or path.startswith(field + "."):
+            return True
+    return False
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), _CHUNK):
+        yield values[i:i + _CHUNK]
+
+
+class SQLiteCursor:
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.keys = []
+
+    def sort(self, keys):
+        self.keys = keys
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _docs(self):
+        mode = self.collection._array_mode(self.query, self.projection)
+        docs = [doc for _, doc in self.collection._find(self.query, mode)]
+        for field, direction in reversed(self.keys):
+            docs.sort(key=lambda doc: get_path(doc, field)[0], reverse=direction < 0)
+        return docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs():
+            yield project(doc, self.projection, clone=False)
+
+    async def to_list(self, length=None):
+        return [project(doc, self.projection, clone=False) for doc in self._docs()[:length]]
+
+
+class SQLiteCollection:
+    """One collection; ``array`` = (field, id field) keeps that array's elements in their own rows."""
+
+    def __init__(self, client, name, array=None):
+        self.client = client
+        self.name = name
+        self.db = client.db
+        self.array, self.element_id = array or (None, None)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS "c_{name}" (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, '
+                        f'doc TEXT NOT NULL)')
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS "i_{name}" (field TEXT NOT NULL, value TEXT NOT NULL, '
+                        f'id TEXT NOT NULL, PRIMARY KEY (field, value, id)) WITHOUT ROWID')
+        if self.array:
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS "a_{name}" (id TEXT NOT NULL, pos INTEGER NOT NULL, '
+                            f'element TEXT, data TEXT NOT NULL, PRIMARY KEY (id, pos)) WITHOUT ROWID')
+            self.db.execute(f'CREATE INDEX IF NOT EXISTS "a_{name}_element" ON "a_{name}" (element)')
+        self.indexed = {row[0] for row in self.db.execute(
+            "SELECT field FROM indexes WHERE collection = ?", (name,))}
+        self.next_rowid = (self.db.execute(f'SELECT MAX(rowid) FROM "c_{name}"').fetchone()[0] or 0) + 1
+
+    # Reading
+
+    def _plan(self, query):
+        """Keys of the documents that can match, from an index; None means a full scan."""
+        if "$or" in query:
+            plans = [self._plan(branch) for branch in query["$or"]]
+            if all(plan is not None for plan in plans):
+                return list(dict.fromkeys(key for plan in plans for key in plan))
+        value = query.get("_id")
+        if value is not None and not isinstance(value, dict):
+            return [_key(value)]
+        for field in self.indexed:
+            value = query.get(field)
+            if value is None:
+                continue
+            if isinstance(value, dict):
+                if set(value) != {"$in"}:
+                    continue
+                values = [_key(v) for v in value["$in"]]
+            else:
+                values = [_key(value)]
+            keys = []
+            for chunk in _chunks(values):
+                keys.extend(row[0] for row in self.db.execute(
+                    f'SELECT id FROM "i_{self.name}" WHERE field = ? AND value IN ({",".join("?" * len(chunk))})',
+                    (field, *chunk)))
+            return keys
+        return None
+
+    def _array_mode(self, query, projection=None):
+        """Which elements of the split-out array a read needs: ALL, None, or a list of element IDs."""
+        field = self.array
+        if field is None or _mentions(query, field):
+            return ALL
+        if projection is None:
+            return ALL
+        spec = projection.get(field)
+        if spec is None:
+            return ALL if all(value == 0 for value in projection.values()) else None
+        if spec == 0:
+            return None
+        if isinstance(spec, dict) and "$filter" in spec:
+            name = spec["$filter"].get("as", "this")
+            op, (path, values) = next(iter(spec["$filter"]["cond"].items()))
+            if op == "$in" and path == f"$${name}.{self.element_id}":
+                return list(values)
+        return ALL
+
+    def _write_mode(self, query, update, projection=False, array_filters=None):
+        """Which elements of the split-out array an update (and what it returns) needs: ALL, None or IDs.
+
+        ``projection=False`` means nothing is returned.
+        """
+        field = self.array
+        if field is None:
+            return ALL
+        if projection is not False and self._array_mode(query, projection) is not None:
+            return ALL
+        targets = self._targets(query, update, array_filters)
+        if targets is not None:
+            return targets
+        if _mentions(query, field):
+            return ALL
+        if any(path == field or path.startswith(field + ".") for fields in update.values() for path in fields):
+            return ALL
+        return None
+
+    def _targets(self, query, update, array_filters):
+        """IDs of the only elements an update looks at, None unless it changes elements picked by ID.
+
+        That is when the filter asks for elements by ID alone (e.g. require_pets)
+        and every change to the array goes through array filters on the ID
+        (e.g. inc_pet), so the array keeps its length and the rest is left as is.
+        """
+        field, id_path = self.array, f"{self.array}.{self.element_id}"
+        ids = []
+        for path, condition in query.items():
+            if path == id_path:
+                if isinstance(condition, dict):
+                    if not condition or set(condition) - {"$in", "$all"}:
+                        return None
+                    for values in condition.values():
+                        ids.extend(values)
+                else:
+                    ids.append(condition)
+            elif _mentions({path: condition}, field):
+                return None
+        picked = {}  # {array filter name: element IDs}
+        for array_filter in array_filters or []:
+            if len(array_filter) != 1:
+                return None
+            (path, condition), = array_filter.items()
+            name, _, rest = path.partition(".")
+            if rest != self.element_id or isinstance(condition, dict) and set(condition) != {"$in"}:
+                return None
+            picked[name] = list(condition["$in"]) if isinstance(condition, dict) else [condition]
+        changes = False
+        for fields in update.values():
+            for path in fields:
+                if path == field:
+                    return None
+                if path.startswith(field + "."):
+                    position, _, inner = path[len(field) + 1:].partition(".")
+                    if not (position.startswith("$[") and position[2:-1] in picked) or \
+                            inner.split(".")[0] == self.element_id:
+                        return None
+                    ids.extend(picked[position[2:-1]])
+                    changes = True
+        return list(dict.fromkeys(ids)) if changes else None
+
+    def _load(self, key, text, mode):
+        doc = _loads(text)
+        if self.array is None:
+            return doc
+        if mode is None:
+            doc.pop(self.array, None)
+        elif self.array in doc:
+            if mode is ALL:
+                rows = self.db.execute(f'SELECT data FROM "a_{self.name}" WHERE id = ? ORDER BY pos', (key,))
+            else:
+                elements = [_key(value) for value in mode]
+                rows = self.db.execute(
+                    f'SELECT data FROM "a_{self.name}" WHERE id = ? AND element IN ({",".join("?" * len(elements))}) '
+                    f'ORDER BY pos', (key, *elements)) if elements else []
+            doc[self.array] = [_loads(row[0]) for row in rows]
+        return doc
+
+    def _find(self, query, mode=ALL, limit=None):
+        """Yield (key, document) for matching documents in insertion order."""
+        plan = self._plan(query)
+        if plan is None:
+            rows = self.db.execute(f'SELECT id, doc FROM "c_{self.name}" ORDER BY rowid')
+        else:
+            rows = []
+            for chunk in _chunks(plan):
+                rows.extend(self.db.execute(
+                    f'SELECT rowid, id, doc FROM "c_{self.name}" WHERE id IN ({",".join("?" * len(chunk))})', chunk))
+            rows = [row[1:] for row in sorted(rows)]
+        found = 0
+        for key, text in rows:
+            doc = self._load(key, text, mode)
+            if matches(doc, query):
+                yield key, doc
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def _find_first(self, query, mode=ALL):
+        return next(self._find(query, mode, limit=1), (None, None))
+
+    # Writing
+
+    def _indexed(self, doc, fields=None):
+        """{field: (value, exists)} for the indexed fields of a document."""
+        return {field: get_path(doc, field) for field in (self.indexed if fields is None else fields)}
+
+    def _index_rows(self, key, values):
+        for field, (value, exists) in values.items():
+            if exists and not isinstance(value, (dict, list)):
+                yield field, _key(value), key
+
+    def _insert(self, doc):
+        doc.setdefault("_id", self.next_rowid)
+        key = _key(doc["_id"])
+        base = {field: ([] if field == self.array else value) for field, value in doc.items()}
+        self.db.execute(f'INSERT INTO "c_{self.name}" (rowid, id, doc) VALUES (?, ?, ?)',
+                        (self.next_rowid, key, _dumps(base)))
+        self.next_rowid += 1
+        self.db.executemany(f'INSERT OR IGNORE INTO "i_{self.name}" VALUES (?, ?, ?)',
+                            self._index_rows(key, self._indexed(doc)))
+        if self.array and doc.get(self.array):
+            self._write_elements(key, doc[self.array], 0)
+        return doc
+
+    def _element_key(self, element):
+        return _key(element.get(self.element_id)) if isinstance(element, dict) else None
+
+    def _write_elements(self, key, elements, start):
+        self.db.executemany(f'INSERT OR REPLACE INTO "a_{self.name}" VALUES (?, ?, ?, ?)', [
+            (key, start + i, self._element_key(element), _dumps(element)) for i, element in enumerate(elements)
+        ])
+
+    def _snapshot(self, doc, mode):
+        """State of a loaded document to compare it with after an update: (row, indexed values, elements).
+
+        The row is the serialized document as c_<name> stores it, so an
+        unchanged one is not written and a changed one is not serialized twice.
+        """
+        base = {f: v for f, v in doc.items() if f != self.array}
+        if self.array is not None and (mode is None or self.array in doc):
+            base[self.array] = []  # its elements live in a_<name>
+        if mode is None or self.array not in doc:
+            return _dumps(base), self._indexed(doc), None
+        return _dumps(base), self._indexed(doc), [_dumps(element) for element in doc[self.array]]
+
+    def _save(self, key, old, doc, mode):
+        """Write what changed in ``doc`` since ``old``, a snapshot taken before the update.
+
+        With ``mode`` None the split-out array was not loaded and is left alone;
+        with a list of IDs only those elements were, and they keep their rows.
+        """
+        old_row, old_indexed, before = old
+        row, indexed, after = self._snapshot(doc, mode)
+        if old_row != row:
+            self.db.execute(f'UPDATE "c_{self.name}" SET doc = ? WHERE id = ?', (row, key))
+            changed = [field for field in self.indexed if old_indexed[field] != indexed[field]]
+            if changed:
+                self.db.executemany(f'DELETE FROM "i_{self.name}" WHERE field = ? AND value = ? AND id = ?',
+                                    self._index_rows(key, {field: old_indexed[field] for field in changed}))
+                self.db.executemany(f'INSERT OR IGNORE INTO "i_{self.name}" VALUES (?, ?, ?)',
+                                    self._index_rows(key, {field: indexed[field] for field in changed}))
+        if after is None and before is None:
+            return
+        before, after, elements = before or [], after or [], doc.get(self.array) or []
+        if mode is not ALL:
+            # The loaded elements, in the order _load read them
+            elements_keys = [_key(value) for value in mode]
+            if not elements_keys:
+                return
+            positions = [row[0] for row in self.db.execute(
+                f'SELECT pos FROM "a_{self.name}" WHERE id = ? AND element IN ({",".join("?" * len(elements_keys))}) '
+                f'ORDER BY pos', (key, *elements_keys))]
+            self.db.executemany(f'UPDATE "a_{self.name}" SET data = ? WHERE id = ? AND pos = ?', [
+                (new, key, pos) for pos, old_element, new in zip(positions, before, after) if old_element != new
+            ])
+            return
+        if len(before) == len(after):
+            changed = [pos for pos, (a, b) in enumerate(zip(before, after)) if a != b]
+        else:
+            same = 0
+            while same < min(len(before), len(after)) and before[same] == after[same]:
+                same += 1
+            self.db.execute(f'DELETE FROM "a_{self.name}" WHERE id = ? AND pos >= ?', (key, same))
+            changed = range(same, len(after))
+        self.db.executemany(f'INSERT OR REPLACE INTO "a_{self.name}" VALUES (?, ?, ?, ?)', [
+            (key, pos, self._element_key(elements[pos]), after[pos]) for pos in changed
+        ])
+
+    def _remove(self, key):
+        self.db.execute(f'DELETE FROM "c_{self.name}" WHERE id = ?', (key,))
+        self.db.execute(f'DELETE FROM "i_{self.name}" WHERE id = ?', (key,))
+        if self.array:
+            self.db.execute(f'DELETE FROM "a_{self.name}" WHERE id = ?', (key,))
+
+    def _modify(self, key, doc, update, array_filters, mode):
+        old = self._snapshot(doc, mode)
+        apply_update(doc, {op: fields for op, fields in update.items() if op != "$setOnInsert"}, array_filters)
+        self._save(key, old, doc, mode)
+
+    def _upsert(self, query, update):
+        doc = {field: value for field, value in query.items()
+               if not field.startswith("$") and not isinstance(value, dict)}
+        for path, value in update.get("$setOnInsert", {}).items():
+            set_path(doc, path, copy.deepcopy(value))
+        apply_update(doc, {op: fields for op, fields in update.items() if op != "$setOnInsert"})
+        return self._insert(doc)
+
+    def _update_one(self, query, update, upsert=False, array_filters=None):
+        mode = self._write_mode(query, update, array_filters=array_filters)
+        key, doc = self._find_first(query, mode)
+        if doc is not None:
+            self._modify(key, doc, update, array_filters, mode)
+            return _Result(matched_count=1, modified_count=1)
+        if upsert:
+            return _Result(upserted_id=self._upsert(query, update)["_id"])
+        return _Result()
+
+    # The motor API
+
+    async def create_index(self, keys, **kwargs):
+        """Equality lookups on the first key of an index go through i_<name>; TTL and uniqueness are not enforced."""
+        field = keys[0][0] if isinstance(keys, list) else keys
+        if field in self.indexed or field == "_id" or "." in field:
+            return
+        await self.client._write(None, lambda: self._add_index(field))
+
+    def _add_index(self, field):
+        self.db.execute("INSERT OR IGNORE INTO indexes VALUES (?, ?)", (self.name, field))
+        self.indexed.add(field)
+        for key, doc in self._find({}, None):
+            self.db.executemany(f'INSERT OR IGNORE INTO "i_{self.name}" VALUES (?, ?, ?)',
+                                self._index_rows(key, self._indexed(doc, [field])))
+
+    async def find_one(self, query, projection=None, session=None):
+        _, doc = self._find_first(query, self._array_mode(query, projection))
+        return project(doc, projection, clone=False) if doc is not None else None
+
+    def find(self, query=None, projection=None, session=None):
+        return SQLiteCursor(self, query or {}, projection)
+
+    async def count_documents(self, query, session=None):
+        return sum(1 for _ in self._find(query, self._array_mode(query, {"_id": 1})))
+
+    async def insert_one(self, doc, session=None):
+        await self.client._write(session, lambda: self._insert(copy.deepcopy(doc)))
+
+    async def insert_many(self, docs, ordered=True, session=None):
+        def insert():
+            for doc in docs:
+                self._insert(copy.deepcopy(doc))
+        await self.client._write(session, insert)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False,
+                                  array_filters=None, session=None):
+        mode = self._write_mode(query, update, projection, array_filters)
+
+        def operation():
+            key, doc = self._find_first(query, mode)
+            if doc is None:
+                if not upsert:
+                    return None
+                doc = self._upsert(query, update)
+                return project(doc, projection, clone=False) if return_document else None
+            before = None if return_document else project(doc, projection)
+            self._modify(key, doc, update, array_filters, mode)
+            return project(doc, projection, clone=False) if return_document else before
+
+        # Reads of existing documents with only $setOnInsert (get-or-create) skip the write path
+        if set(update) == {"$setOnInsert"}:
+            _, doc = self._find_first(query, self._array_mode(query, projection))
+            if doc is not None:
+                return project(doc, projection, clone=False)
+        return await self.client._write(session, operation)
+
+    async def find_one_and_delete(self, query, projection=None, session=None):
+        def operation():
+            key, doc = self._find_first(query, self._array_mode(query, projection))
+            if doc is None:
+                return None
+            self._remove(key)
+            return project(doc, projection, clone=False)
+        return await self.client._write(session, operation)
+
+    async def update_one(self, query, update, upsert=False, array_filters=None, session=None):
+        return await self.client._write(session, lambda: self._update_one(query, update, upsert, array_filters))
+
+    async def replace_one(self, query, doc, upsert=False, session=None):
+        def operation():
+            key, found = self._find_first(query, self._array_mode(query, {"_id": 1}))
+            if found is not None:
+                self._remove(key)
+            elif not upsert:
+                return _Result()
+            self._insert(copy.deepcopy(doc))
+            return _Result(matched_count=int(found is not None), modified_count=int(found is not None))
+        return await self.client._write(session, operation)
+
+    async def delete_one(self, query, session=None):
+        def operation():
+            key, doc = self._find_first(query, self._array_mode(query, {"_id": 1}))
+            if doc is not None:
+                self._remove(key)
+            return _Result(deleted_count=int(doc is not None))
+        return await self.client._write(session, operation)
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        """UpdateOne and DeleteOne requests, which is all the bot sends."""
+        def operation():
+            matched = 0
+            for index, request in enumerate(requests):
+                self.db.execute("SAVEPOINT request")
+                try:
+                    if isinstance(request, DeleteOne):
+                        key, doc = self._find_first(request._filter, self._array_mode(request._filter, {"_id": 1}))
+                        if doc is not None:
+                            self._remove(key)
+                    else:
+                        result = self._update_one(request._filter, request._doc, request._upsert,
+                                                  request._array_filters)
+                        matched += result.matched_count
+                except (sqlite3.Error, ValueError, TypeError, KeyError) as e:
+                    self.db.execute("ROLLBACK TO request")
+                    self.db.execute("RELEASE request")
+                    raise BulkWriteError({"writeErrors": [{"index": index, "errmsg": str(e)}], "nMatched": matched})
+                self.db.execute("RELEASE request")
+            return _Result(matched_count=matched, modified_count=matched)
+        return await self.client._write(session, operation)
+
+
+class SQLiteSession:
+    """Transactions are savepoints, and run one at a time.
+
+    Other coroutines' writes wait for the transaction; their reads may see
+    its changes before it commits.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def with_transaction(self, callback):
+        db = self.client.db
+        async with self.client.write_lock:
+            if not db.in_transaction:
+                db.execute("BEGIN")
+            db.execute("SAVEPOINT session")
+            try:
+                result = await callback(self)
+            except BaseException:
+                db.execute("ROLLBACK TO session")
+                db.execute("RELEASE session")
+                raise
+            db.execute("RELEASE session")
+        await self.client.commit()
+        return result
+
+
+class SQLiteDatabase:
+
+    def __init__(self, client):
+        self.client = client
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = SQLiteCollection(self.client, name, self.client.arrays.get(name))
+        return self.collections[name]
+
+
+class SQLiteClient:
+    """Stand-in for AsyncIOMotorClient backed by one SQLite file, for a single bot process.
+
+    Every database name maps to the same file. ``arrays`` maps a collection
+    to an array field kept in its own indexed rows, e.g. {"users": ("pets", "id")},
+    so reading a user without their pets does not parse them and a write
+    only rewrites the pets that changed. Writes wait for a COMMIT shared with
+    every other write made before the event loop gets to it, or within
+    ``commit_delay`` seconds if that is set.
+    """
+
+    def __init__(self, path, arrays=None, commit_delay=0):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS indexes (collection TEXT NOT NULL, field TEXT NOT NULL, "
+                        "PRIMARY KEY (collection, field))")
+        self.arrays = arrays or {}
+        self.commit_delay = commit_delay
+        self.write_lock = asyncio.Lock()  # held by transactions, so other writes don't land inside one
+        self.database = SQLiteDatabase(self)
+        self._commit = None
+
+    def __getitem__(self, name):
+        return self.database
+
+    async def start_session(self):
+        return SQLiteSession(self)
+
+    async def _write(self, session, operation):
+        if session is not None:
+            # Inside with_transaction, which holds the lock and commits
+            return operation()
+        async with self.write_lock:
+            if not self.db.in_transaction:
+                self.db.execute("BEGIN")
+            # Each operation is atomic; a bulk write keeps the requests before a failed one, like Mongo
+            self.db.execute("SAVEPOINT operation")
+            try:
+                result = operation()
+            except BulkWriteError:
+                self.db.execute("RELEASE operation")
+                raise
+            except BaseException:
+                self.db.execute("ROLLBACK TO operation")
+                self.db.execute("RELEASE operation")
+                raise
+            self.db.execute("RELEASE operation")
+        await self.commit()
+        return result
+
+    async def commit(self):
+        """Wait for the writes made so far to be committed, together with everyone else's."""
+        if not self.db.in_transaction:
+            return
+        if self._commit is None:
+            loop = asyncio.get_running_loop()
+            self._commit = loop.create_future()
+            loop.call_later(self.commit_delay, self._commit_now)
+        await asyncio.shield(self._commit)
+
+    def _commit_now(self):
+        if self.write_lock.locked():
+            # A transaction is half done, commit once it is over
+            asyncio.get_running_loop().call_later(self.commit_delay, self._commit_now)
+            return
+        future, self._commit = self._commit, None
+        try:
+            if self.db.in_transaction:
+                self.db.execute("COMMIT")
+        except sqlite3.Error as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+    def close(self):
+        if self.db.in_transaction:
+            self.db.execute("COMMIT")
+        self.db.close()
@@ -0,0 +1,114 @@
+# fake_telegram.py - локальная подделка Telegram Bot API
+#
+# Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8081/bot and it
+# answers the Bot API methods the bot uses, recording every call. It can also
+# play Telegram's side of the webhook by posting updates to the bot.
+
+import itertools
+import json
+import time
+from urllib.parse import parse_qs
+
+from keep_alive import _read_body, _respond
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Petropolis", "username": "petropolis_bot"}
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+class FakeTelegram:
+    """ASGI stand-in for api.telegram.org plus helpers to build and send updates."""
+
+    def __init__(self, webhook_url=None, secret_token=None):
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.calls = []  # [(method, params)]
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        method = scope["path"].rsplit("/", 1)[-1]
+        params = self._parse(await _read_body(receive), dict(scope["headers"]))
+        self.calls.append((method, params))
+        body = json.dumps({"ok": True, "result": self._result(method, params)}).encode()
+        await _respond(send, 200, body, b"application/json")
+
+    @staticmethod
+    def _parse(body, headers):
+        if not body:
+            return {}
+        if headers.get(b"content-type", b"").startswith(b"application/json"):
+            return json.loads(body)
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def _message(self, chat_id, text, message_id=None, from_user=BOT_USER):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": from_user,
+            "text": text,
+        }
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params.get("chat_id", 0), params.get("text", ""), params.get("message_id"))
+        return True
+
+    def sent_messages(self, chat_id=None):
+        """Texts the bot sent or edited, optionally for one chat only."""
+        return [params.get("text") for method, params in self.calls
+                if method in ("sendMessage", "editMessageText")
+                and (chat_id is None or params.get("chat_id") == chat_id)]
+
+    def message_update(self, user_id, text):
+        message = self._message(user_id, text, from_user=_user(user_id))
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_update(self, user_id, data):
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": _user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": self._message(user_id, "..."),
+            },
+        }
+
+    async def post_update(self, client, update):
+        """Deliver an update to the bot's webhook like Telegram would (client is an httpx.AsyncClient)."""
+        headers = {}
+        if self.secret_token is not None:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret_token
+        response = await client.post(self.webhook_url, json=update, headers=headers)
+        response.raise_for_status()
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+
+    from keep_alive import serve
+
+    port = int(os.getenv("FAKE_TELEGRAM_PORT", "8081"))
+    print(f"Fake Bot API on http://127.0.0.1:{port}/bot (set TELEGRAM_API_URL to it)")
+    asyncio.run(serve(FakeTelegram(), host="127.0.0.1", port=port))
@@ -1,15 +1,93 @@
-from flask import Flask
-from threading import Thread
+# keep_alive.py - HTTP сервер бота: проверки живости/готовности и вебхук Telegram
+#
+# A bare ASGI app, served by uvicorn on the bot's own event loop, so there is
+# no extra thread or web framework next to the bot.
 
-app = Flask(__name__)
+import hmac
+import json
+import logging
 
-@app.route('/')
-def home():
-    return "I'm alive!"
+from telegram import Update
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+logger = logging.getLogger(__name__)
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+
+async def _read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def _respond(send, status, body=b"", content_type=b"text/plain; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class KeepAliveApp:
+    """ASGI app with health (/healthz), readiness (/readyz), metrics and the Telegram webhook.
+
+    Webhook updates are handed to the application's update queue right away,
+    so Telegram gets its 200 without waiting for the handlers. Only updates
+    that carry ``secret_token`` get in, so a webhook needs one.
+    """
+
+    def __init__(self, application, webhook_path=None, secret_token=None, metrics=None):
+        if webhook_path and not secret_token:
+            raise ValueError("a webhook needs a secret_token")
+        self.application = application
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self.metrics = metrics  # callable returning the /metrics text
+        self.ready = False
+
+    async def __call__(self, scope, receive, send):
+        # The bot's lifecycle is driven by bot.py, so lifespan events are not used
+        if scope["type"] != "http":
+            return
+
+        path = scope["path"]
+        if path == "/":
+            await _respond(send, 200, b"I'm alive!")
+        elif path == "/healthz":
+            await _respond(send, 200, b"ok")
+        elif path == "/readyz":
+            await _respond(send, 200 if self.ready else 503, b"ready" if self.ready else b"starting")
+        elif path == "/metrics" and self.metrics is not None:
+            await _respond(send, 200, self.metrics().encode(), b"text/plain; version=0.0.4; charset=utf-8")
+        elif self.webhook_path and path == self.webhook_path and scope["method"] == "POST":
+            await self._webhook(scope, receive, send)
+        else:
+            await _respond(send, 404, b"not found")
+
+    async def _webhook(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        if not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), self.secret_token.encode()):
+            await _respond(send, 403, b"forbidden")
+            return
+
+        body = await _read_body(receive)
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Ignoring malformed webhook update")
+            await _respond(send, 400, b"bad request")
+            return
+
+        await self.application.update_queue.put(update)
+        await _respond(send, 200, b"ok")
+
+
+async def serve(app, host="0.0.0.0", port=8080):
+    """Serve the app until the process is asked to stop (SIGINT/SIGTERM)."""
+    import uvicorn
+
+    config = uvicorn.Config(app, host=host, port=port, lifespan="off", log_level="warning")
+    await uvicorn.Server(config).serve()
@@ -0,0 +1,121 @@
+# leaderboard.py - таблицы лидеров по индексированным полям
+#
+# Ranking keys live on the user document and are kept up to date by every
+# mutation that adds or removes pets:
+#   power         - sum of all stats of all pets
+#   rarity_counts - {rarity index: number of pets}, to know when the best one is gone
+#   best_rarity   - index of the rarest pet in RARITIES, -1 without pets
+
+import asyncio
+import logging
+from array import array
+from bisect import bisect_right
+
+from pymongo import ASCENDING, DESCENDING
+
+logger = logging.getLogger(__name__)
+
+BOARDS = {
+    "coins": "coins",
+    "power": "power",
+    "rarity": "best_rarity",
+}
+
+
+def pet_power(pet):
+    return sum(pet["stats"].values())
+
+
+def legacy_ranking(user, rarities):
+    """Ranking keys for a user from before they were tracked (one-off, O(pets))."""
+    counts = {}
+    for pet in user.get("pets", []):
+        index = str(rarities.index(pet["rarity"]))
+        counts[index] = counts.get(index, 0) + 1
+    return {
+        "power": sum(pet_power(pet) for pet in user.get("pets", [])),
+        "rarity_counts": counts,
+        "best_rarity": max(map(int, counts), default=-1),
+    }
+
+
+def ranking_delta(user, rarities, added=(), removed=()):
+    """Changes to the ranking keys for pets entering and leaving a collection.
+
+    Returns ($inc fields, $set fields).
+    """
+    inc = {"power": sum(pet_power(p) for p in added) - sum(pet_power(p) for p in removed)}
+    counts = dict(user.get("rarity_counts", {}))
+    for pet, step in [(p, 1) for p in added] + [(p, -1) for p in removed]:
+        index = str(rarities.index(pet["rarity"]))
+        counts[index] = counts.get(index, 0) + step
+        inc[f"rarity_counts.{index}"] = inc.get(f"rarity_counts.{index}", 0) + step
+
+    best = max((int(i) for i, n in counts.items() if n > 0), default=-1)
+    updates = {} if best == user.get("best_rarity") else {"best_rarity": best}
+    return {field: amount for field, amount in inc.items() if amount}, updates
+
+
+class Leaderboard:
+    """Top-N pages and rank lookups served from a periodically refreshed snapshot.
+
+    Each refresh streams one indexed, projected scan per board. The snapshot
+    keeps the top ``size`` entries and every score in a sorted array, so a
+    user's rank is a binary search rather than a count over the collection.
+    """
+
+    def __init__(self, users, size=10, refresh_interval=300):
+        self.users = users
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.tops = {board: [] for board in BOARDS}  # {board: [(user_id, score), ...]}
+        self.scores = {board: array("d") for board in BOARDS}  # ascending
+        self._refresher = None
+
+    async def ensure_indexes(self):
+        for field in BOARDS.values():
+            await self.users.create_index([(field, DESCENDING), ("user_id", ASCENDING)])
+
+    async def refresh(self):
+        for board, field in BOARDS.items():
+            top = []
+            scores = array("d")
+            cursor = (self.users.find({field: {"$exists": True}}, {"_id": 0, "user_id": 1, field: 1})
+                      .sort([(field, DESCENDING), ("user_id", ASCENDING)])
+                      .batch_size(10000))
+            async for doc in cursor:
+                if len(top) < self.size:
+                    top.append((doc["user_id"], doc[field]))
+                scores.append(doc[field])
+            scores.reverse()
+            self.tops[board] = top
+            self.scores[board] = scores
+
+    def top(self, board):
+        return self.tops[board]
+
+    def rank(self, board, score):
+        """1-based rank a score would have in the snapshot."""
+        scores = self.scores[board]
+        return len(scores) - bisect_right(scores, score) + 1
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh leaderboard")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
@@ -0,0 +1,215 @@
+# ledger.py - журнал монет: каждое начисление и списание
+#
+# Every change of a user's coins is appended as a small event, and events
+# are written in batches. A user's balance is their latest snapshot plus the
+# events after it; a new snapshot is taken once enough events pile up, so
+# replaying a balance never reads more than a short tail. Every event also
+# carries the balance it left, so a change of coins that bypassed the ledger
+# shows up as a break in the chain, and as a difference between the coins and
+# the ledger's balance.
+#
+# Audit the whole economy (run while the bot is stopped, or expect the users
+# it is serving to show up until their writes are flushed):
+#   MONGO_URI=... python ledger.py
+
+import asyncio
+import logging
+import time
+
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+# Events use short field names, there are many of them:
+#   u - user_id, a - amount (negative for debits), r - reason, b - balance after, t - unix time
+
+
+class CoinLedger:
+    """Append-only coin events and per-user balance snapshots.
+
+    ``record`` only queues an event; queued events are inserted every
+    ``flush_interval`` seconds or once ``batch_size`` of them are waiting. A
+    user gets a new snapshot after ``snapshot_every`` events. Events of one
+    user must be recorded by one process in the order they happened, which
+    is what routing updates by user gives.
+    """
+
+    def __init__(self, events, snapshots, batch_size=500, flush_interval=1.0, snapshot_every=100):
+        self.events = events
+        self.snapshots = snapshots
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.pending = []  # events not inserted yet, in order
+        self.since_snapshot = {}  # {user_id: events recorded since their snapshot, as far as we know}
+        self._flusher = None
+        self._wakeup = None
+
+    async def ensure_indexes(self):
+        await self.events.create_index([("u", ASCENDING), ("_id", ASCENDING)])
+        await self.snapshots.create_index([("user_id", ASCENDING)], unique=True)
+
+    def record(self, user_id, amount, reason, balance):
+        """Queue a credit (amount > 0) or debit (amount < 0) that left the user with ``balance``."""
+        if not amount:
+            return
+        self.pending.append({"u": user_id, "a": amount, "r": reason, "b": balance, "t": time.time()})
+        self.since_snapshot[user_id] = self.since_snapshot.get(user_id, 0) + 1
+        if len(self.pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Insert queued events, then snapshot the users whose tails got long."""
+        if self.pending:
+            pending, self.pending = self.pending, []
+            try:
+                # Unordered, so events an earlier attempt got through don't stop the rest. Replays go
+                # by _id, and snapshots wait until every queued event is in, so the order is kept
+                await self.events.insert_many(pending, ordered=False)
+            except BulkWriteError as e:
+                # insert_many gave the events their _id, so the ones already written are duplicates
+                failed = [error["index"] for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY]
+                if failed:
+                    self.pending = [pending[index] for index in failed] + self.pending
+                    raise
+            except Exception:
+                # The failed events go before anything recorded meanwhile
+                self.pending = pending + self.pending
+                raise
+        due = [user_id for user_id, count in self.since_snapshot.items() if count >= self.snapshot_every]
+        for user_id in due:
+            await self.snapshot(user_id)
+
+    async def _replay(self, user_id):
+        """The snapshot brought up to date with the events after it, None if there is nothing.
+
+        Snapshots are {"balance": sum of the amounts, "last": balance the last
+        event left, "through": its _id, "breaks": events that did not start
+        where the previous one left the balance}.
+        """
+        snapshot = await self.snapshots.find_one({"user_id": user_id},
+                                                 {"_id": 0, "balance": 1, "last": 1, "through": 1, "breaks": 1})
+        query = {"u": user_id}
+        if snapshot is not None:
+            query["_id"] = {"$gt": snapshot["through"]}
+        async for event in self.events.find(query, {"u": 0, "r": 0, "t": 0}).sort([("_id", ASCENDING)]):
+            if snapshot is None:
+                # Users from before the ledger start from the balance their first event began with
+                start = event["b"] - event["a"]
+                snapshot = {"balance": start, "last": start, "breaks": 0}
+            snapshot["breaks"] += snapshot["last"] + event["a"] != event["b"]
+            snapshot["balance"] += event["a"]
+            snapshot["last"], snapshot["through"] = event["b"], event["_id"]
+        return snapshot
+
+    async def balance(self, user_id):
+        """The user's balance according to the ledger, None if it has never seen them."""
+        snapshot = await self._replay(user_id)
+        return None if snapshot is None else snapshot["balance"]
+
+    async def snapshot(self, user_id):
+        snapshot = await self._replay(user_id)
+        self.since_snapshot.pop(user_id, None)
+        if snapshot is None:
+            return
+        await self.snapshots.update_one({"user_id": user_id}, {"$set": dict(snapshot, at=time.time())}, upsert=True)
+
+    async def reconcile(self, user_id, coins):
+        """Compare the ledger with the user's coins: (ledger balance, breaks in the chain, difference)."""
+        snapshot = await self._replay(user_id)
+        if snapshot is None:
+            return None, 0, None
+        return snapshot["balance"], snapshot["breaks"], coins - snapshot["balance"]
+
+    async def audit(self, users, batch_size=500):
+        """Stream through every user and yield (user_id, coins, ledger balance) where they disagree.
+
+        Users are read in ``user_id`` order a batch at a time, with their
+        snapshots and tails fetched per batch, so memory stays bounded by the
+        batch whatever the number of users. Users the ledger has never seen
+        are skipped.
+        """
+        cursor = users.find({}, {"_id": 0, "user_id": 1, "coins": 1}).sort([("user_id", ASCENDING)])
+        batch = []
+        async for user in cursor.batch_size(batch_size):
+            batch.append(user)
+            if len(batch) >= batch_size:
+                async for mismatch in self._audit_batch(batch):
+                    yield mismatch
+                batch = []
+        if batch:
+            async for mismatch in self._audit_batch(batch):
+                yield mismatch
+
+    async def _audit_batch(self, batch):
+        user_ids = [user["user_id"] for user in batch]
+        snapshots = {
+            snapshot["user_id"]: snapshot
+            async for snapshot in self.snapshots.find({"user_id": {"$in": user_ids}},
+                                                      {"_id": 0, "user_id": 1, "balance": 1, "through": 1})
+        }
+        balances = {user_id: snapshot["balance"] for user_id, snapshot in snapshots.items()}
+        tails = [{"u": user_id, "_id": {"$gt": snapshots[user_id]["through"]}} if user_id in snapshots
+                 else {"u": user_id} for user_id in user_ids]
+        events = self.events.find({"$or": tails}, {"u": 1, "a": 1, "b": 1})
+        async for event in events.sort([("u", ASCENDING), ("_id", ASCENDING)]):
+            balances[event["u"]] = balances.get(event["u"], event["b"] - event["a"]) + event["a"]
+        for user in batch:
+            balance = balances.get(user["user_id"])
+            if balance is not None and balance != user.get("coins", 0):
+                yield user["user_id"], user.get("coins", 0), balance
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write coin events")
+
+    def start(self):
+        if self._flusher is None:
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stop the background task and write queued events."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+            self._wakeup = None
+        await self.flush()
+
+
+async def _audit(uri):
+    from storage import create_client
+
+    db = create_client(uri)["petropolis"]
+    ledger = CoinLedger(db["coin_events"], db["coin_snapshots"])
+    mismatches = 0
+    async for user_id, coins, balance in ledger.audit(db["users"]):
+        mismatches += 1
+        print(f"{user_id}: {coins} coins, ledger says {balance} ({coins - balance:+})")
+    print(f"{mismatches} users disagree with the ledger")
+    return mismatches
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    sys.exit(1 if asyncio.run(_audit(os.environ["MONGO_URI"])) else 0)
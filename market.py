@@ -0,0 +1,305 @@
+# market.py - рынок питомцев: выставить за монеты, купить у любого игрока
+#
+# A listed pet leaves its owner's collection and waits in the listings
+# collection (escrow) until it is bought or taken back, so it can't be
+# merged, traded or listed twice meanwhile. A listing's _id is the pet's ID.
+# Buying moves the coins and the pet in one transaction.
+#
+# Every process keeps an order book of the open listings in memory: a list
+# sorted by (price, pet ID) for every type, rarity and level. The cheapest
+# listing of a filter is the smallest head of the lists it covers, and a page
+# is a merge of those lists, so neither depends on the number of listings,
+# only on how many kinds there are. The book is rebuilt from the collection
+# every refresh_interval seconds to pick up other processes' listings; a
+# purchase is settled against the collection, so a stale entry only ever
+# means "already sold". The collection is only looked up by _id and seller,
+# all browsing goes through the book.
+
+import asyncio
+import heapq
+import logging
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from itertools import islice
+
+from pymongo import ASCENDING, ReturnDocument
+
+from storage import pets_projection, repeated_pet_id
+from trading import arrived, summary_update
+
+logger = logging.getLogger(__name__)
+
+Listing = namedtuple("Listing", "pet_id seller_id type rarity level price")
+Sale = namedtuple("Sale", "pet price seller_id coins")  # coins: the buyer's, after paying
+
+# Fields of a listing document besides the escrowed pet
+_LISTING_FIELDS = {"_id": 1, "seller_id": 1, "type": 1, "rarity": 1, "level": 1, "price": 1}
+# Fields needed to update the summaries of a user whose pets change
+_SUMMARY_FIELDS = {"_id": 0, "coins": 1, "income": 1, "rarity_counts": 1, "best_rarity": 1}
+
+
+class MarketError(Exception):
+    """A listing or purchase failed; the message is shown to the user."""
+
+
+def _listing(doc):
+    return Listing(doc["_id"], doc["seller_id"], doc["type"], doc["rarity"], doc["level"], doc["price"])
+
+
+class OrderBook:
+    """Open listings by type and rarity, then level, each level sorted by price."""
+
+    def __init__(self, listings=()):
+        self.books = {}  # {(type, rarity): {level: [(price, pet_id), ...] ascending}}
+        self.listings = {}  # {pet_id: Listing}
+        for listing in listings:
+            self._append(listing)
+        for book in self._all():
+            book.sort()
+
+    @classmethod
+    async def build(cls, listings):
+        """A book of the listings an async iterator yields, giving way to the event loop between sorts."""
+        book = cls()
+        async for listing in listings:
+            book._append(listing)
+        for level in book._all():
+            level.sort()
+            await asyncio.sleep(0)
+        return book
+
+    def _all(self):
+        return [book for levels in self.books.values() for book in levels.values()]
+
+    def _book(self, listing):
+        return self.books.setdefault((listing.type, listing.rarity), {}).setdefault(listing.level, [])
+
+    def _append(self, listing):
+        # Unsorted, and pet IDs must not repeat: one sort per book follows, inserting one by one
+        # would be quadratic
+        self.listings[listing.pet_id] = listing
+        self._book(listing).append((listing.price, listing.pet_id))
+
+    def __len__(self):
+        return len(self.listings)
+
+    def add(self, listing):
+        self.remove(listing.pet_id)
+        self.listings[listing.pet_id] = listing
+        insort(self._book(listing), (listing.price, listing.pet_id))
+
+    def remove(self, pet_id):
+        listing = self.listings.pop(pet_id, None)
+        if listing is None:
+            return None
+        levels = self.books[listing.type, listing.rarity]
+        book = levels[listing.level]
+        del book[bisect_left(book, (listing.price, pet_id))]
+        if not book:
+            del levels[listing.level]
+            if not levels:
+                del self.books[listing.type, listing.rarity]
+        return listing
+
+    def get(self, pet_id):
+        return self.listings.get(pet_id)
+
+    def _books(self, pet_type, rarity, min_level):
+        if pet_type is not None and rarity is not None:
+            kinds = [self.books.get((pet_type, rarity), {})]
+        else:
+            kinds = [levels for (t, r), levels in self.books.items()
+                     if (pet_type is None or t == pet_type) and (rarity is None or r == rarity)]
+        return [book for levels in kinds for level, book in levels.items() if level >= min_level]
+
+    def cheapest(self, pet_type=None, rarity=None, min_level=1):
+        """The cheapest listing matching the filter, None if there is none."""
+        heads = [book[0] for book in self._books(pet_type, rarity, min_level)]
+        return self.listings[min(heads)[1]] if heads else None
+
+    def page(self, pet_type=None, rarity=None, min_level=1, offset=0, limit=10):
+        """Listings ``offset`` to ``offset + limit`` of the filter, cheapest first, and whether more follow."""
+        entries = heapq.merge(*self._books(pet_type, rarity, min_level))
+        listings = [self.listings[pet_id] for _, pet_id in islice(entries, offset, offset + limit + 1)]
+        return listings[:limit], len(listings) > limit
+
+
+class Market:
+    """Pets listed for coins, escrowed in their own collection and sold atomically.
+
+    Coins that change hands are recorded in ``ledger`` (a CoinLedger) when
+    one is given. The seller's event goes through ``record_seller``, which
+    takes the arguments of CoinLedger.record: a ledger wants all events of a
+    user from one process, so with sharding it hands them to the seller's
+    worker. A seller has at most ``max_listings`` open listings.
+    """
+
+    def __init__(self, client, users, listings, cache, rarities, ledger=None, max_listings=20,
+                 refresh_interval=60):
+        self.client = client
+        self.users = users
+        self.listings = listings
+        self.cache = cache
+        self.rarities = rarities
+        self.ledger = ledger
+        self.record_seller = None if ledger is None else ledger.record
+        self.max_listings = max_listings
+        self.refresh_interval = refresh_interval
+        self.book = OrderBook()
+        self._refresher = None
+
+    async def ensure_indexes(self):
+        await self.listings.create_index([("seller_id", ASCENDING), ("price", ASCENDING)])
+
+    async def load(self):
+        """Rebuild the order book from the collection."""
+        self.book = await OrderBook.build(_listing(doc) async for doc in self.listings.find({}, _LISTING_FIELDS))
+
+    async def seller_listings(self, seller_id):
+        cursor = self.listings.find({"seller_id": seller_id}, _LISTING_FIELDS).sort([("price", ASCENDING)])
+        return [_listing(doc) async for doc in cursor]
+
+    async def _transaction(self, callback, user_ids):
+        # Queued cache writes must reach the database before it becomes the source of truth
+        await self.cache.flush_users(user_ids)
+        async with await self.client.start_session() as session:
+            try:
+                return await session.with_transaction(callback)
+            finally:
+                for user_id in user_ids:
+                    self.cache.invalidate(user_id)
+
+    async def _give_pet(self, user_id, owner, pet, session):
+        pet = arrived(pet)
+        update = dict(summary_update(owner, self.rarities, added=[pet]), **{"$push": {"pets": pet}})
+        result = await self.users.update_one({"user_id": user_id, "pets.id": {"$ne": pet["id"]}}, update,
+                                             session=session)
+        if not result.matched_count:
+            raise MarketError(f"У тебя уже есть питомец с ID {pet['id']}.")
+
+    async def list_pet(self, seller_id, pet_id, price):
+        """Move the seller's pet into escrow at ``price`` coins; returns the Listing."""
+        async def escrow(session):
+            # Counted in the transaction: two listings of one seller both write their user
+            # document, so one of the transactions conflicts and is retried with a new count
+            if await self.listings.count_documents({"seller_id": seller_id}, session=session) >= self.max_listings:
+                raise MarketError(f"У тебя уже {self.max_listings} лотов. Сними какой-нибудь: /unlist <ID>")
+            before = await self.users.find_one_and_update(
+                {"user_id": seller_id, "pets.id": pet_id},
+                {"$pull": {"pets": {"id": pet_id}}},
+                projection={"pets": pets_projection([pet_id]), **_SUMMARY_FIELDS},
+                session=session,
+            )
+            if not before:
+                raise MarketError("Такого питомца у тебя нет.")
+            if repeated_pet_id(before["pets"]) is not None:
+                # The $pull took all of them; the transaction puts them back
+                raise MarketError(f"У тебя несколько питомцев с ID {pet_id}. Скоро им выдадут новые ID, "
+                                  f"тогда попробуй снова.")
+            pet = before.pop("pets")[0]
+            await self.users.update_one({"user_id": seller_id}, summary_update(before, self.rarities, removed=[pet]),
+                                        session=session)
+            doc = {"_id": pet_id, "seller_id": seller_id, "type": pet["type"], "rarity": pet["rarity"],
+                   "level": pet["level"], "price": price, "pet": pet, "listed_at": time.time()}
+            await self.listings.insert_one(doc, session=session)
+            return _listing(doc)
+
+        listing = await self._transaction(escrow, [seller_id])
+        self.book.add(listing)
+        return listing
+
+    async def unlist(self, seller_id, pet_id):
+        """Give a listed pet back to its seller; returns the pet."""
+        async def give_back(session):
+            doc = await self.listings.find_one_and_delete({"_id": pet_id, "seller_id": seller_id}, session=session)
+            if not doc:
+                raise MarketError("Такого лота у тебя нет.")
+            owner = await self.users.find_one({"user_id": seller_id}, _SUMMARY_FIELDS, session=session)
+            await self._give_pet(seller_id, owner, doc["pet"], session)
+            return doc["pet"]
+
+        try:
+            return await self._transaction(give_back, [seller_id])
+        finally:
+            self.book.remove(pet_id)
+
+    async def buy(self, buyer_id, pet_id, price=None):
+        """Buy a listed pet, at ``price`` if given (the price the buyer saw).
+
+        Returns a Sale. The coins and the pet move in one transaction;
+        MarketError means nothing was written.
+        """
+        known = self.book.get(pet_id)
+        if known is not None and known.seller_id == buyer_id:
+            raise MarketError("Это твой лот. Снять его: /unlist " + str(pet_id))
+        seller_ids = [known.seller_id] if known is not None else []
+
+        async def settle(session):
+            query = {"_id": pet_id, "seller_id": {"$ne": buyer_id}}
+            if price is not None:
+                query["price"] = price
+            doc = await self.listings.find_one_and_delete(query, session=session)
+            if not doc:
+                raise MarketError("Этот лот уже продан, снят или изменился.")
+            buyer = await self.users.find_one_and_update(
+                {"user_id": buyer_id, "coins": {"$gte": doc["price"]}},
+                {"$inc": {"coins": -doc["price"]}},
+                projection=_SUMMARY_FIELDS,
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if not buyer:
+                raise MarketError(f"😟 Не хватает монет: лот стоит {doc['price']}.")
+            seller = await self.users.find_one_and_update(
+                {"user_id": doc["seller_id"]},
+                {"$inc": {"coins": doc["price"]}},
+                projection={"_id": 0, "coins": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if not seller:
+                raise MarketError("Продавец этого лота не найден.")
+            await self._give_pet(buyer_id, buyer, doc["pet"], session)
+            return doc, buyer["coins"], seller["coins"]
+
+        try:
+            doc, buyer_coins, seller_coins = await self._transaction(settle, [buyer_id, *seller_ids])
+        except MarketError:
+            # Bring the book's entry in line with the collection
+            doc = await self.listings.find_one({"_id": pet_id}, _LISTING_FIELDS)
+            if doc:
+                self.book.add(_listing(doc))
+            else:
+                self.book.remove(pet_id)
+            raise
+        self.book.remove(pet_id)
+        if doc["seller_id"] not in seller_ids:
+            # Listed by another process; our cache may hold the seller too
+            await self.cache.flush_users([doc["seller_id"]])
+            self.cache.invalidate(doc["seller_id"])
+        if self.ledger is not None:
+            self.ledger.record(buyer_id, -doc["price"], "market_buy", buyer_coins)
+            self.record_seller(doc["seller_id"], doc["price"], "market_sell", seller_coins)
+        return Sale(doc["pet"], doc["price"], doc["seller_id"], buyer_coins)
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Failed to reload the market order book")
+
+    def start(self):
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
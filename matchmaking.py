@@ -0,0 +1,119 @@
+# matchmaking.py - очередь поиска соперника для боёв
+#
+# Waiting players sit in rating buckets that grow geometrically (each is
+# ``ratio`` times wider than the one below), so a team is only compared with
+# teams of similar strength at any power level. Finding an opponent looks at
+# a few neighbouring buckets, never at the whole queue, and stale entries are
+# dropped from a queue in join order. Everything is in process memory; with
+# shards the queue is on one worker (bot.MATCH_SHARD), which the other
+# workers send their players' teams to, so all players wait in the same queue.
+
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class MatchQueue:
+    """Players waiting for a battle, paired by rating.
+
+    ``join`` either returns a waiting opponent of a similar rating (and
+    removes them from the queue) or queues the player. Players who waited
+    ``timeout`` seconds are removed and passed to ``on_timeout(user_id)``.
+    """
+
+    def __init__(self, ratio=1.25, spread=1, timeout=120.0, on_timeout=None, sweep_interval=5.0,
+                 clock=time.monotonic):
+        self.log_ratio = math.log(ratio)
+        self.spread = spread  # neighbouring buckets on each side an opponent may come from
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self.buckets = {}  # {bucket: OrderedDict {user_id: payload}}, oldest first
+        self.waiting = {}  # {user_id: (bucket, joined_at)}
+        self.joined = deque()  # (joined_at, user_id) in join order, may hold outdated entries
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def bucket_of(self, rating):
+        return int(math.log(max(rating, 1)) / self.log_ratio)
+
+    def join(self, user_id, rating, payload=None):
+        """Pair the player with someone waiting, or queue them.
+
+        Returns (opponent_id, opponent's payload), or None if the player was queued.
+        """
+        self.leave(user_id)
+        bucket = self.bucket_of(rating)
+        for candidate in self._nearby(bucket):
+            players = self.buckets.get(candidate)
+            if players:
+                opponent_id, opponent_payload = players.popitem(last=False)
+                if not players:
+                    del self.buckets[candidate]
+                del self.waiting[opponent_id]
+                return opponent_id, opponent_payload
+
+        now = self.clock()
+        self.buckets.setdefault(bucket, OrderedDict())[user_id] = payload
+        self.waiting[user_id] = (bucket, now)
+        self.joined.append((now, user_id))
+        return None
+
+    def _nearby(self, bucket):
+        yield bucket
+        for distance in range(1, self.spread + 1):
+            yield bucket - distance
+            yield bucket + distance
+
+    def leave(self, user_id):
+        """Take the player out of the queue; True if they were waiting."""
+        entry = self.waiting.pop(user_id, None)
+        if entry is None:
+            return False
+        players = self.buckets[entry[0]]
+        del players[user_id]
+        if not players:
+            del self.buckets[entry[0]]
+        return True
+
+    def expire(self, now=None):
+        """Remove the players who waited too long and return their IDs."""
+        deadline = (self.clock() if now is None else now) - self.timeout
+        expired = []
+        while self.joined and self.joined[0][0] <= deadline:
+            joined_at, user_id = self.joined.popleft()
+            entry = self.waiting.get(user_id)
+            if entry is not None and entry[1] == joined_at:
+                self.leave(user_id)
+                expired.append(user_id)
+        return expired
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            for user_id in self.expire():
+                if self.on_timeout is not None:
+                    try:
+                        await self.on_timeout(user_id)
+                    except Exception:
+                        logger.exception("Failed to tell %s that matchmaking timed out", user_id)
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
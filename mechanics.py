@@ -0,0 +1,187 @@
+# mechanics.py - игровая механика: константы, генерация и скрещивание питомцев
+#
+# Nothing here touches Telegram or MongoDB, so the same code runs in the bot
+# and in offline simulations (benchmarks/simulate.py).
+
+import hashlib
+import itertools
+import os
+import random
+import time
+from bisect import bisect_right
+from itertools import accumulate
+
+# Constants
+PET_TYPES = ["Огненный", "Водный", "Земляной", "Воздушный", "Светлый", "Тёмный"]
+RARITIES = ["Обычный", "Необычный", "Редкостный", "Эпический", "Легендарный", "Мифический"]
+RARITY_CHANCES = {
+    "Обычный": 0.35,
+    "Необычный": 0.30,
+    "Редкостный": 0.20,
+    "Эпический": 0.10,
+    "Легендарный": 0.04,
+    "Мифический": 0.01,
+}
+RARITY_MULTIPLIERS = {
+    "Обычный": 50,
+    "Необычный": 100,
+    "Редкостный": 250,
+    "Эпический": 500,
+    "Легендарный": 1500,
+    "Мифический": 3000,
+}
+EGG_PRICES = {
+    "Базовое": 150,
+    "Премиум": 600,
+    "Редкостное": 1200,
+}
+EGG_RARITY_BOOSTS = {
+    "Базовое": 0,
+    "Премиум": 0.30,
+    "Редкостное": 0.45,
+}
+HATCH_BATCH_LIMIT = 500  # eggs per click of "hatch all"
+
+
+def coin_rate(rarity):
+    """Coins per hour a pet of ``rarity`` brings, hatched or merged."""
+    return 20 + RARITY_MULTIPLIERS[rarity] // 2
+
+
+def rarity_table(chances):
+    """Cumulative rarity table, rarest first: a roll below thresholds[i] gives order[i]."""
+    order = [r for r in RARITIES[::-1] if r in chances]
+    thresholds = list(accumulate(chances[r] for r in order[:-1]))
+    return order, thresholds
+
+
+RARITY_ORDER, RARITY_THRESHOLDS = rarity_table(RARITY_CHANCES)
+
+
+class GameRNG(random.Random):
+    """Random generator that remembers its seed, so any roll can be replayed for an audit."""
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(63)
+        self.seed_value = seed
+        super().__init__(seed)
+
+
+# Mixed into every derived seed, so players can't predict rolls from their own and pet IDs.
+# There is no default, a public one would give the rolls away; bot.py refuses to start without it
+RNG_SECRET = os.getenv("RNG_SECRET", "").encode()
+
+
+def rng_for(*event):
+    """Deterministic generator for one event, e.g. rng_for("hatch", user_id, first_pet_id)."""
+    digest = hashlib.blake2b(repr(event).encode(), key=RNG_SECRET[:64], digest_size=8).digest()
+    return GameRNG(int.from_bytes(digest, "big") >> 1)
+
+
+_default_rng = GameRNG(int(os.environ["RNG_SEED"])) if os.getenv("RNG_SEED") else GameRNG()
+_local_ids = itertools.count(1)  # simulations only, the bot allocates IDs in MongoDB
+
+
+def determine_rarity(rarity_boost=0, rng=None, table=None):
+    order, thresholds = table or (RARITY_ORDER, RARITY_THRESHOLDS)
+    return order[bisect_right(thresholds, (rng or _default_rng).random() - rarity_boost)]
+
+
+def generate_random_pet(pet_type=None, rarity_boost=0, rng=None, pet_id=None):
+    return generate_random_pets(1, pet_type, rarity_boost, rng, None if pet_id is None else [pet_id])[0]
+
+
+def generate_random_pets(count, pet_type=None, rarity_boost=0, rng=None, ids=None, table=None):
+    """Generate several pets at once, drawing each kind of random value in one batch.
+
+    ``ids`` are the pets' IDs (allocated by the caller). When an ``rng`` is
+    given its seed is stored on every pet, so the batch can be replayed from it.
+    """
+    seed = rng.seed_value if rng is not None else None
+    rng = rng or _default_rng
+    order, thresholds = table or (RARITY_ORDER, RARITY_THRESHOLDS)
+    ids = ids or [next(_local_ids) for _ in range(count)]
+    roll = rng.random
+    rarities = [order[bisect_right(thresholds, roll() - rarity_boost)] for _ in range(count)]
+    pet_types = [pet_type] * count if pet_type else rng.choices(PET_TYPES, k=count)
+    bases = rng.choices(range(5, 13), k=count)
+    attacks = rng.choices(range(-1, 6), k=count)
+    defenses = rng.choices(range(1, 6), k=count)
+    healths = rng.choices(range(5, 8), k=count)
+    speeds = rng.choices(range(1, 9), k=count)
+    now = time.time()
+
+    pets = []
+    for i, rarity in enumerate(rarities):
+        base_stats = bases[i] * RARITY_MULTIPLIERS[rarity]
+        pets.append({
+            "id": ids[i],
+            "name": f"{rarity} {pet_types[i]}",
+            "type": pet_types[i],
+            "rarity": rarity,
+            "level": 1,
+            "xp": 0,
+            "xp_needed": 100,
+            "stats": {
+                "attack": base_stats + attacks[i],
+                "defense": base_stats + defenses[i],
+                "health": base_stats * 2 + healths[i],
+                "speed": base_stats + speeds[i],
+            },
+            "coin_rate": coin_rate(rarity),
+            "added_at": now,
+        })
+        if seed is not None:
+            pets[-1]["seed"] = seed
+    return pets
+
+
+def merge_pet_stats(pet1, pet2, rng=None, pet_id=None):
+    """Merge two pets' stats and potentially increase rarity"""
+    # Determine which pet has higher level/rarity for base
+    rarities_order = {r: i for i, r in enumerate(RARITIES)}
+
+    # Use the higher level pet as the base
+    base_pet = pet1 if pet1["level"] >= pet2["level"] else pet2
+    other_pet = pet2 if base_pet == pet1 else pet1
+
+    # Create a new pet based on the higher level one
+    merged_pet = base_pet.copy()
+    merged_pet["stats"] = dict(base_pet["stats"])
+    merged_pet["id"] = pet_id if pet_id is not None else next(_local_ids)  # New ID
+
+    # Increase level
+    merged_pet["level"] = base_pet["level"] + 1
+
+    # Merge stats (base + 50% of other pet's stats)
+    for stat in ["attack", "defense", "health", "speed"]:
+        bonus = other_pet["stats"][stat] * 0.5
+        merged_pet["stats"][stat] = int(base_pet["stats"][stat] + bonus)
+
+    # Chance to increase rarity based on combined levels
+    combined_level = pet1["level"] + pet2["level"]
+    rarity_chance = min(0.30 * combined_level, 0.60)  # Max 50% chance
+
+    current_rarity_idx = rarities_order[base_pet["rarity"]]
+    if current_rarity_idx < len(RARITIES) - 1 and (rng or _default_rng).random() < rarity_chance:
+        new_rarity = RARITIES[current_rarity_idx + 1]
+        merged_pet["rarity"] = new_rarity
+
+        # Bonus stats from rarity increase
+        rarity_mult = RARITY_MULTIPLIERS[new_rarity] / RARITY_MULTIPLIERS[base_pet["rarity"]]
+        for stat in merged_pet["stats"]:
+            merged_pet["stats"][stat] = int(merged_pet["stats"][stat] * rarity_mult)
+
+    # Update name and coin rate
+    merged_pet["name"] = f"{merged_pet['rarity']} {merged_pet['type']}"
+    merged_pet["coin_rate"] = coin_rate(merged_pet["rarity"])
+
+    # The merged pet starts collecting from scratch
+    merged_pet.pop("last_collected", None)
+    merged_pet["added_at"] = time.time()
+    merged_pet.pop("seed", None)
+    if rng is not None:
+        merged_pet["seed"] = rng.seed_value
+
+    return merged_pet
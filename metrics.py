@@ -0,0 +1,234 @@
+# metrics.py - метрики бота в текстовом формате Prometheus
+#
+# A small in-process registry of counters, gauges and histograms, rendered at
+# /metrics by keep_alive.py. Handlers, whole updates and database calls are
+# timed by wrappers, so the code being measured does not change. With shards
+# the workers send their samples to the main process, which adds a shard label.
+
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+def _labels(names, values):
+    return tuple(zip(names, values))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}  # {label values: value}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, _labels(self.label_names, label_values), value
+
+
+class Gauge:
+    """A value read when the metrics are collected, e.g. a queue's length.
+
+    ``monotonic`` gauges read a running total kept elsewhere (such as cache
+    hits) and are exposed as counters.
+    """
+
+    def __init__(self, name, help, read, monotonic=False):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = "counter" if monotonic else "gauge"
+
+    def samples(self):
+        yield self.name, (), self.read()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        self.values = {}  # {label values: [count per bucket..., count above the last, sum]}
+
+    def observe(self, value, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in self.values.items():
+            labels = _labels(self.label_names, label_values)
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield f"{self.name}_bucket", labels + (("le", repr(float(bound))),), total
+            total += counts[-2]
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), total
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, total
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, read, monotonic=False):
+        """Register (or replace) a gauge that calls ``read()`` on every collection."""
+        return self._register(Gauge(name, help, read, monotonic))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def collect(self):
+        """Current samples as plain data: [(name, kind, help, [(sample, labels, value)])]."""
+        return [(m.name, m.kind, m.help, list(m.samples())) for m in self.metrics.values()]
+
+
+def with_label(families, name, value):
+    """Add a label to every sample, e.g. the shard the samples came from."""
+    return [(family, kind, help, [(sample, ((name, value),) + labels, v) for sample, labels, v in samples])
+            for family, kind, help, samples in families]
+
+
+def combine(*family_lists):
+    """Merge collections from several sources into one, family by family."""
+    merged = {}
+    for families in family_lists:
+        for family, kind, help, samples in families:
+            if family in merged:
+                merged[family][3].extend(samples)
+            else:
+                merged[family] = (family, kind, help, list(samples))
+    return list(merged.values())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(families):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for family, kind, help, samples in families:
+        lines.append(f"# HELP {family} {help}")
+        lines.append(f"# TYPE {family} {kind}")
+        for sample, labels, value in samples:
+            label_text = ",".join(f'{name}="{_escape(v)}"' for name, v in labels)
+            lines.append(f"{sample}{{{label_text}}} {value}" if label_text else f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Time spent in a handler", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Handlers that raised", ("handler",))
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Time to process one update")
+UPDATE_DB_OPS = REGISTRY.histogram("bot_update_db_operations", "Database round-trips per update",
+                                   buckets=COUNT_BUCKETS)
+DB_SECONDS = REGISTRY.histogram("bot_db_seconds", "Database operation latency", ("collection", "operation"))
+
+# Database operations of the update being processed; None outside of updates
+_update_db_ops = contextvars.ContextVar("update_db_ops", default=None)
+
+
+def timed_handler(name, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def instrument_handlers(application):
+    """Time every registered handler; the anti-flood group (< 0) is left alone."""
+    for group, handlers in application.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback.__name__, handler.callback)
+
+
+def timed_updates(process):
+    """Wrap ``process(update)`` to record its latency and database round-trips."""
+    @functools.wraps(process)
+    async def wrapper(update):
+        ops = [0]
+        token = _update_db_ops.set(ops)
+        started = time.perf_counter()
+        try:
+            return await process(update)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started)
+            UPDATE_DB_OPS.observe(ops[0])
+            _update_db_ops.reset(token)
+    return wrapper
+
+
+def _count_db_op():
+    ops = _update_db_ops.get()
+    if ops is not None:
+        ops[0] += 1
+
+
+class InstrumentedCollection:
+    """Motor collection wrapper that times every database operation."""
+
+    TIMED = {"find_one", "find_one_and_update", "find_one_and_delete", "find_one_and_replace",
+             "update_one", "update_many", "replace_one", "insert_one", "insert_many",
+             "delete_one", "delete_many", "bulk_write", "count_documents", "create_index"}
+    CURSORS = {"find", "aggregate"}  # counted when the cursor is created, not timed
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.TIMED:
+            return self._timed(name, attr)
+        if name in self.CURSORS:
+            @functools.wraps(attr)
+            def cursor(*args, **kwargs):
+                _count_db_op()
+                return attr(*args, **kwargs)
+            return cursor
+        return attr
+
+    def _timed(self, name, operation):
+        collection = self._collection.name
+
+        @functools.wraps(operation)
+        async def wrapper(*args, **kwargs):
+            _count_db_op()
+            started = time.perf_counter()
+            try:
+                return await operation(*args, **kwargs)
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, collection, name)
+        return wrapper
@@ -0,0 +1,259 @@
+# migrations.py - версионные миграции документов пользователей
+#
+# A user document records the shape it has in "schema_version" (missing
+# means 0; new users start at storage.SCHEMA_VERSION). Each migration brings
+# a document from one version to the next. A run streams the users that are
+# behind in user_id order, a batch at a time, runs the transforms each one
+# still needs on the document in memory and sends the resulting updates of
+# the whole batch in one bulk_write.
+#
+# Users are split into partitions by user_id modulo the partition count and
+# the partitions run concurrently, in one process or spread over several
+# with --only. Every partition checkpoints the last user_id it finished in
+# the "migrations" collection, so a run that crashed resumes where it
+# stopped. The bot can keep serving meanwhile: an update
+# only applies if the user's schema_version and pets_version are still what
+# was read, and users that changed in between are left for the next run.
+# A migration that changes what the bot's cached copies derive from bumps
+# pets_version, which writes built from those copies require (see collect
+# in bot.py): they stop matching and the cache reloads the user.
+#   MONGO_URI=... python migrations.py --partitions 8 --batch-size 1000
+#   MONGO_URI=... python migrations.py --partitions 8 --only 0 1 2 3   # and 4 5 6 7 elsewhere
+#   MONGO_URI=... python migrations.py --dry-run
+
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+from pymongo import ASCENDING
+
+from economy import is_pending, legacy_income
+from leaderboard import legacy_ranking
+from mechanics import RARITIES, coin_rate
+from storage import SCHEMA_VERSION, UserUpdate
+
+logger = logging.getLogger(__name__)
+
+# ``transform(user, changes)`` adds to the UserUpdate what brings ``user`` to ``version``.
+# With ``fresh_ids``, the number of new pet IDs it needs for a user, it is
+# called as ``transform(user, changes, pet_ids)`` with an iterator of them.
+Migration = namedtuple("Migration", "version description transform fresh_ids", defaults=(None,))
+
+
+def rename_last_claim(user, changes):
+    """Users made by the old initialize_user have last_claim and no eggs."""
+    if "last_claim" in user:
+        if user.get("last_daily") is None:
+            changes.set("last_daily", user["last_claim"])
+        changes.unset("last_claim")
+    for field, default in (("eggs", {}), ("streak", 0)):
+        if field not in user:
+            changes.set(field, default)
+
+
+def build_summaries(user, changes):
+    """The income summary and ranking keys, which get_user otherwise builds on first load."""
+    if "income" not in user:
+        changes.set("income", legacy_income(user))
+    if "power" not in user:
+        for field, value in legacy_ranking(user, RARITIES).items():
+            changes.set(field, value)
+
+
+def repeated_pets(user):
+    """How many of the user's pets have an ID an earlier pet in the collection has too."""
+    pet_ids = [pet["id"] for pet in user.get("pets", [])]
+    return len(pet_ids) - len(set(pet_ids))
+
+
+def renumber_repeated_pets(user, changes, pet_ids):
+    """Give a fresh ID to every pet whose old random five-digit ID an earlier pet has too.
+
+    Until then commands refuse to move such pets, since a $pull by ID
+    takes all of them. Runs before rebalance_coin_rates, which sets rates by ID.
+    """
+    if not repeated_pets(user):
+        return
+    seen = set()
+    pets = []
+    for pet in user["pets"]:
+        if pet["id"] in seen:
+            pet = dict(pet, id=next(pet_ids))
+        seen.add(pet["id"])
+        pets.append(pet)
+    changes.set("pets", pets)
+    changes.inc("pets_version", 1)  # cached copies hold the old IDs
+
+
+def rebalance_coin_rates(user, changes):
+    """Give every pet the coin rate mechanics.coin_rate gives now, and move the income with it."""
+    by_rate = {}  # {new rate: IDs of the pets that get it}, one array filter per rate
+    deltas = {}
+    for pet in user.get("pets", []):
+        rate = coin_rate(pet["rarity"])
+        if pet.get("coin_rate") == rate:
+            continue
+        by_rate.setdefault(rate, []).append(pet["id"])
+        field = "income.pending_rate" if is_pending(user["income"], pet) else "income.rate"
+        deltas[field] = deltas.get(field, 0) + rate - pet.get("coin_rate", 0)
+    for rate, pet_ids in by_rate.items():
+        changes.set_pet(pet_ids, "coin_rate", rate)
+    for field, amount in deltas.items():
+        changes.inc(field, amount)
+    if by_rate:
+        changes.inc("pets_version", 1)  # cached collection pages show the old rates
+
+
+MIGRATIONS = [
+    Migration(1, "last_claim -> last_daily, default eggs and streak", rename_last_claim),
+    Migration(2, "income summary and ranking keys", build_summaries),
+    Migration(3, "fresh IDs for repeated legacy pet IDs", renumber_repeated_pets, fresh_ids=repeated_pets),
+    Migration(4, "coin rates of merged pets", rebalance_coin_rates),
+]
+assert [m.version for m in MIGRATIONS] == list(range(1, SCHEMA_VERSION + 1))
+
+
+def fresh_ids_needed(user, target=SCHEMA_VERSION):
+    """How many new pet IDs migrate() takes to bring ``user`` to ``target``."""
+    return sum(migration.fresh_ids(user) for migration in MIGRATIONS[user.get("schema_version", 0):target]
+               if migration.fresh_ids is not None)
+
+
+def migrate(user, target=SCHEMA_VERSION, pet_ids=()):
+    """Update requests that bring one user document to ``target``, in order.
+
+    Every migration is its own update that requires the version (and pets)
+    the previous one left, so if one of them finds the user changed, the
+    rest don't apply either. ``user`` is migrated in place. ``pet_ids``
+    holds at least fresh_ids_needed(user) new pet IDs.
+    """
+    pet_ids = iter(pet_ids)
+    requests = []
+    for migration in MIGRATIONS[user.get("schema_version", 0):target]:
+        changes = UserUpdate()
+        if migration.fresh_ids is None:
+            migration.transform(user, changes)
+        else:
+            migration.transform(user, changes, pet_ids)
+        changes.require("schema_version", user.get("schema_version"))
+        changes.require("pets_version", user.get("pets_version"))
+        changes.set("schema_version", migration.version)
+        requests.extend(changes.requests(user["user_id"]))
+        changes.apply(user)
+    return requests
+
+
+def _behind(target):
+    return {"$or": [{"schema_version": None}, {"schema_version": {"$lt": target}}]}
+
+
+class Migrator:
+    """Runs the migrations over a users collection, ``partitions`` at a time.
+
+    ``checkpoints`` is where each partition records its progress; a run
+    with the same target and partition count picks up from there. A
+    partition's checkpoint is removed when it is done, so the next run
+    looks at its users again, including those that were stale.
+    ``pet_ids`` hands out the new pet IDs some migrations need.
+    """
+
+    def __init__(self, users, checkpoints, pet_ids, target=SCHEMA_VERSION, partitions=8, batch_size=1000):
+        self.users = users
+        self.checkpoints = checkpoints
+        self.pet_ids = pet_ids  # storage.PetIdAllocator
+        self.target = target
+        self.partitions = partitions
+        self.batch_size = batch_size
+
+    def _checkpoint_id(self, partition):
+        return f"v{self.target}:{partition}/{self.partitions}"
+
+    async def pending(self):
+        """How many users are at each version below the target: {version: count}."""
+        counts = {}
+        async for user in self.users.find(_behind(self.target), {"_id": 0, "schema_version": 1}):
+            version = user.get("schema_version", 0)
+            counts[version] = counts.get(version, 0) + 1
+        return counts
+
+    async def reset(self):
+        for partition in range(self.partitions):
+            await self.checkpoints.delete_one({"_id": self._checkpoint_id(partition)})
+
+    async def run(self, only=None):
+        """Migrate the partitions in ``only`` (default all); returns the totals {"users", "requests", "stale"}."""
+        partitions = range(self.partitions) if only is None else only
+        results = await asyncio.gather(*(self._run_partition(p) for p in partitions))
+        return {key: sum(result[key] for result in results) for key in ("users", "requests", "stale")}
+
+    async def _run_partition(self, partition):
+        checkpoint = await self.checkpoints.find_one({"_id": self._checkpoint_id(partition)}) or {}
+        totals = {key: checkpoint.get(key, 0) for key in ("users", "requests", "stale")}
+
+        query = {"user_id": {"$mod": [self.partitions, partition]}, **_behind(self.target)}
+        if "after" in checkpoint:
+            query["user_id"]["$gt"] = checkpoint["after"]
+        cursor = self.users.find(query, {"_id": 0}).sort([("user_id", ASCENDING)])
+        batch = []
+        async for user in cursor.batch_size(self.batch_size):
+            batch.append(user)
+            if len(batch) >= self.batch_size:
+                await self._write(partition, batch, totals)
+                batch = []
+        if batch:
+            await self._write(partition, batch, totals)
+        await self.checkpoints.delete_one({"_id": self._checkpoint_id(partition)})
+        return totals
+
+    async def _write(self, partition, batch, totals):
+        needed = sum(fresh_ids_needed(user, self.target) for user in batch)
+        pet_ids = iter(await self.pet_ids.allocate(needed)) if needed else ()
+        requests = [request for user in batch for request in migrate(user, self.target, pet_ids)]
+        if requests:
+            # Ordered: a user's migrations must apply in turn
+            result = await self.users.bulk_write(requests, ordered=True)
+            totals["stale"] += len(requests) - result.matched_count
+        totals["users"] += len(batch)
+        totals["requests"] += len(requests)
+        await self._save_checkpoint(partition, totals, after=batch[-1]["user_id"])
+
+    async def _save_checkpoint(self, partition, totals, **fields):
+        await self.checkpoints.update_one({"_id": self._checkpoint_id(partition)},
+                                          {"$set": dict(totals, updated_at=time.time(), **fields)}, upsert=True)
+
+
+async def _main(uri, args):
+    from storage import PetIdAllocator, create_client
+
+    db = create_client(uri)["petropolis"]
+    migrator = Migrator(db["users"], db["migrations"], PetIdAllocator(db["counters"]),
+                        partitions=args.partitions, batch_size=args.batch_size)
+    if args.dry_run:
+        for version, count in sorted((await migrator.pending()).items()):
+            print(f"{count} users at version {version}")
+        return
+    if args.restart:
+        await migrator.reset()
+    started = time.perf_counter()
+    totals = await migrator.run(args.only)
+    elapsed = time.perf_counter() - started
+    print(f"{totals['users']} users migrated to version {SCHEMA_VERSION} in {elapsed:.1f} s, "
+          f"{totals['stale']} of {totals['requests']} updates found the user changed (run again for them)")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Bring user documents to the current schema version")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--only", type=int, nargs="+", help="partitions to run in this process")
+    parser.add_argument("--dry-run", action="store_true", help="only count the users behind, per version")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints of an earlier run")
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(os.environ["MONGO_URI"], parser.parse_args()))
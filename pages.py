@@ -0,0 +1,136 @@
+# pages.py - постраничный вывод коллекции питомцев
+#
+# Collections are shown one page at a time, sorted and optionally filtered by
+# rarity or type, with prev/next buttons. Pages are rendered once and cached
+# under the user's pets_version, a counter bumped by every change to the pets,
+# so a cached page can never be stale and nothing is invalidated explicitly.
+#
+# Callback data: page_<view>_<sort>_<filter>_<page>, where the filter is "-",
+# r<rarity index> or t<type index> to stay within Telegram's 64 bytes.
+
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from mechanics import PET_TYPES, RARITIES
+
+PAGE_SIZE = 10
+
+SORTS = {
+    "added": "по порядку",
+    "rarity": "по редкости",
+    "level": "по уровню",
+    "type": "по виду",
+}
+_SORT_KEYS = {
+    "rarity": lambda pet: (-RARITIES.index(pet["rarity"]), -pet["level"]),
+    "level": lambda pet: (-pet["level"], -RARITIES.index(pet["rarity"])),
+    "type": lambda pet: (PET_TYPES.index(pet["type"]), -RARITIES.index(pet["rarity"])),
+}
+NO_FILTER = "-"
+
+
+def parse_filter(name):
+    """Filter code for a rarity or pet type name, None if it is neither."""
+    name = name.capitalize()
+    if name in RARITIES:
+        return f"r{RARITIES.index(name)}"
+    if name in PET_TYPES:
+        return f"t{PET_TYPES.index(name)}"
+    return None
+
+
+def filter_name(filt):
+    if filt == NO_FILTER:
+        return None
+    return (RARITIES if filt[0] == "r" else PET_TYPES)[int(filt[1:])]
+
+
+def _matches(pet, filt):
+    if filt == NO_FILTER:
+        return True
+    return pet["rarity" if filt[0] == "r" else "type"] == filter_name(filt)
+
+
+def page_data(view, sort, filt, page):
+    return f"page_{view}_{sort}_{filt}_{page}"
+
+
+def parse_page_data(data):
+    """(view, sort, filter, page) from callback data, None for the page counter button."""
+    if data == "page_noop":
+        return None
+    _, view, sort, filt, page = data.split("_")
+    return view, sort, filt, int(page)
+
+
+class CollectionPages:
+    """Sorted, filtered and rendered pages of users' pet collections.
+
+    ``renderers`` maps a view kind to ``render(view, entries, total)`` returning
+    (text, keyboard rows) for one page, where entries are (number, pet) pairs
+    and the number is the pet's position in the collection. Views may carry a
+    parameter after a dot, e.g. "offer.123" for an offer to user 123.
+    """
+
+    def __init__(self, renderers, page_size=PAGE_SIZE, max_size=5000):
+        self.renderers = renderers
+        self.page_size = page_size
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key, build):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = self.entries[key] = build()
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+    def order(self, user, sort, filt):
+        """Positions in user["pets"] of the pets to show, in display order."""
+        def build():
+            pets = user["pets"]
+            positions = [i for i, pet in enumerate(pets) if _matches(pet, filt)]
+            if sort in _SORT_KEYS:
+                positions.sort(key=lambda i: _SORT_KEYS[sort](pets[i]))
+            return positions
+
+        return self._cached(("order", user["user_id"], user.get("pets_version", 0), sort, filt), build)
+
+    def render(self, user, view, sort="added", filt=NO_FILTER, page=0):
+        """(text, reply markup) of one page; out-of-range pages show the nearest one."""
+        positions = self.order(user, sort, filt)
+        pages = max(1, -(-len(positions) // self.page_size))
+        page = min(max(page, 0), pages - 1)
+
+        def build():
+            start = page * self.page_size
+            entries = [(i + 1, user["pets"][i]) for i in positions[start:start + self.page_size]]
+            text, rows = self.renderers[view.split(".")[0]](view, entries, len(positions))
+            rows = rows + self._navigation(view, sort, filt, page, pages, len(positions))
+            return text, InlineKeyboardMarkup(rows) if rows else None
+
+        key = ("page", user["user_id"], user.get("pets_version", 0), view, sort, filt, page)
+        return self._cached(key, build)
+
+    @staticmethod
+    def _navigation(view, sort, filt, page, pages, count):
+        rows = []
+        if pages > 1:
+            row = []
+            if page > 0:
+                row.append(InlineKeyboardButton("◀", callback_data=page_data(view, sort, filt, page - 1)))
+            row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="page_noop"))
+            if page < pages - 1:
+                row.append(InlineKeyboardButton("▶", callback_data=page_data(view, sort, filt, page + 1)))
+            rows.append(row)
+        if count > 1:
+            rows.append([InlineKeyboardButton(label, callback_data=page_data(view, other, filt, 0))
+                         for other, label in SORTS.items() if other != sort])
+        return rows
@@ -0,0 +1,133 @@
+# ratelimit.py - ограничение частоты запросов (анти-флуд)
+#
+# Token buckets in front of the handlers: every user has an overall budget,
+# some commands and buttons have a tighter one on top, and the process has a
+# global one. Over-budget updates are dropped before any handler (and so any
+# database access) runs. Repeated presses of the same button within a short
+# window are coalesced into the first one.
+
+import time
+from collections import OrderedDict
+
+from telegram.ext import ApplicationHandlerStop
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``capacity`` saved up."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """Per-user, per-command and global token buckets.
+
+    Budgets are (tokens per second, burst). ``budgets`` maps a command or a
+    callback prefix (the part of callback data before the first "_") to its
+    budget. Buckets of idle users are dropped in LRU order beyond ``max_keys``;
+    a dropped bucket comes back full, which is what it would have refilled to.
+    """
+
+    def __init__(self, user_budget=(2, 10), budgets=None, global_budget=None, max_keys=100000,
+                 clock=time.monotonic):
+        self.user_budget = user_budget
+        self.budgets = budgets or {}
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()  # {key: TokenBucket}
+        self.global_bucket = TokenBucket(*global_budget, clock()) if global_budget else None
+
+    def _bucket(self, key, budget, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*budget, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, user_id, command=None):
+        """Take a token from every bucket the update counts against, if all have one."""
+        now = self.clock()
+        buckets = [self._bucket(user_id, self.user_budget, now)]
+        if command in self.budgets:
+            buckets.append(self._bucket((user_id, command), self.budgets[command], now))
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+
+        if any(bucket.refill(now) < 1 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+
+class CallbackCoalescer:
+    """Recognises repeated presses of the same button within ``window`` seconds."""
+
+    def __init__(self, window=2.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.pressed = OrderedDict()  # {(user_id, message_id, data): pressed_at}, oldest first
+
+    def is_repeat(self, user_id, message_id, data):
+        now = self.clock()
+        while self.pressed and now - next(iter(self.pressed.values())) >= self.window:
+            self.pressed.popitem(last=False)
+
+        key = (user_id, message_id, data)
+        if key in self.pressed:
+            return True
+        self.pressed[key] = now
+        return False
+
+
+def command_of(update):
+    """The command ("collect") or callback prefix ("buy") an update is for, if any."""
+    if update.callback_query is not None:
+        return (update.callback_query.data or "").split("_", 1)[0]
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith("/"):
+        return message.text.split()[0][1:].split("@", 1)[0].lower()
+    return None
+
+
+def throttle(limiter, coalescer, notice="⏳ Не так быстро!", notice_interval=10):
+    """Handler callback that drops updates over their budget; register it in group -1.
+
+    Users over their budget are told so at most once per ``notice_interval`` seconds.
+    """
+    notices = RateLimiter(user_budget=(1 / notice_interval, 1), max_keys=limiter.max_keys, clock=limiter.clock)
+
+    async def callback(update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        query = update.callback_query
+
+        if query is not None and query.message is not None and \
+                coalescer.is_repeat(user.id, query.message.message_id, query.data):
+            await query.answer()
+            raise ApplicationHandlerStop
+
+        if limiter.allow(user.id, command_of(update)):
+            return
+
+        if query is not None:
+            await query.answer(notice)
+        elif update.effective_message is not None and notices.allow(user.id):
+            await update.effective_message.reply_text(notice)
+        raise ApplicationHandlerStop
+
+    return callback
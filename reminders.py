@@ -0,0 +1,124 @@
+# reminders.py - напоминания о доходе и ежедневной награде
+#
+# Users who opt in (/remind) get a message when their pets stop accruing
+# income and when /daily is available again. Due reminders sit in one heap
+# ordered by time, so scheduling is O(log n) no matter how many users wait,
+# and are persisted to MongoDB so they survive restarts. Rescheduling leaves
+# the old heap entry behind; it is skipped when it comes up.
+
+import asyncio
+import heapq
+import logging
+import time
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("income", "daily")
+
+
+class ReminderScheduler:
+    """Time-ordered reminders for the users of one shard.
+
+    ``send(user_id, kind)`` is awaited for every due reminder, at most
+    ``batch_size`` of them every ``interval`` seconds, which keeps reminders
+    well inside Telegram's broadcast limits. Changes are written to the
+    collection in batches as well.
+    """
+
+    def __init__(self, collection, send, batch_size=20, interval=1.0, shard=0, shards=1):
+        self.collection = collection
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self.shard = shard
+        self.shards = shards
+        self.heap = []  # [(due_at, user_id, kind)], may hold outdated entries
+        self.due = {}  # {(user_id, kind): due_at}, the current schedule
+        self.writes = {}  # {(user_id, kind): due_at, or None to delete}, not persisted yet
+        self._runner = None
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("user_id", ASCENDING)])
+
+    async def load(self):
+        """Read this shard's reminders into the heap."""
+        query = {"user_id": {"$mod": [self.shards, self.shard]}} if self.shards > 1 else {}
+        async for doc in self.collection.find(query, {"_id": 0, "user_id": 1, "kind": 1, "due_at": 1}):
+            self.due[(doc["user_id"], doc["kind"])] = doc["due_at"]
+        self.heap = [(due_at, user_id, kind) for (user_id, kind), due_at in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def schedule(self, user_id, kind, due_at):
+        if self.due.get((user_id, kind)) == due_at:
+            return
+        self.due[(user_id, kind)] = due_at
+        self.writes[(user_id, kind)] = due_at
+        heapq.heappush(self.heap, (due_at, user_id, kind))
+
+    def cancel(self, user_id, kind=None):
+        for kind in [kind] if kind else KINDS:
+            if self.due.pop((user_id, kind), None) is not None:
+                self.writes[(user_id, kind)] = None
+
+    def pop_due(self, now):
+        """Up to batch_size reminders that are due, earliest first."""
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            due_at, user_id, kind = heapq.heappop(self.heap)
+            if self.due.get((user_id, kind)) == due_at:
+                del self.due[(user_id, kind)]
+                self.writes[(user_id, kind)] = None
+                due.append((user_id, kind))
+        return due
+
+    async def persist(self):
+        if not self.writes:
+            return
+        writes, self.writes = self.writes, {}
+        requests = []
+        for (user_id, kind), due_at in writes.items():
+            key = {"_id": f"{user_id}:{kind}"}
+            if due_at is None:
+                requests.append(DeleteOne(key))
+            else:
+                requests.append(UpdateOne(key, {"$set": {"user_id": user_id, "kind": kind, "due_at": due_at}},
+                                          upsert=True))
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # Newer changes win over the ones that failed
+            self.writes = {**writes, **self.writes}
+            raise
+
+    async def run_due(self, now=None):
+        due = self.pop_due(time.time() if now is None else now)
+        results = await asyncio.gather(*(self.send(user_id, kind) for user_id, kind in due), return_exceptions=True)
+        for (user_id, kind), result in zip(due, results):
+            if isinstance(result, Exception):
+                logger.warning("Failed to send %s reminder to %s: %s", kind, user_id, result)
+        return len(due)
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_due()
+                await self.persist()
+            except Exception:
+                logger.exception("Failed to process reminders")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        await self.persist()
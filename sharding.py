@@ -0,0 +1,139 @@
+# sharding.py - порядок апдейтов по пользователям и шардирование по процессам
+#
+# Updates of one user are always handled one after another, updates of
+# different users run concurrently. With SHARDS > 1 the main process only
+# receives updates and routes them by user_id to worker processes, so each
+# user is owned by exactly one worker (and its in-process user cache).
+# State shared by all users, like the /findbattle queue, lives on one worker
+# and the others send it messages.
+
+import asyncio
+import logging
+import multiprocessing
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(user_id, shards):
+    return user_id % shards
+
+
+def update_user_id(update):
+    """The user an update belongs to; updates without a user all go to 0."""
+    user = update.effective_user
+    return user.id if user else 0
+
+
+class UpdateDispatcher:
+    """Runs ``process(update)`` in order per user and concurrently across users.
+
+    Every user has a chain of tasks where each one waits for the previous, and
+    a semaphore bounds how many updates are processed at the same time.
+    """
+
+    def __init__(self, process, max_concurrency=256):
+        self.process = process
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.chains = {}  # {user_id: last task of that user}
+
+    def submit(self, user_id, update):
+        task = asyncio.create_task(self._run(self.chains.get(user_id), update))
+        self.chains[user_id] = task
+        task.add_done_callback(lambda t: self.chains.get(user_id) is t and self.chains.pop(user_id))
+
+    async def _run(self, previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            try:
+                await self.process(update)
+            except Exception:
+                logger.exception("Failed to process update %s", update)
+
+    def queue_depth(self):
+        return len(self.chains)
+
+    async def drain(self):
+        if self.chains:
+            await asyncio.wait(list(self.chains.values()))
+
+
+async def fetch_updates(queue, handle):
+    """Hand every update from the application's queue to ``handle``."""
+    while True:
+        handle(await queue.get())
+
+
+class ShardRouter:
+    """Main-process side of sharding: starts the workers and routes updates to them.
+
+    ``target(index, shards, inbox, control)`` runs in every worker process. Workers
+    read raw update dicts from their inbox (``None`` means stop) and may put
+    ``{"invalidate": user_id}`` into ``control`` when they changed a user owned
+    by another worker; the router forwards it to the owner. Any other message
+    with a ``"shard"`` goes to that worker. Workers also report
+    ``{"metrics": index, "families": ...}``, which the router keeps for /metrics.
+    """
+
+    def __init__(self, shards, target):
+        context = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self.inboxes = [context.Queue() for _ in range(shards)]
+        self.control = context.Queue()
+        self.processes = [
+            context.Process(target=target, args=(i, shards, self.inboxes[i], self.control), daemon=True)
+            for i in range(shards)
+        ]
+        self.worker_metrics = {}  # {index: latest families reported by the worker}
+        self._forwarder = threading.Thread(target=self._forward_control, daemon=True)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self._forwarder.start()
+
+    def route(self, update):
+        self.inboxes[shard_for(update_user_id(update), self.shards)].put(update.to_dict())
+
+    def _forward_control(self):
+        while True:
+            message = self.control.get()
+            if message is None:
+                return
+            if "metrics" in message:
+                self.worker_metrics[message["metrics"]] = message["families"]
+            elif "shard" in message:
+                self.inboxes[message["shard"]].put(message)
+            else:
+                self.inboxes[shard_for(message["invalidate"], self.shards)].put(message)
+
+    def queue_depth(self):
+        return sum(inbox.qsize() for inbox in self.inboxes)
+
+    def stop(self, timeout=30):
+        """Ask the workers to finish what they have queued, then wait for them."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        self.control.put(None)
+
+
+async def worker_loop(inbox, on_update, on_invalidate, on_message=None):
+    """Worker-process side: read the inbox until the router says stop.
+
+    Messages other workers addressed to this one (with a ``"shard"``) go to ``on_message``.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await loop.run_in_executor(None, inbox.get)
+        if message is None:
+            return
+        if "invalidate" in message:
+            on_invalidate(message["invalidate"])
+        elif "shard" in message:
+            if on_message is not None:
+                on_message(message)
+        else:
+            on_update(message)
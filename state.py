@@ -0,0 +1,183 @@
+# state.py - состояние диалогов (merge/train и т.п.) с истечением
+#
+# Every store has the same async interface: get(key), set(key, value, ttl),
+# delete(key), purge(). Values must be JSON-serialisable, and a value is
+# gone ``ttl`` seconds after it was set, so abandoned conversations don't
+# pile up.
+#   MemoryStateStore - per process, capped; enough when updates are sharded by user
+#   SQLiteStateStore - local file, shared by processes on one host, survives restarts
+#   MongoStateStore  - shared by workers on any host
+# Conversations sits on top of a store: it keeps one state per user and
+# sends a user's text messages to the handler of the state they are in.
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStateStore:
+    """Holds at most ``max_size`` keys; once full, the least recently set key goes first."""
+
+    def __init__(self, max_size=100000, clock=time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self.data = OrderedDict()  # {key: (value, expires_at)}, least recently set first
+
+    def __len__(self):
+        return len(self.data)
+
+    async def ensure_indexes(self):
+        pass
+
+    async def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self.clock():
+            del self.data[key]
+            return None
+        return entry[0]
+
+    async def set(self, key, value, ttl):
+        self.data[key] = (value, self.clock() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    async def purge(self):
+        """Drop expired keys from the least recently set end; they expire in that order for one ttl."""
+        now = self.clock()
+        while self.data:
+            key, (_, expires_at) = next(iter(self.data.items()))
+            if expires_at > now:
+                break
+            del self.data[key]
+
+
+class SQLiteStateStore:
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state "
+                        "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (expires)")
+
+    async def ensure_indexes(self):
+        pass
+
+    async def get(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set(self, key, value, ttl):
+        self.db.execute("INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+                        (key, json.dumps(value), time.time() + ttl))
+
+    async def delete(self, key):
+        self.db.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    async def purge(self):
+        self.db.execute("DELETE FROM state WHERE expires <= ?", (time.time(),))
+
+
+class MongoStateStore:
+    """Expired documents are removed by a TTL index; until it runs, reads skip them."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    async def get(self, key):
+        doc = await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        return doc["value"] if doc else None
+
+    async def set(self, key, value, ttl):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        await self.collection.update_one({"_id": key}, {"$set": {"value": value, "expires_at": expires_at}},
+                                         upsert=True)
+
+    async def delete(self, key):
+        await self.collection.delete_one({"_id": key})
+
+    async def purge(self):
+        pass
+
+
+class Conversations:
+    """The state each user's conversation is in, and the text handler of every state.
+
+    ``begin`` puts a user in a state for ``ttl`` seconds; ``dispatch`` is the
+    one handler of text messages and passes a message to the handler
+    registered for the sender's state with ``on``, or to ``default``.
+    Messages from users in no state are ignored.
+    """
+
+    def __init__(self, store, ttl=600, sweep_interval=60):
+        self.store = store
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.handlers = {}  # {state: handler(update, context)}
+        self.default = None
+        self._sweeper = None
+
+    @staticmethod
+    def _key(user_id):
+        return f"state:{int(user_id)}"
+
+    async def ensure_indexes(self):
+        await self.store.ensure_indexes()
+
+    def on(self, state, handler):
+        self.handlers[state] = handler
+
+    async def get(self, user_id):
+        return await self.store.get(self._key(user_id))
+
+    async def begin(self, user_id, state):
+        await self.store.set(self._key(user_id), state, self.ttl)
+
+    async def end(self, user_id):
+        await self.store.delete(self._key(user_id))
+
+    async def dispatch(self, update, context):
+        state = await self.get(update.effective_user.id)
+        if state is None:
+            return
+        handler = self.handlers.get(state, self.default)
+        if handler is not None:
+            await handler(update, context)
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.store.purge()
+            except Exception:
+                logger.exception("Failed to purge expired conversation states")
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
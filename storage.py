@@ -0,0 +1,798 @@
+# storage.py - асинхронный доступ к данным пользователей (MongoDB через motor)
+
+import asyncio
+import copy
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+def create_client(uri, pool_size=50, min_pool_size=0, connect_timeout_ms=5000,
+                  server_selection_timeout_ms=5000, socket_timeout_ms=10000):
+    """Create a pooled, non-blocking Mongo client.
+
+    The client does not connect until the first operation, so creating it is cheap.
+    """
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    return AsyncIOMotorClient(
+        uri,
+        tls=True,
+        maxPoolSize=pool_size,
+        minPoolSize=min_pool_size,
+        connectTimeoutMS=connect_timeout_ms,
+        serverSelectionTimeoutMS=server_selection_timeout_ms,
+        socketTimeoutMS=socket_timeout_ms,
+    )
+
+
+class LazyClient:
+    """Stand-in for a Mongo client that is only created by ``open()`` or its first use.
+
+    Databases and collections taken from it are lazy too, so modules can bind
+    their collections at import time without importing motor or building a
+    client. ``close()`` drops the client; the next use creates a new one.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._client = None
+
+    def open(self):
+        if self._client is None:
+            self._client = self.factory()
+        return self._client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def __getitem__(self, name):
+        return LazyDatabase(self, name)
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+
+class LazyDatabase:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return LazyCollection(self, name)
+
+    def __getattr__(self, name):
+        return getattr(self.client.open()[self.name], name)
+
+
+class LazyCollection:
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._resolved = (None, None)  # (client, collection)
+
+    def __getattr__(self, name):
+        client, collection = self._resolved
+        if client is not self.database.client.open():
+            client = self.database.client.open()
+            collection = client[self.database.name][self.name]
+            self._resolved = (client, collection)
+        return getattr(collection, name)
+
+
+# Version of the user document's shape; migrations.py brings older documents up to it
+SCHEMA_VERSION = 4
+
+# How many marks of written updates a user document keeps, see UserUpdate.mark()
+WRITE_MARKS = 64
+
+
+def new_user(user_id):
+    """Default document for a freshly registered user."""
+    return {
+        "user_id": user_id,
+        "schema_version": SCHEMA_VERSION,
+        "coins": 450,
+        "eggs": {},
+        "pets": [],
+        "last_daily": None,
+        "streak": 0
+    }
+
+
+def _values(doc, path):
+    """All values at a dotted path, descending into arrays like Mongo does."""
+    values = [doc]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    # Arrays match by their elements as well as by themselves
+    flat = []
+    for value in values:
+        flat.append(value)
+        if isinstance(value, list):
+            flat.extend(value)
+    return flat
+
+
+def _compare(values, op, arg):
+    if op == "$gte":
+        return any(v is not None and not isinstance(v, list) and v >= arg for v in values)
+    if op == "$gt":
+        return any(v is not None and not isinstance(v, list) and v > arg for v in values)
+    if op == "$lte":
+        return any(v is not None and not isinstance(v, list) and v <= arg for v in values)
+    if op == "$lt":
+        return any(v is not None and not isinstance(v, list) and v < arg for v in values)
+    if op == "$eq":
+        return arg in values
+    if op == "$ne":
+        return arg not in values
+    if op == "$in":
+        return any(v in arg for v in values if not isinstance(v, list))
+    if op == "$nin":
+        return not any(v in arg for v in values if not isinstance(v, list))
+    if op == "$all":
+        return all(a in values for a in arg)
+    if op == "$exists":
+        return bool(values) == arg
+    if op == "$mod":
+        return any(isinstance(v, int) and v % arg[0] == arg[1] for v in values)
+    raise ValueError(f"Unsupported operator {op}")
+
+
+def matches(doc, conditions):
+    """Evaluate a (small subset of a) Mongo filter against a document."""
+    for path, condition in conditions.items():
+        if path == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        values = _values(doc, path)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if not all(_compare(values, op, arg) for op, arg in condition.items()):
+                return False
+        elif condition not in values:
+            if not (condition is None and not values):
+                return False
+    return True
+
+
+def _element_matches(item, condition):
+    if isinstance(condition, dict):
+        if condition and all(k.startswith("$") for k in condition):
+            return all(_compare([item], op, arg) for op, arg in condition.items())
+        return isinstance(item, dict) and matches(item, condition)
+    return item == condition
+
+
+def _targets(doc, parts, array_filters):
+    """Yield (container, key) pairs addressed by an update path."""
+    containers = [doc]
+    for part in parts[:-1]:
+        found = []
+        for container in containers:
+            if part.startswith("$["):
+                name = part[2:-1]
+                if not name:
+                    found.extend(container)
+                    continue
+                condition = {k[len(name) + 1:]: v for k, v in array_filters.items() if k.split(".")[0] == name}
+                found.extend(item for item in container if matches(item, condition))
+            elif isinstance(container, list):
+                found.append(container[int(part)])
+            else:
+                found.append(container.setdefault(part, {}))
+        containers = found
+    key = parts[-1]
+    for container in containers:
+        yield container, int(key) if isinstance(container, list) else key
+
+
+def apply_update(doc, update, array_filters=None):
+    """Apply Mongo update operators to a local document in place."""
+    merged_filters = {}
+    for array_filter in array_filters or []:
+        merged_filters.update(array_filter)
+
+    for op, fields in update.items():
+        for path, value in fields.items():
+            for container, key in _targets(doc, path.split("."), merged_filters):
+                exists = key < len(container) if isinstance(container, list) else key in container
+                if op == "$set":
+                    container[key] = copy.deepcopy(value)
+                elif op == "$inc":
+                    container[key] = (container[key] if exists else 0) + value
+                elif op == "$unset":
+                    if exists:
+                        del container[key]
+                elif op == "$push":
+                    items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                    if not exists or container[key] is None:
+                        container[key] = []
+                    container[key].extend(copy.deepcopy(items))
+                    if isinstance(value, dict) and "$slice" in value:
+                        # Only the negative form ("keep the last n") is used
+                        container[key] = container[key][value["$slice"]:] if value["$slice"] else []
+                elif op == "$pull":
+                    if exists:
+                        container[key] = [item for item in container[key] if not _element_matches(item, value)]
+                else:
+                    raise ValueError(f"Unsupported update operator {op}")
+
+
+def get_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _filter_array(items, spec):
+    """Evaluate {"$filter": {"input": "$pets", "as": "pet", "cond": {"$in": ["$$pet.id", [...]]}}}."""
+    name = spec.get("as", "this")
+    op, (field, values) = next(iter(spec["cond"].items()))
+    if op != "$in":
+        raise ValueError(f"Unsupported $filter condition {op}")
+    field = field[len(f"$${name}."):]
+    return [item for item in items or [] if get_path(item, field)[0] in values]
+
+
+def project(doc, projection, clone=True):
+    """Apply a find() projection to a local document, returning a copy (or, without ``clone``, sharing values)."""
+    dup = copy.deepcopy if clone else (lambda value: value)
+    if projection is None:
+        return dup(doc)
+    if all(spec == 0 for spec in projection.values()):
+        return {key: dup(value) for key, value in doc.items() if key not in projection}
+    result = {} if projection.get("_id", 1) == 0 or "_id" not in doc else {"_id": doc["_id"]}
+    for path, spec in projection.items():
+        if path == "_id":
+            continue
+        if isinstance(spec, dict) and "$elemMatch" in spec:
+            found = [item for item in doc.get(path, []) if matches(item, spec["$elemMatch"])][:1]
+            if found:
+                result[path] = dup(found)
+        elif isinstance(spec, dict) and "$filter" in spec:
+            result[path] = dup(_filter_array(doc.get(spec["$filter"]["input"][1:]), spec["$filter"]))
+        elif spec:
+            value, exists = get_path(doc, path)
+            if exists:
+                set_path(result, path, dup(value))
+    return result
+
+
+def pets_projection(pet_ids):
+    """Projection of every pet with one of ``pet_ids``; ``$elemMatch`` would only give the first.
+
+    Pets from before PetIdAllocator can share their random five-digit ID
+    until migrations.py renumbers them, and a ``$pull`` by ID takes them all,
+    so whatever moves a pet by ID must see that exactly one has it.
+    """
+    return {"$filter": {"input": "$pets", "as": "pet", "cond": {"$in": ["$$pet.id", list(pet_ids)]}}}
+
+
+def repeated_pet_id(pets):
+    """An ID that more than one of ``pets`` has, None if they all differ."""
+    seen = set()
+    for pet in pets:
+        if pet["id"] in seen:
+            return pet["id"]
+        seen.add(pet["id"])
+    return None
+
+
+def _conflicts(path, other):
+    parts, other_parts = path.split("."), other.split(".")
+    shortest = min(len(parts), len(other_parts))
+    return parts[:shortest] == other_parts[:shortest]
+
+
+class UserUpdate:
+    """Targeted update of one user document.
+
+    Collects Mongo update operators (``$inc``, ``$set``, ``$push``, ``$pull``)
+    and the conditions the document must satisfy before they are applied, so
+    a write never has to resend the whole document. Operators that touch
+    conflicting paths (e.g. pulling and pushing pets) go into consecutive stages
+    which are sent as ordered requests.
+    """
+
+    def __init__(self):
+        self.conditions = {}
+        self.stages = [({}, [])]  # [(update, array_filters)]
+        self._paths = [[]]
+        self._filter_count = 0
+
+    def _add(self, op, path, value):
+        if any(_conflicts(path, other) for other in self._paths[-1]):
+            self.stages.append(({}, []))
+            self._paths.append([])
+        update, _ = self.stages[-1]
+        update.setdefault(op, {})[path] = copy.deepcopy(value)
+        self._paths[-1].append(path)
+        return self
+
+    def _pet_path(self, pet_id, field):
+        if isinstance(pet_id, (list, tuple, set)):
+            condition = {"$in": list(pet_id)}
+        else:
+            condition = pet_id
+        name = f"p{self._filter_count}"
+        self._filter_count += 1
+        path = f"pets.$[{name}].{field}"
+        if any(_conflicts(path, other) for other in self._paths[-1]):
+            self.stages.append(({}, []))
+            self._paths.append([])
+        self.stages[-1][1].append({f"{name}.id": condition})
+        return path
+
+    def require(self, field, condition):
+        """Only apply the update if ``field`` matches ``condition`` (a Mongo filter value)."""
+        self.conditions[field] = condition
+        return self
+
+    def require_pets(self, *pet_ids):
+        """Only apply the update if the user still owns all given pets."""
+        return self.require("pets.id", {"$all": list(pet_ids)})
+
+    def inc(self, field, amount):
+        return self._add("$inc", field, amount)
+
+    def set(self, field, value):
+        return self._add("$set", field, value)
+
+    def unset(self, field):
+        return self._add("$unset", field, "")
+
+    def push(self, field, *values):
+        return self._add("$push", field, {"$each": list(values)})
+
+    def pull(self, field, condition):
+        return self._add("$pull", field, condition)
+
+    def pull_pets(self, *pet_ids):
+        return self.pull("pets", {"id": {"$in": list(pet_ids)}})
+
+    def set_pet(self, pet_id, field, value):
+        """Set a field on one pet (or a list of pets) addressed by ID."""
+        return self._add("$set", self._pet_path(pet_id, field), value)
+
+    def inc_pet(self, pet_id, field, amount):
+        return self._add("$inc", self._pet_path(pet_id, field), amount)
+
+    def mark(self, token):
+        """Leave ``token`` in the document's "_marks" when the update is written.
+
+        Add it last, so it goes with the last request: that one only applies
+        if the others did. The document keeps the last WRITE_MARKS marks.
+        """
+        return self._add("$push", "_marks", {"$each": [token], "$slice": -WRITE_MARKS})
+
+    def incremented(self, field):
+        """Total amount ``field`` is incremented by, e.g. the coins an update spends or earns."""
+        return sum(update.get("$inc", {}).get(field, 0) for update, _ in self.stages)
+
+    def matches(self, user):
+        return matches(user, self.conditions)
+
+    def apply(self, user):
+        """Apply the update to a local copy of the user document."""
+        for update, array_filters in self.stages:
+            apply_update(user, update, array_filters)
+
+    def requests(self, user_id):
+        """Mongo write requests for this update, conditions go on the first one.
+
+        With several stages the first one stamps the document with a token
+        that the later ones require, so they only apply if the first did.
+        """
+        stages = [stage for stage in self.stages if stage[0]]
+        token = uuid.uuid4().hex if len(stages) > 1 else None
+        requests = []
+        for i, (update, array_filters) in enumerate(stages):
+            query = {"user_id": user_id}
+            if i == 0:
+                query.update(self.conditions)
+                if token:
+                    update = dict(update, **{"$set": dict(update.get("$set", {}), _write=token)})
+            else:
+                query["_write"] = token
+            requests.append(UpdateOne(query, update, array_filters=array_filters or None))
+        return requests
+
+
+class UserRepository:
+    """Async access to the users collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("user_id", ASCENDING)], unique=True)
+        await self.collection.create_index([("pets.id", ASCENDING)])
+
+    async def get(self, user_id, fields=None):
+        """Retrieve a user or create a new one in a single round-trip.
+
+        With ``fields`` only those fields (and user_id) are returned.
+        """
+        defaults = new_user(user_id)
+        defaults.pop("user_id")
+        projection = None if fields is None else {"_id": 0, "user_id": 1, **{field: 1 for field in fields}}
+        return await self.collection.find_one_and_update(
+            {"user_id": user_id},
+            {"$setOnInsert": defaults},
+            projection=projection,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def get_pets(self, user_id, pet_ids, fields=()):
+        """Only the given pets and ``fields`` of a user, None if there is no such user."""
+        projection = {"_id": 0, "user_id": 1, **{field: 1 for field in fields}}
+        projection["pets"] = pets_projection(pet_ids)
+        return await self.collection.find_one({"user_id": user_id}, projection)
+
+    async def marks(self, user_ids):
+        """{user_id: set of the marks in their document} (see UserUpdate.mark)."""
+        cursor = self.collection.find({"user_id": {"$in": list(user_ids)}}, {"_id": 0, "user_id": 1, "_marks": 1})
+        return {doc["user_id"]: set(doc.get("_marks", ())) async for doc in cursor}
+
+    async def exists(self, user_id):
+        return await self.collection.find_one({"user_id": user_id}, {"_id": 1}) is not None
+
+    async def bulk_write(self, requests):
+        """Send update requests in order, in a single round-trip."""
+        return await self.collection.bulk_write(requests, ordered=True)
+
+
+class UserCache:
+    """In-process write-back cache in front of UserRepository.
+
+    Reads are served from memory. Updates are checked and applied to the
+    cached document right away and their write requests are queued; a
+    background task flushes everything queued with one bulk_write. Clean
+    entries are evicted by LRU order or after ``ttl`` seconds, dirty ones
+    stay resident until they have been flushed.
+
+    Updates that change coins for a ``reason`` go to the ``ledger`` (a
+    CoinLedger) once they are written. A queued one may yet fail to match
+    or be dropped, so it marks the document (UserUpdate.mark), and when a
+    flush does not match everything the marks tell which events to record.
+    """
+
+    def __init__(self, repository, max_size=10000, ttl=300, flush_interval=5, ledger=None):
+        self.repository = repository
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.ledger = ledger
+        self.entries = OrderedDict()  # {user_id: (user, loaded_at)}
+        self.pending = {}  # {user_id: [UpdateOne, ...]}
+        self.events = {}  # {user_id: [(mark, request that carries it, ledger.record args), ...]}
+        self.stale = set()  # changed elsewhere, reload once pending writes are flushed
+        self.on_invalidate = None  # called for every invalidation, e.g. to tell other workers
+        self._direct_writes = 0  # loads that overlap a direct write are not cached
+        self.hits = 0
+        self.misses = 0
+        self._flusher = None
+        self._writing = asyncio.Lock()  # one write-back at a time keeps every user's events in order
+
+    def _cached(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        user, loaded_at = entry
+        if user_id not in self.pending and time.monotonic() - loaded_at >= self.ttl:
+            return None
+        self.entries.move_to_end(user_id)
+        return user
+
+    def _lookup(self, user_id):
+        """_cached() for a read that is served either way, counted as a hit or a miss."""
+        user = self._cached(user_id)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    async def get(self, user_id):
+        user = self._lookup(user_id)
+        if user is not None:
+            return user
+
+        direct_writes = self._direct_writes
+        user = await self.repository.get(user_id)
+
+        # Another coroutine may have loaded (and modified) the user while we waited
+        cached = self._cached(user_id)
+        if cached is not None:
+            return cached
+        if self._direct_writes != direct_writes:
+            return user
+
+        self.entries[user_id] = (user, time.monotonic())
+        self.entries.move_to_end(user_id)
+        self._evict()
+        return user
+
+    async def update(self, user_id, changes, reason=None):
+        """Apply a UserUpdate, returns the updated user or None if its conditions failed.
+
+        The check and the local apply happen without yielding to the event
+        loop, so concurrent handlers for the same user cannot interleave.
+        With a ``reason`` the change of coins goes to the ledger once written.
+        """
+        if len(self.events.get(user_id, ())) >= WRITE_MARKS // 2:
+            # The marks of the waiting events must still be in the document when they are checked
+            await self.flush_users([user_id])
+        user = await self.get(user_id)
+        if not changes.matches(user):
+            return None
+        changes.apply(user)
+        amount = changes.incremented("coins") if reason is not None and self.ledger is not None else 0
+        if amount:
+            mark = uuid.uuid4().hex[:12]
+            requests = changes.mark(mark).requests(user_id)
+            self.events.setdefault(user_id, []).append((mark, requests[-1], (user_id, amount, reason, user["coins"])))
+        else:
+            requests = changes.requests(user_id)
+        self.pending.setdefault(user_id, []).extend(requests)
+        return user
+
+    @staticmethod
+    def _view(user, fields):
+        return {field: user[field] for field in ("user_id", *fields) if field in user}
+
+    async def get_fields(self, user_id, fields):
+        """Only ``fields`` of a user (created if new), for commands that need a few scalars.
+
+        Served from the cached document if there is one, otherwise with a
+        projected query that is not cached.
+        """
+        user = self._lookup(user_id)
+        if user is None:
+            return await self.repository.get(user_id, fields)
+        return self._view(user, fields)
+
+    async def get_pets(self, user_id, pet_ids, fields=()):
+        """Only the given pets and ``fields`` of a user, without loading the whole collection.
+
+        Served like get_fields(). Returns None for unknown users.
+        """
+        user = self._lookup(user_id)
+        if user is None:
+            return await self.repository.get_pets(user_id, pet_ids, fields)
+        wanted = set(pet_ids)
+        view = self._view(user, fields)
+        view["pets"] = [pet for pet in user["pets"] if pet["id"] in wanted]
+        return view
+
+    async def update_view(self, user_id, view, changes, reason=None):
+        """Apply a UserUpdate to a user read with get_fields() or get_pets().
+
+        Cached users go through update(). Others are written to the database
+        right away, so their document never has to be loaded; the changes are
+        applied to ``view``, which is returned, or None if the conditions failed.
+        """
+        if self._cached(user_id) is not None:
+            return await self.update(user_id, changes, reason)
+        if not changes.matches(view):
+            return None
+
+        requests = changes.requests(user_id)
+        self._direct_writes += 1
+        result = await self.repository.bulk_write(requests)
+        if result.matched_count < len(requests):
+            return None
+        # A load that started before the write may have cached the old document
+        self.evict(user_id)
+        changes.apply(view)
+        if reason is not None and self.ledger is not None:
+            self.ledger.record(user_id, changes.incremented("coins"), reason, view["coins"])
+        return view
+
+    def evict(self, user_id):
+        """Drop a clean entry so the next read goes to the database."""
+        if user_id not in self.pending:
+            self.entries.pop(user_id, None)
+
+    def invalidate(self, user_id, notify=True):
+        """The user was changed directly in the database: reload it on next read."""
+        if user_id in self.pending:
+            self.stale.add(user_id)
+        else:
+            self.entries.pop(user_id, None)
+        if notify and self.on_invalidate is not None:
+            self.on_invalidate(user_id)
+
+    def _evict(self):
+        if len(self.entries) <= self.max_size:
+            return
+        for user_id in list(self.entries):
+            if len(self.entries) <= self.max_size:
+                break
+            if user_id not in self.pending:
+                del self.entries[user_id]
+
+    def _requeue(self, pending):
+        for user_id, requests in pending.items():
+            self.pending[user_id] = requests + self.pending.get(user_id, [])
+
+    def _requeue_events(self, events):
+        for user_id, user_events in events.items():
+            if user_events:
+                self.events[user_id] = user_events + self.events.get(user_id, [])
+
+    async def flush(self):
+        """Write all queued updates to the database, returns how many users were written."""
+        async with self._writing:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, {}
+            return await self._write(pending)
+
+    async def flush_users(self, user_ids):
+        """Write queued updates of the given users only."""
+        async with self._writing:
+            pending = {user_id: self.pending.pop(user_id) for user_id in user_ids if user_id in self.pending}
+            if not pending:
+                return 0
+            return await self._write(pending)
+
+    async def _record_marked(self, events):
+        """Send the coin events whose update left its mark to the ledger, drop the others.
+
+        The balances of the later events, including those still waiting, came
+        from a cached copy that counted the dropped changes, so they are corrected.
+        """
+        events = {user_id: user_events for user_id, user_events in events.items() if user_events}
+        if not events:
+            return
+        marks = await self.repository.marks(events)
+        for user_id, user_events in events.items():
+            dropped = 0
+            for mark, _, (_, amount, reason, balance) in user_events:
+                if mark in marks.get(user_id, ()):
+                    self.ledger.record(user_id, amount, reason, balance - dropped)
+                else:
+                    logger.warning("Coin change %s of user %s was not written, leaving it out of the ledger",
+                                   amount, user_id)
+                    dropped += amount
+            if dropped and user_id in self.events:
+                self.events[user_id] = [(mark, request, (user_id, amount, reason, balance - dropped))
+                                        for mark, request, (_, amount, reason, balance) in self.events[user_id]]
+
+    async def _write(self, pending):
+        events = {user_id: self.events.pop(user_id) for user_id in pending if user_id in self.events}
+        requests = [request for user_requests in pending.values() for request in user_requests]
+        try:
+            result = await self.repository.bulk_write(requests)
+        except BulkWriteError as e:
+            # Requests before the failed one are applied, retry only the rest
+            failed = e.details["writeErrors"][0]["index"]
+            logger.error("Dropping user update %s: %s", requests[failed], e.details["writeErrors"][0]["errmsg"])
+            done = set(map(id, requests[:failed + 1]))
+            self._requeue({user_id: [r for r in user_requests if id(r) not in done]
+                           for user_id, user_requests in pending.items()})
+            for user_id in pending:
+                self.evict(user_id)
+            # Events of retried updates wait for them; the rest went through unless their update was dropped
+            self._requeue_events({user_id: [event for event in user_events if id(event[1]) not in done]
+                                  for user_id, user_events in events.items()})
+            await self._record_marked({user_id: [event for event in user_events if id(event[1]) in done]
+                                       for user_id, user_events in events.items()})
+            raise
+        except Exception:
+            self._requeue(pending)
+            self._requeue_events(events)
+            raise
+
+        if result.matched_count < len(requests):
+            # A condition failed in the database, so our copy no longer matches it
+            logger.warning("%d of %d user updates did not match, reloading affected users",
+                           len(requests) - result.matched_count, len(requests))
+            for user_id in pending:
+                self.evict(user_id)
+            await self._record_marked(events)
+        else:
+            for user_events in events.values():
+                for _, _, event in user_events:
+                    self.ledger.record(*event)
+
+        for user_id in list(self.stale):
+            if user_id not in self.pending:
+                self.stale.discard(user_id)
+                self.entries.pop(user_id, None)
+        return len(pending)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush user cache")
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stop the background task and flush pending writes."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+
+class PetIdAllocator:
+    """Collision-free pet IDs from a counter in MongoDB.
+
+    IDs are reserved in blocks of ``block_size``, so most allocations need no
+    round-trip. IDs start above ``start`` to stay clear of the old random
+    five-digit IDs.
+    """
+
+    def __init__(self, counters, block_size=100, start=100000):
+        self.counters = counters
+        self.block_size = block_size
+        self.start = start
+        self.next_id = 0
+        self.block_end = -1
+        self._lock = asyncio.Lock()
+
+    async def _reserve(self, count):
+        doc = await self.counters.find_one_and_update(
+            {"_id": "pet_id"},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self.next_id = self.start + doc["value"] - count
+        self.block_end = self.start + doc["value"] - 1
+
+    async def allocate(self, count=1):
+        async with self._lock:
+            ids = []
+            while len(ids) < count:
+                if self.next_id > self.block_end:
+                    await self._reserve(max(self.block_size, count - len(ids)))
+                take = min(count - len(ids), self.block_end - self.next_id + 1)
+                ids.extend(range(self.next_id, self.next_id + take))
+                self.next_id += take
+            return ids
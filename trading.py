@@ -0,0 +1,148 @@
+# trading.py - обмен питомцами между игроками (предложения хранятся в MongoDB)
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+
+from economy import added_pets_delta, merge_deltas, new_income, removed_pets_delta
+from leaderboard import ranking_delta
+from storage import pets_projection, repeated_pet_id
+
+logger = logging.getLogger(__name__)
+
+
+class TradeError(Exception):
+    """A trade could not be settled; the message is shown to the user."""
+
+
+def arrived(pet):
+    """The pet as its new owner gets it: it starts earning like a fresh one."""
+    pet.pop("last_collected", None)
+    pet["added_at"] = time.time()
+    return pet
+
+
+def summary_update(owner, rarities, added=(), removed=()):
+    """$inc/$set of the income summary and ranking keys for pets entering and leaving a collection.
+
+    ``owner`` holds the summaries from before (income, rarity_counts, best_rarity).
+    """
+    income = owner.get("income") or new_income()
+    rank_inc, rank_set = ranking_delta(owner, rarities, added, removed)
+    inc = merge_deltas(removed_pets_delta(income, removed), added_pets_delta(added), rank_inc, {"pets_version": 1})
+    update = {}
+    if inc:
+        update["$inc"] = inc
+    if rank_set:
+        update["$set"] = rank_set
+    return update
+
+
+class TradeEngine:
+    """Trade offers persisted in their own collection and settled atomically.
+
+    Every proposer has at most one open offer. Offers expire through a TTL
+    index, and pets are referenced by their ID rather than list position, so
+    any bot worker can create or settle a trade.
+    """
+
+    def __init__(self, client, users, trades, cache, rarities, ttl=900):
+        self.client = client
+        self.rarities = rarities
+        self.users = users
+        self.trades = trades
+        self.cache = cache
+        self.ttl = ttl
+
+    async def ensure_indexes(self):
+        await self.trades.create_index([("proposer_id", ASCENDING)], unique=True)
+        await self.trades.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    async def create_offer(self, proposer_id, partner_id, pet_id):
+        """Open (or replace) the proposer's offer of one pet to a partner."""
+        now = datetime.now(timezone.utc)
+        await self.trades.replace_one(
+            {"proposer_id": proposer_id},
+            {
+                "proposer_id": proposer_id,
+                "partner_id": partner_id,
+                "pet_id": pet_id,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl),
+            },
+            upsert=True,
+        )
+
+    async def get_offer(self, proposer_id):
+        """The proposer's open offer, or None. The TTL monitor may lag, so expiry is checked here too."""
+        return await self.trades.find_one({
+            "proposer_id": proposer_id,
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+        })
+
+    async def cancel(self, proposer_id):
+        await self.trades.delete_one({"proposer_id": proposer_id})
+
+    async def _take_pet(self, user_id, pet_id, session):
+        """Pull the pet out of the user's collection.
+
+        Returns (pet, owner summary fields), or (None, None) if the user no longer has it.
+        """
+        before = await self.users.find_one_and_update(
+            {"user_id": user_id, "pets.id": pet_id},
+            {"$pull": {"pets": {"id": pet_id}}},
+            projection={"pets": pets_projection([pet_id]), "income": 1, "rarity_counts": 1, "best_rarity": 1},
+            session=session,
+        )
+        if not before:
+            return None, None
+        if repeated_pet_id(before["pets"]) is not None:
+            # The $pull took all of them; the transaction puts them back
+            raise TradeError(f"У одного из вас несколько питомцев с ID {pet_id}. Скоро им выдадут новые ID, "
+                             f"тогда попробуйте снова.")
+        return before.pop("pets")[0], before
+
+    async def _give_pet(self, user_id, owner, old_pet, new_pet, session):
+        new_pet = arrived(new_pet)
+        update = dict(summary_update(owner, self.rarities, [new_pet], [old_pet]), **{"$push": {"pets": new_pet}})
+        result = await self.users.update_one({"user_id": user_id, "pets.id": {"$ne": new_pet["id"]}}, update,
+                                             session=session)
+        if not result.matched_count:
+            raise TradeError(f"У одного из вас уже есть питомец с ID {new_pet['id']}.")
+
+    async def settle(self, proposer_id, responder_id, responder_pet_id):
+        """Swap the offered pet for the responder's pet in one transaction.
+
+        Returns (proposer_pet, responder_pet). Raises TradeError if the offer is
+        gone or either pet has changed hands in the meantime; nothing is written then.
+        """
+        # Queued cache writes must reach the database before it becomes the source of truth
+        await self.cache.flush_users([proposer_id, responder_id])
+
+        async def swap(session):
+            trade = await self.trades.find_one_and_delete({
+                "proposer_id": proposer_id,
+                "partner_id": responder_id,
+                "expires_at": {"$gt": datetime.now(timezone.utc)},
+            }, session=session)
+            if not trade:
+                raise TradeError("Предложение устарело.")
+
+            proposer_pet, proposer = await self._take_pet(proposer_id, trade["pet_id"], session)
+            responder_pet, responder = await self._take_pet(responder_id, responder_pet_id, session)
+            if proposer_pet is None or responder_pet is None:
+                raise TradeError("Одного из питомцев уже нет у владельца.")
+
+            await self._give_pet(proposer_id, proposer, proposer_pet, dict(responder_pet), session)
+            await self._give_pet(responder_id, responder, responder_pet, dict(proposer_pet), session)
+            return proposer_pet, responder_pet
+
+        async with await self.client.start_session() as session:
+            try:
+                result = await session.with_transaction(swap)
+            finally:
+                self.cache.invalidate(proposer_id)
+                self.cache.invalidate(responder_id)
+        return result